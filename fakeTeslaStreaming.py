@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+
+# This is a stand-in for the Tesla streaming API server. It lets you test
+# simpleTWCcontrol.py's carApiStreaming = True support without a car or a Tesla
+# account.
+#
+# Run it, then in simpleTWCcontrol.py set:
+#   carApiStreaming = True
+#   carApiStreamingURL = 'ws://127.0.0.1:8765/streaming/'
+#
+# It answers every data:subscribe_oauth message with a data:update about once a
+# second for a car parked at homeLat, homeLon below. Every dropAfterSecs it
+# closes the connection without warning so you can watch the client reconnect.
+# Set homeLat and homeLon somewhere else to test a car that isn't at home.
+
+import socketserver
+import base64
+import hashlib
+import struct
+import json
+import time
+
+listenAddr = ('127.0.0.1', 8765)
+
+homeLat = 37.4925
+homeLon = -121.9447
+
+# Power in kW. Negative means the car is charging.
+power = -7
+
+# Set to 0 to never drop connections.
+dropAfterSecs = 120
+
+debugLevel = 1
+
+
+def time_now():
+    return time.strftime("%H:%M:%S")
+
+def recv_exact(sock, numBytes):
+    data = b''
+    while(len(data) < numBytes):
+        chunk = sock.recv(numBytes - len(data))
+        if(len(chunk) == 0):
+            raise ValueError('connection closed')
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    (byte0, byte1) = recv_exact(sock, 2)
+    length = byte1 & 0x7F
+    if(length == 126):
+        length = struct.unpack('>H', recv_exact(sock, 2))[0]
+    elif(length == 127):
+        length = struct.unpack('>Q', recv_exact(sock, 8))[0]
+
+    mask = None
+    if(byte1 & 0x80):
+        mask = recv_exact(sock, 4)
+    payload = bytearray(recv_exact(sock, length))
+    if(mask != None):
+        for i in range(0, len(payload)):
+            payload[i] ^= mask[i % 4]
+
+    return (byte0 & 0x0F, bytes(payload))
+
+def send_frame(sock, opcode, payload):
+    # Frames from the server aren't masked. The real server sends JSON in
+    # binary frames, so we do too.
+    header = bytearray([0x80 | opcode])
+    if(len(payload) < 126):
+        header.append(len(payload))
+    elif(len(payload) < 0x10000):
+        header.append(126)
+        header += struct.pack('>H', len(payload))
+    else:
+        header.append(127)
+        header += struct.pack('>Q', len(payload))
+    sock.sendall(bytes(header) + payload)
+
+def send_msg(sock, msg):
+    send_frame(sock, 0x2, json.dumps(msg).encode('utf-8'))
+
+
+class StreamingHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        sock.settimeout(30)
+        try:
+            self.handshake(sock)
+            self.stream(sock)
+        except (OSError, ValueError) as e:
+            if(debugLevel >= 1):
+                print(time_now() + ': ' + str(self.client_address) + ' ' + str(e))
+
+    def handshake(self, sock):
+        request = b''
+        while(b'\r\n\r\n' not in request):
+            data = sock.recv(1024)
+            if(len(data) == 0):
+                raise ValueError('connection closed during handshake')
+            request += data
+
+        key = None
+        for line in request.decode('latin-1').split('\r\n')[1:]:
+            (name, sep, value) = line.partition(':')
+            if(name.strip().lower() == 'sec-websocket-key'):
+                key = value.strip()
+        if(key == None):
+            sock.sendall(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+            raise ValueError('no Sec-WebSocket-Key')
+
+        accept = base64.b64encode(hashlib.sha1((key
+                    + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('ascii')
+                 ).digest()).decode('ascii')
+        sock.sendall(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: ' + accept + '\r\n\r\n').encode('ascii'))
+        send_msg(sock, {'msg_type': 'control:hello', 'connection_timeout': 30000})
+
+    def stream(self, sock):
+        (opcode, payload) = recv_frame(sock)
+        msg = json.loads(payload.decode('utf-8'))
+        if(msg.get('msg_type') != 'data:subscribe_oauth'):
+            send_msg(sock, {'msg_type': 'data:error', 'tag': msg.get('tag'),
+                            'error_type': 'client_error',
+                            'value': 'unknown msg_type'})
+            return
+
+        tag = msg.get('tag')
+        columns = str(msg.get('value', '')).split(',')
+        if(debugLevel >= 1):
+            print(time_now() + ': ' + str(self.client_address)
+                  + ' subscribed to vehicle ' + str(tag))
+
+        timeConnected = time.time()
+        while(dropAfterSecs == 0 or time.time() - timeConnected < dropAfterSecs):
+            state = {
+                'speed': '',
+                'odometer': '12345.6',
+                'soc': '60',
+                'elevation': '10',
+                'est_heading': '90',
+                'est_lat': str(homeLat),
+                'est_lng': str(homeLon),
+                'power': str(power),
+                'shift_state': '',
+                'range': '180',
+                'est_range': '150',
+                'heading': '90',
+            }
+            value = [str(int(time.time() * 1000))]
+            for column in columns:
+                value.append(state.get(column, ''))
+            send_msg(sock, {'msg_type': 'data:update', 'tag': tag,
+                            'value': ','.join(value)})
+            time.sleep(1)
+
+        if(debugLevel >= 1):
+            print(time_now() + ': Dropping ' + str(self.client_address))
+
+
+socketserver.ThreadingTCPServer.allow_reuse_address = True
+socketserver.ThreadingTCPServer.daemon_threads = True
+server = socketserver.ThreadingTCPServer(listenAddr, StreamingHandler)
+print(time_now() + ': Fake Tesla streaming server listening on '
+      + listenAddr[0] + ':' + str(listenAddr[1]))
+server.serve_forever()
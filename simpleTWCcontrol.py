@@ -109,17 +109,55 @@ import serial
 import time
 import re
 import subprocess
-import queue
+import heapq
+import socket
+import selectors
+import mmap
+import asyncio
+import collections
+import itertools
+import http.server
+import signal
+import ssl
+import base64
+import hashlib
+import os
+import fcntl
+import termios
+import ctypes
+import ctypes.util
+import zlib
+import urllib.parse
 import random
 import math
 import struct
 import sys
+import gzip
+import shutil
+import gc
+import tracemalloc
 import traceback
 import sysv_ipc
 import json
+import csv
+import sqlite3
+import argparse
 from datetime import datetime
 import threading
 
+try:
+    # numpy is only needed to record heartbeat samples. See SampleStore.
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    # pyarrow is only needed to export history as Parquet. See export_history().
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 
 ##########################
 #
@@ -207,6 +245,13 @@ minAmpsPerTWC = 12
 # a car not at home being stopped from charging by the API.
 onlyChargeMultiCarsAtHome = True
 
+# Set carApiStreaming = True to keep a connection open to the Tesla streaming
+# API for each car. The stream tells us where cars are as soon as they move, so
+# checking whether a car is at home doesn't need to wait for a drive_state
+# request. If the stream stops sending data, we go back to asking the car.
+carApiStreaming = False
+carApiStreamingURL = 'wss://streaming.vn.teslamotors.com/streaming/'
+
 # After determining how much green energy is available for charging, we add
 # greenEnergyAmpsOffset to the value. This is most often given a negative value
 # equal to the average amount of power consumed by everything other than car
@@ -234,6 +279,13 @@ debugLevel = 1
 # Choose whether to display milliseconds after time on each line of debug info.
 displayMilliseconds = False
 
+# Debug info goes to stdout. Set logFileName to also write it to a file. When
+# the file reaches logMaxBytes, it's compressed to logFileName.1.gz and a new
+# one is started. We keep logNumBackups compressed files.
+logFileName = ''
+logMaxBytes = 10*1024*1024
+logNumBackups = 5
+
 # Normally we fake being a TWC Master using fakeMaster = 1.
 # Two other settings are available, but are only useful for debugging and
 # experimenting:
@@ -286,6 +338,22 @@ def hex_str(s:str):
 def hex_str(ba:bytearray):
     return " ".join("{:02X}".format(c) for c in ba)
 
+def log(minDebugLevel, fmt, *args):
+    # Print time_now() + fmt % args if debugLevel >= minDebugLevel. Nothing is
+    # formatted here. LogWriter does that on its own thread, and prints bytes
+    # and bytearray args the way hex_str() does, so pass them with %s instead
+    # of calling hex_str() yourself. Use %r to print them like b'text'
+    # instead. Use this instead of print() for anything printed while we're
+    # talking to TWCs.
+    if(debugLevel < minDebugLevel):
+        return
+    for arg in args:
+        if(type(arg) is bytearray):
+            # Copy bytearrays since they may change before they're printed.
+            args = tuple((bytes(arg) if type(arg) is bytearray else arg) for arg in args)
+            break
+    logWriter.events.append((next(logWriter.seqCounter), time.time(), fmt, args))
+
 def run_process(cmd):
     result = None
     try:
@@ -297,131 +365,223 @@ def run_process(cmd):
     return result
 
 
-def load_settings():
-    global debugLevel, settingsFileName, nonScheduledAmpsMax, scheduledAmpsMax, \
-           scheduledAmpsStartHour, scheduledAmpsEndHour, \
-           scheduledAmpsDaysBitmap, hourResumeTrackGreenEnergy, kWhDelivered, \
-           carApiBearerToken, carApiRefreshToken, carApiTokenExpireTime, \
-           homeLat, homeLon
+def parse_setting(name, value):
+    # Convert the text value of setting name in settingsFileName to the type
+    # settingsSchema declares for it. Raises ValueError if it doesn't fit.
+    global settingsSchema
+
+    settingType = settingsSchema[name]
+    if(settingType == 'int'):
+        # Accept '12.0' as well as '12' in case someone edits the file by hand.
+        return int(float(value))
+    if(settingType == 'float' or settingType == 'time'):
+        return float(value)
+    return value
+
+def format_setting(name, value):
+    # Convert value of setting name to the text we store in settingsFileName.
+    global settingsSchema
+
+    settingType = settingsSchema[name]
+    if(settingType == 'int' or settingType == 'time'):
+        return str(int(value))
+    if(settingType == 'float'):
+        # Defaults like homeLat = 10000 are ints, so make sure they look the
+        # same as the float we'd parse from the file.
+        return str(float(value))
+    return str(value)
+
+def settings_snapshot():
+    # Return a dict of the text we'd store in settingsFileName for each setting
+    # in settingsSchema, in schema order.
+    global settingsSchema
+
+    snapshot = {}
+    for name in settingsSchema:
+        snapshot[name] = format_setting(name, globals()[name])
+    return snapshot
+
+def load_settings(reload = False):
+    # Read settingsFileName and set the global named by each setting in it.
+    #
+    # Each line is split on the first '=' and looked up in settingsSchema, so
+    # the file is read in one pass without trying every setting's pattern on
+    # every line.
+    #
+    # When reload is True, settingsFileName was changed while we were running,
+    # so only settings that differ from what we last loaded or saved are set.
+    global debugLevel, settingsFileName, settingsSchema, settingsLock, \
+           settingsLastSaved
 
+    settingsLock.acquire()
     try:
-        fh = open(settingsFileName, 'r')
-
-        for line in fh:
-            m = re.search(r'^\s*nonScheduledAmpsMax\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                nonScheduledAmpsMax = int(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: nonScheduledAmpsMax set to " + str(nonScheduledAmpsMax))
-                continue
-
-            m = re.search(r'^\s*scheduledAmpsMax\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                scheduledAmpsMax = int(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: scheduledAmpsMax set to " + str(scheduledAmpsMax))
-                continue
-
-            m = re.search(r'^\s*scheduledAmpsStartHour\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                scheduledAmpsStartHour = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: scheduledAmpsStartHour set to " + str(scheduledAmpsStartHour))
-                continue
-
-            m = re.search(r'^\s*scheduledAmpsEndHour\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                scheduledAmpsEndHour = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: scheduledAmpsEndHour set to " + str(scheduledAmpsEndHour))
-                continue
-
-            m = re.search(r'^\s*scheduledAmpsDaysBitmap\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                scheduledAmpsDaysBitmap = int(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: scheduledAmpsDaysBitmap set to " + str(scheduledAmpsDaysBitmap))
-                continue
-
-            m = re.search(r'^\s*hourResumeTrackGreenEnergy\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                hourResumeTrackGreenEnergy = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: hourResumeTrackGreenEnergy set to " + str(hourResumeTrackGreenEnergy))
-                continue
-
-            m = re.search(r'^\s*kWhDelivered\s*=\s*([-0-9.]+)', line, re.MULTILINE)
-            if(m):
-                kWhDelivered = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: kWhDelivered set to " + str(kWhDelivered))
+        try:
+            fh = open(settingsFileName, 'r')
+            lines = fh.readlines()
+            fh.close()
+        except FileNotFoundError:
+            return
+
+        for line in lines:
+            (name, sep, value) = line.partition('=')
+            name = name.strip()
+            value = value.rstrip('\r\n')
+            if(sep == '' and name == ''):
+                # Ignore blank lines.
                 continue
 
-            m = re.search(r'^\s*carApiBearerToken\s*=\s*(.+)', line, re.MULTILINE)
-            if(m):
-                carApiBearerToken = m.group(1)
-                if(debugLevel >= 10):
-                    print("load_settings: carApiBearerToken set to " + str(carApiBearerToken))
+            if(name in counterJournalNames):
+                # Older versions stored counters like kWhDelivered in
+                # settingsFileName. Use the value as a starting point in case
+                # counterJournal has never saved one.
+                if(not reload):
+                    try:
+                        globals()[name] = float(value)
+                    except ValueError:
+                        pass
                 continue
 
-            m = re.search(r'^\s*carApiRefreshToken\s*=\s*(.+)', line, re.MULTILINE)
-            if(m):
-                carApiRefreshToken = m.group(1)
-                if(debugLevel >= 10):
-                    print("load_settings: carApiRefreshToken set to " + str(carApiRefreshToken))
+            if(name not in settingsSchema):
+                print(time_now() + ": load_settings: Unknown setting " + line)
                 continue
 
-            m = re.search(r'^\s*carApiTokenExpireTime\s*=\s*(.+)', line, re.MULTILINE)
-            if(m):
-                carApiTokenExpireTime = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: carApiTokenExpireTime set to " + str(carApiTokenExpireTime))
+            if(settingsSchema[name] != 'str'):
+                value = value.strip()
+            try:
+                parsedValue = parse_setting(name, value)
+            except ValueError:
+                print(time_now() + ": load_settings: Bad value for setting " + line)
                 continue
 
-            m = re.search(r'^\s*homeLat\s*=\s*(.+)', line, re.MULTILINE)
-            if(m):
-                homeLat = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: homeLat set to " + str(homeLat))
+            if(reload and format_setting(name, parsedValue) == settingsLastSaved.get(name)):
                 continue
 
-            m = re.search(r'^\s*homeLon\s*=\s*(.+)', line, re.MULTILINE)
-            if(m):
-                homeLon = float(m.group(1))
-                if(debugLevel >= 10):
-                    print("load_settings: homeLon set to " + str(homeLon))
-                continue
+            globals()[name] = parsedValue
+            settingsLastSaved[name] = format_setting(name, parsedValue)
+            if(debugLevel >= 10 or (reload and debugLevel >= 1)):
+                print(time_now() + ": load_settings: " + name + " set to " + str(parsedValue))
 
-            print(time_now() + ": load_settings: Unknown setting " + line)
+        if(not reload):
+            # Settings missing from the file keep their defaults. Remember those
+            # too so save_settings() doesn't rewrite an unchanged file.
+            settingsLastSaved = settings_snapshot()
+    finally:
+        settingsLock.release()
 
+def save_settings():
+    # Write every setting in settingsSchema to settingsFileName, unless none of
+    # them changed since we last loaded or saved the file.
+    #
+    # We write to a temp file and rename it over settingsFileName so that a
+    # crash or power loss in the middle of a write leaves either the old or the
+    # new file, never a truncated one. That matters on a pi that loses power
+    # whenever the breaker feeding it and the TWC trips.
+    global debugLevel, settingsFileName, settingsLock, settingsLastSaved, \
+           metrics
+
+    settingsLock.acquire()
+    try:
+        snapshot = settings_snapshot()
+        if(snapshot == settingsLastSaved):
+            metrics.inc('settings_writes_skipped_total')
+            if(debugLevel >= 11):
+                print(time_now() + ": save_settings: No settings changed.")
+            return
+
+        lines = []
+        for name in snapshot:
+            lines.append(name + '=' + snapshot[name])
+
+        tmpFileName = settingsFileName + '.tmp'
+        fh = open(tmpFileName, 'w')
+        fh.write('\n'.join(lines))
+        fh.flush()
+        os.fsync(fh.fileno())
         fh.close()
+        os.replace(tmpFileName, settingsFileName)
+        metrics.inc('settings_writes_total')
+
+        settingsLastSaved = snapshot
+    finally:
+        settingsLock.release()
+
+def watch_settings():
+    # Ask the kernel to tell us when settingsFileName is written, so
+    # check_settings_file() can apply changes without polling. We watch the
+    # directory rather than the file because editors and save_settings()
+    # replace the file with a new one.
+    #
+    # If inotify isn't available, check_settings_file() falls back to checking
+    # the file's modification time every settingsPollSecs.
+    global settingsFileName, settingsWatchFd
 
-    except FileNotFoundError:
-        pass
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if(fd < 0):
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        # IN_CLOSE_WRITE | IN_MOVED_TO
+        wd = libc.inotify_add_watch(fd,
+                 os.path.dirname(os.path.abspath(settingsFileName)).encode(),
+                 0x00000008 | 0x00000080)
+        if(wd < 0):
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+
+        settingsWatchFd = fd
+    except (OSError, AttributeError, TypeError) as e:
+        if(debugLevel >= 1):
+            print(time_now() + ": Can't watch " + settingsFileName + " for changes ("
+                  + str(e) + ").  Checking every " + str(settingsPollSecs)
+                  + " seconds instead.")
+        settingsWatchFd = None
+
+def check_settings_file():
+    # Called from the main loop. Reload settingsFileName if it changed.
+    global settingsFileName, settingsWatchFd, settingsPollSecs, \
+           settingsTimeLastPolled, settingsMtime
+
+    if(settingsWatchFd != None):
+        changed = False
+        baseName = os.path.basename(settingsFileName).encode()
+        while True:
+            try:
+                data = os.read(settingsWatchFd, 4096)
+            except BlockingIOError:
+                break
 
-def save_settings():
-    global debugLevel, settingsFileName, nonScheduledAmpsMax, scheduledAmpsMax, \
-           scheduledAmpsStartHour, scheduledAmpsEndHour, \
-           scheduledAmpsDaysBitmap, hourResumeTrackGreenEnergy, kWhDelivered, \
-           carApiBearerToken, carApiRefreshToken, carApiTokenExpireTime, \
-           homeLat, homeLon
-
-    fh = open(settingsFileName, 'w')
-    fh.write('nonScheduledAmpsMax=' + str(nonScheduledAmpsMax) +
-            '\nscheduledAmpsMax=' + str(scheduledAmpsMax) +
-            '\nscheduledAmpsStartHour=' + str(scheduledAmpsStartHour) +
-            '\nscheduledAmpsEndHour=' + str(scheduledAmpsEndHour) +
-            '\nscheduledAmpsDaysBitmap=' + str(scheduledAmpsDaysBitmap) +
-            '\nhourResumeTrackGreenEnergy=' + str(hourResumeTrackGreenEnergy) +
-            '\nkWhDelivered=' + str(kWhDelivered) +
-            '\ncarApiBearerToken=' + str(carApiBearerToken) +
-            '\ncarApiRefreshToken=' + str(carApiRefreshToken) +
-            '\ncarApiTokenExpireTime=' + str(int(carApiTokenExpireTime)) +
-            '\nhomeLat=' + str(homeLat) +
-            '\nhomeLon=' + str(homeLon)
-            )
+            # Each event is struct inotify_event: int wd, uint32 mask,
+            # uint32 cookie, uint32 len, followed by len bytes of
+            # null-padded file name.
+            i = 0
+            while(i + 16 <= len(data)):
+                nameLen = struct.unpack_from('iIII', data, i)[3]
+                name = data[i + 16:i + 16 + nameLen].rstrip(b'\0')
+                if(name == baseName):
+                    changed = True
+                i += 16 + nameLen
+
+        if(not changed):
+            return
+    else:
+        now = time.time()
+        if(now - settingsTimeLastPolled < settingsPollSecs):
+            return
+        settingsTimeLastPolled = now
 
-    fh.close()
+        try:
+            mtime = os.stat(settingsFileName).st_mtime
+        except FileNotFoundError:
+            return
+        if(mtime == settingsMtime):
+            return
+        settingsMtime = mtime
+
+    # Our own save_settings() also triggers this, but load_settings() ignores
+    # settings that match what we saved.
+    load_settings(reload = True)
 
 def trim_pad(s:bytearray, makeLen):
     # Trim or pad s with zeros so that it's makeLen length.
@@ -438,9 +598,10 @@ def send_msg(msg):
     # Send msg on the RS485 network. We'll escape bytes with a special meaning,
     # add a CRC byte to the message end, and add a C0 byte to the start and end
     # to mark where it begins and ends.
-    global ser, timeLastTx, fakeMaster, slaveTWCRoundRobin
+    global ser, timeLastTx, fakeMaster, slaveTWCRoundRobin, metrics
 
     msg = bytearray(msg)
+    metrics.inc('twc_frames_tx_total', {'opcode': '%02X%02X' % (msg[0], msg[1])})
     checksum = 0
     for i in range(1, len(msg)):
         checksum += msg[i]
@@ -468,10 +629,10 @@ def send_msg(msg):
 
     msg = bytearray(b'\xc0' + msg + b'\xc0')
 
-    if(debugLevel >= 9):
-        print("Tx@" + time_now() + ": " + hex_str(msg))
+    log(9, ": Tx %s", msg)
 
     ser.write(msg)
+    busTiming.tx(len(msg))
 
     timeLastTx = time.time()
 
@@ -497,10 +658,11 @@ def unescape_msg(msg:bytearray, msgLen):
             elif(msg[i+1] == 0xdd):
                 msg[i:i+2] = [0xdb]
             else:
-                print(time_now(), "ERROR: Special character 0xDB in message is " \
+                busHealth.count('badEscapes')
+                log(0, ": ERROR: Special character 0xDB in message is " \
                   "followed by invalid character 0x%02X.  " \
-                  "Message may be corrupted." %
-                  (msg[i+1]))
+                  "Message may be corrupted.",
+                  msg[i+1])
 
                 # Replace the character with something even though it's probably
                 # not the right thing.
@@ -513,8 +675,7 @@ def unescape_msg(msg:bytearray, msgLen):
 
 
 def send_master_linkready1():
-    if(debugLevel >= 1):
-        print(time_now() + ": Send master linkready1")
+    log(1, ": Send master linkready1")
 
     # When master is powered on or reset, it sends 5 to 7 copies of this
     # linkready1 message followed by 5 copies of linkready2 (I've never seen
@@ -566,8 +727,7 @@ def send_master_linkready1():
 
 
 def send_master_linkready2():
-    if(debugLevel >= 1):
-        print(time_now() + ": Send master linkready2")
+    log(1, ": Send master linkready2")
 
     # This linkready2 message is also sent 5 times when master is booted/reset
     # and then not sent again if no other TWCs are heard from on the network.
@@ -642,6 +802,9 @@ def delete_slave(deleteSlaveID):
 
     for i in range(0, len(slaveTWCRoundRobin)):
         if(slaveTWCRoundRobin[i].TWCID == deleteSlaveID):
+            # Store the session of a car that was plugged in when we lost
+            # contact with its TWC so its energy isn't lost.
+            slaveTWCRoundRobin[i].end_session()
             del slaveTWCRoundRobin[i]
             break
     try:
@@ -649,6 +812,299 @@ def delete_slave(deleteSlaveID):
     except KeyError:
         pass
 
+def fleet_snapshot():
+    # Return a dict of everything a freshly started fake master needs to keep
+    # heartbeating our slaves where we left off. See load_fleet_snapshot().
+    global fakeTWCID, slaveTWCRoundRobin, fleetSnapshotGlobals
+
+    snapshot = {
+        'version': 1,
+        'timeSaved': time.time(),
+        'fakeTWCID': hex_str(fakeTWCID),
+        'slaves': [slaveTWC.snapshot() for slaveTWC in slaveTWCRoundRobin],
+        'globals': {},
+    }
+    for name in fleetSnapshotGlobals:
+        snapshot['globals'][name] = globals()[name]
+    return snapshot
+
+def save_fleet_snapshot(snapshot):
+    # Write a snapshot from fleet_snapshot() to fleetSnapshotFileName.
+    #
+    # Like save_settings(), we write to a temp file and rename it so a crash
+    # never leaves half a snapshot.
+    global fleetSnapshotFileName
+
+    tmpFileName = fleetSnapshotFileName + '.tmp'
+    fh = open(tmpFileName, 'w')
+    json.dump(snapshot, fh)
+    fh.close()
+    os.replace(tmpFileName, fleetSnapshotFileName)
+
+def load_fleet_snapshot():
+    # Restore the slaves in fleetSnapshotFileName so we can send them
+    # heartbeats, with the same amps offered as before, as soon as we start.
+    # Otherwise we send 10 linkready messages and wait up to 10 seconds for
+    # each slave to send its own linkready, during which cars stop charging.
+    #
+    # Returns the number of slaves restored.
+    global fleetSnapshotFileName
+
+    try:
+        fh = open(fleetSnapshotFileName, 'r')
+        snapshot = json.load(fh)
+        fh.close()
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        print(time_now() + ": WARNING: Can't read " + fleetSnapshotFileName
+              + ": " + str(e))
+        return 0
+
+    return restore_fleet_snapshot(snapshot)
+
+def restore_fleet_snapshot(snapshot):
+    # Restore the slaves and globals in a snapshot from fleet_snapshot(), read
+    # from fleetSnapshotFileName or handed to us by take_over_serial_port().
+    # Returns the number of slaves restored.
+    global debugLevel, fakeTWCID, fleetSnapshotMaxAgeSecs, \
+           fleetSnapshotGlobals, slaveTWCRoundRobin, \
+           idxSlaveToSendNextHeartbeat
+
+    now = time.time()
+    age = now - snapshot.get('timeSaved', 0)
+    if(snapshot.get('version') != 1
+       or snapshot.get('fakeTWCID') != hex_str(fakeTWCID)
+    ):
+        # Slaves only take heartbeats from the master they linked with.
+        if(debugLevel >= 1):
+            print(time_now() + ": Fleet snapshot is from a different fake master.  Ignoring it.")
+        return 0
+    if(age < 0 or age > fleetSnapshotMaxAgeSecs):
+        if(debugLevel >= 1):
+            print(time_now() + ": Fleet snapshot is %d seconds old.  Ignoring it." % (age))
+        return 0
+
+    try:
+        for state in snapshot['slaves']:
+            slaveTWC = new_slave(bytes.fromhex(state['TWCID']), state['maxAmps'])
+            slaveTWC.restore(state, now)
+            if(debugLevel >= 1):
+                print(time_now() + ": Resuming slave TWC %02X%02X at %.2fA offered." % \
+                      (slaveTWC.TWCID[0], slaveTWC.TWCID[1], slaveTWC.lastAmpsOffered))
+
+        for name in fleetSnapshotGlobals:
+            if(name in snapshot['globals']):
+                globals()[name] = snapshot['globals'][name]
+    except (KeyError, TypeError, ValueError) as e:
+        print(time_now() + ": WARNING: Bad fleet snapshot: " + str(e))
+        for slaveTWC in list(slaveTWCRoundRobin):
+            delete_slave(slaveTWC.TWCID)
+        return 0
+
+    if(idxSlaveToSendNextHeartbeat >= len(slaveTWCRoundRobin)):
+        idxSlaveToSendNextHeartbeat = 0
+
+    return len(slaveTWCRoundRobin)
+
+def send_handoff_msg(conn, data, fds = []):
+    # Send data with a length prefix so the other side knows where it ends.
+    # File descriptors in fds are passed using SCM_RIGHTS, which gives the
+    # receiving process its own descriptor for the same open file.
+    ancillary = []
+    if(len(fds) > 0):
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          struct.pack(str(len(fds)) + 'i', *fds)))
+    conn.sendmsg([struct.pack('<I', len(data)) + data], ancillary)
+
+def recv_handoff_msg(conn):
+    # Receive a message from send_handoff_msg(). Returns (data, fds).
+    fds = []
+    (data, ancillary, flags, addr) = conn.recvmsg(65536,
+                                        socket.CMSG_SPACE(struct.calcsize('i') * 4))
+    for (level, type, fdData) in ancillary:
+        if(level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS):
+            fdData = fdData[:len(fdData) - (len(fdData) % struct.calcsize('i'))]
+            fds.extend(struct.unpack(str(len(fdData) // struct.calcsize('i')) + 'i',
+                                     fdData))
+    if(len(data) < 4):
+        raise ValueError('short handoff message')
+
+    msgLen = struct.unpack('<I', data[0:4])[0]
+    data = data[4:]
+    while(len(data) < msgLen):
+        chunk = conn.recv(msgLen - len(data))
+        if(len(chunk) == 0):
+            raise ValueError('handoff connection closed')
+        data += chunk
+    return (data, fds)
+
+def listen_for_handoff():
+    # Listen on handoffSocketFileName for a new copy of this script started
+    # with 'takeover'. See check_handoff().
+    global handoffSocketFileName, handoffListener
+
+    try:
+        os.unlink(handoffSocketFileName)
+    except FileNotFoundError:
+        pass
+
+    handoffListener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    handoffListener.bind(handoffSocketFileName)
+    os.chmod(handoffSocketFileName, 0o600)
+    handoffListener.listen(1)
+    handoffListener.setblocking(False)
+
+def check_handoff():
+    # Called at the top of the main loop, between messages on the RS485 bus,
+    # to see if a new copy of this script wants to take over from us.
+    #
+    # We send it our RS485 port and a fleet snapshot that includes when we last
+    # sent a heartbeat, so it can send the next one on schedule. The snapshot
+    # also carries our rollups so neither of us has to write them out while
+    # the bus is waiting on the handoff. Once it has them, we stop using the
+    # port, close the files it's about to open, and tell it to go ahead.
+    # Returns True if we handed off and should exit.
+    global debugLevel, handoffListener, handoffTimeoutSecs, handoffDone, \
+           ser, timeLastTx, numInitMsgsToSend, counterJournal, sampleStore, \
+           rollups
+
+    try:
+        (conn, addr) = handoffListener.accept()
+    except (BlockingIOError, InterruptedError):
+        return False
+
+    try:
+        conn.setblocking(True)
+        conn.settimeout(handoffTimeoutSecs)
+
+        snapshot = fleet_snapshot()
+        snapshot['timeLastTx'] = timeLastTx
+        snapshot['linkReady'] = (numInitMsgsToSend == 0)
+        snapshot['rollups'] = rollups.snapshot()
+        send_handoff_msg(conn, json.dumps(snapshot).encode('utf-8'), [ser.fileno()])
+
+        (data, fds) = recv_handoff_msg(conn)
+        if(data != b'took over'):
+            raise ValueError('unexpected handoff reply ' + str(data))
+
+        # From here on, the new process owns the RS485 port.
+        handoffDone = True
+        print(time_now() + ": Handed RS485 port and %d slaves to a new process." % \
+              (len(snapshot['slaves'])))
+
+        counterJournal.close()
+        if(sampleStore != None):
+            sampleStore.close()
+
+        send_handoff_msg(conn, b'files closed')
+    except (OSError, ValueError) as e:
+        if(handoffDone):
+            print(time_now() + ": ERROR: Handoff failed after the new process took over: " + str(e))
+        else:
+            print(time_now() + ": WARNING: Handoff to new process failed: " + str(e))
+    finally:
+        conn.close()
+
+    return handoffDone
+
+def take_over_serial_port():
+    # Run when this script is started as:
+    #   simpleTWCcontrol.py takeover
+    # to replace a copy of this script that's already running without a gap in
+    # heartbeats long enough for slaves to notice. We connect to its
+    # handoffSocketFileName, receive its RS485 port, fleet snapshot, and
+    # rollups, and wait for it to close the counter journal and sample store so
+    # we can open them.
+    #
+    # The running process stops talking on the bus from the moment we connect
+    # until we've opened those files, so call this only after everything else
+    # is started, except what would replace the running process's control
+    # socket or status snapshot.
+    #
+    # Returns (port, snapshot), or (None, None) if there was nothing to take
+    # over.
+    global debugLevel, handoffSocketFileName, handoffTimeoutSecs
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(handoffTimeoutSecs)
+    try:
+        conn.connect(handoffSocketFileName)
+    except OSError as e:
+        print(time_now() + ": Can't take over from a running TWCManager: " + str(e)
+              + ".  Starting normally.")
+        conn.close()
+        return (None, None)
+
+    port = None
+    tookOver = False
+    try:
+        (data, fds) = recv_handoff_msg(conn)
+        if(len(fds) != 1):
+            for fd in fds:
+                os.close(fd)
+            raise ValueError('expected 1 file descriptor, got ' + str(len(fds)))
+        port = HandoffSerial(fds[0])
+        snapshot = json.loads(data.decode('utf-8'))
+
+        send_handoff_msg(conn, b'took over')
+        tookOver = True
+
+        # Don't give up on the old process closing its files too soon. If we
+        # did, we'd have no way to hand the port back.
+        conn.settimeout(handoffTimeoutSecs * 6)
+        (data, fds) = recv_handoff_msg(conn)
+        if(data != b'files closed'):
+            print(time_now() + ": WARNING: Unexpected handoff message " + str(data))
+    except (OSError, ValueError) as e:
+        if(not tookOver):
+            # The running process still owns the RS485 port, so we can't use it.
+            print(time_now() + ": ERROR: Can't take over from the running TWCManager: "
+                  + str(e))
+            if(port != None):
+                port.close()
+            sys.exit(1)
+        print(time_now() + ": WARNING: " + str(e) + " while waiting for the old "
+              "process to close its files.")
+    finally:
+        conn.close()
+
+    print(time_now() + ": Took over RS485 port and %d slaves." % (len(snapshot['slaves'])))
+    return (port, snapshot)
+
+def toggle_profiler(signum, frame):
+    # SIGUSR2 handler. See SamplingProfiler.
+    global profiler, profilerSecs, profilerIntervalSecs
+
+    if(profiler.running()):
+        profiler.stop()
+    else:
+        profiler.start(profilerSecs, profilerIntervalSecs)
+
+def request_exit(signum, frame):
+    # SIGTERM handler.
+    global exitRequested
+
+    exitRequested = True
+
+def serve_metrics():
+    # Runs in its own thread to serve Metrics on metricsPort. Keep trying if
+    # the port is in use, like by the process we took over from, which will
+    # exit soon.
+    global metricsAddress, metricsPort
+
+    while True:
+        try:
+            server = http.server.HTTPServer((metricsAddress, metricsPort),
+                                            MetricsHTTPHandler)
+            break
+        except OSError as e:
+            if(debugLevel >= 1):
+                print(time_now() + ": Can't serve metrics on port " + str(metricsPort)
+                      + " yet: " + str(e))
+            time.sleep(30)
+    server.serve_forever()
+
 def total_amps_actual_all_twcs():
     global debugLevel, slaveTWCRoundRobin, wiringMaxAmpsAllTWCs
 
@@ -660,10 +1116,161 @@ def total_amps_actual_all_twcs():
     return totalAmps
 
 
-def car_api_available(email = None, password = None, charge = None):
+def car_api_endpoint(endpoint):
+    # Return the [TokenBucket, CircuitBreaker] pair that limits requests to
+    # endpoint, creating it the first time we use endpoint.
+    global carApiEndpoints, carApiEndpointRateLimits, \
+           carApiEndpointFailureThreshold, carApiErrorRetryMins
+
+    try:
+        return carApiEndpoints[endpoint]
+    except KeyError:
+        pass
+
+    if(endpoint in carApiEndpointRateLimits):
+        (capacity, perMinute) = carApiEndpointRateLimits[endpoint]
+    else:
+        (capacity, perMinute) = carApiEndpointRateLimits['default']
+
+    carApiEndpoints[endpoint] = [TokenBucket(capacity, perMinute),
+                                 CircuitBreaker(endpoint,
+                                     carApiEndpointFailureThreshold,
+                                     carApiErrorRetryMins*60)]
+    return carApiEndpoints[endpoint]
+
+def car_api_call(cmd, endpoint, vehicle = None):
+    # Run car API curl command cmd and return its decoded JSON response, or {}
+    # if the response wasn't JSON.
+    #
+    # Returns None without sending the request if the circuit breaker for
+    # endpoint or vehicle is open, or if sending it would exceed the rate limit
+    # for all requests, for endpoint, or for vehicle. That way one car or
+    # endpoint that keeps failing doesn't stop us controlling the others.
+    #
+    # The caller must report how the request went using car_api_result().
+    global carApiTotalBucket, metrics
+
+    (endpointBucket, endpointBreaker) = car_api_endpoint(endpoint)
+    buckets = [carApiTotalBucket, endpointBucket]
+    breakers = [endpointBreaker]
+    if(vehicle != None):
+        buckets.append(vehicle.bucket)
+        breakers.append(vehicle.breaker)
+
+    for breaker in breakers:
+        if(breaker.secs_till_closed() > 0):
+            if(debugLevel >= 8):
+                print(time_now() + ': Car API ' + endpoint + ' request not sent because breaker for '
+                      + breaker.name + ' is ' + breaker.state + ' for '
+                      + str(int(breaker.secs_till_closed())) + ' more seconds.')
+            metrics.inc('car_api_blocked_total', {'endpoint': endpoint, 'reason': 'breaker'})
+            return None
+
+    for bucket in buckets:
+        if(not bucket.has_token()):
+            if(debugLevel >= 8):
+                print(time_now() + ': Car API ' + endpoint + ' request rate limited for '
+                      + str(int(bucket.secs_till_token())) + ' more seconds.')
+            metrics.inc('car_api_blocked_total', {'endpoint': endpoint, 'reason': 'rate'})
+            return None
+
+    for breaker in breakers:
+        breaker.allow()
+    for bucket in buckets:
+        bucket.take()
+
+    timeStart = time.time()
+    output = run_process(cmd)
+    metrics.observe('car_api_request_seconds', time.time() - timeStart,
+                    {'endpoint': endpoint})
+    try:
+        return json.loads(output.decode('ascii'))
+    except json.decoder.JSONDecodeError:
+        return {}
+
+def car_api_wait_secs(endpoint, vehicle = None):
+    # Return seconds till car_api_call() might send a request to endpoint.
+    global carApiTotalBucket
+
+    (endpointBucket, endpointBreaker) = car_api_endpoint(endpoint)
+    waitSecs = max(carApiTotalBucket.secs_till_token(),
+                   endpointBucket.secs_till_token(),
+                   endpointBreaker.secs_till_closed())
+    if(vehicle != None):
+        waitSecs = max(waitSecs, vehicle.bucket.secs_till_token(),
+                       vehicle.breaker.secs_till_closed())
+    return waitSecs
+
+def car_api_result(endpoint, vehicle, success, openSecs = None,
+                   apiResponseDict = None):
+    # Tell the circuit breakers for endpoint and vehicle whether a request sent
+    # by car_api_call() succeeded.
+    #
+    # A failed request opens vehicle's breaker right away, for openSecs if
+    # given or carApiErrorRetryMins otherwise. It only counts against the
+    # endpoint's breaker if apiResponseDict, the reply car_api_call() returned,
+    # shows the endpoint failed rather than the car. See
+    # car_api_endpoint_error(). The endpoint's breaker opens after
+    # carApiEndpointFailureThreshold of those in a row, so a single flaky car
+    # doesn't block requests to other cars.
+    global metrics
+
+    endpointBreaker = car_api_endpoint(endpoint)[1]
+    if(not success):
+        metrics.inc('car_api_errors_total', {'endpoint': endpoint})
+    if(success):
+        endpointBreaker.success()
+        if(vehicle != None):
+            vehicle.breaker.success()
+    elif(vehicle != None):
+        if(car_api_endpoint_error(apiResponseDict)):
+            endpointBreaker.failure()
+        vehicle.breaker.failure(openSecs)
+    else:
+        endpointBreaker.failure(openSecs)
+
+def car_api_endpoint_error(apiResponseDict):
+    # Return True if apiResponseDict, a reply from car_api_call(), means the
+    # endpoint failed: curl timed out or got an empty or non-JSON reply, or
+    # the server returned an error that isn't in carApiVehicleErrors. Replies
+    # where the car itself refused, like 'could_not_wake_buses', return False.
+    global carApiVehicleErrors
+
+    if(apiResponseDict == None):
+        return False
+    if(type(apiResponseDict) != dict or len(apiResponseDict) == 0):
+        return True
+
+    error = str(apiResponseDict.get('error', ''))
+    if(error == ''):
+        return False
+    for vehicleError in carApiVehicleErrors:
+        if(vehicleError == error[0:len(vehicleError)]):
+            return False
+
+    return True
+
+def car_api_transient_error(apiResponseDict):
+    # Return True if apiResponseDict contains an error listed in
+    # carApiTransientErrors.
+    global carApiTransientErrors
+
+    if(type(apiResponseDict) != dict or 'error' not in apiResponseDict):
+        return False
+
+    error = str(apiResponseDict['error'])
+    for knownError in carApiTransientErrors:
+        if(knownError == error[0:len(knownError)]):
+            return True
+
+    return False
+
+def car_api_available(email = None, password = None, charge = None, TWCID = None):
+    # When TWCID is given, only wake the car we've matched to that TWC. See
+    # vehicles_for_twc().
     global debugLevel, carApiLastErrorTime, carApiErrorRetryMins, \
            carApiTransientErrors, carApiBearerToken, carApiRefreshToken, \
-           carApiTokenExpireTime, carApiVehicles
+           carApiTokenExpireTime, carApiVehicles, carApiStreaming
 
     now = time.time()
     apiResponseDict = {}
@@ -689,7 +1296,6 @@ def car_api_available(email = None, password = None, charge = None):
     # Tesla car API info comes from https://timdorr.docs.apiary.io/
     if(carApiBearerToken == '' or carApiTokenExpireTime - now < 30*24*60*60):
         cmd = None
-        apiResponse = b''
 
         # If we don't have a bearer token or our refresh token will expire in
         # under 30 days, get a new bearer token.  Refresh tokens expire in 45
@@ -714,23 +1320,23 @@ def car_api_available(email = None, password = None, charge = None):
                 # Hide car password in output
                 cmdRedacted = re.sub(r'("password": )"[^"]+"', r'\1[HIDDEN]', cmd)
                 print(time_now() + ': Car API cmd', cmdRedacted)
-            apiResponse = run_process(cmd)
+            apiResponseDict = car_api_call(cmd, 'oauth/token')
+            if(apiResponseDict == None):
+                return False
             # Example response:
             # b'{"access_token":"4720d5f980c9969b0ca77ab39399b9103adb63ee832014fe299684201929380","token_type":"bearer","expires_in":3888000,"refresh_token":"110dd4455437ed351649391a3425b411755a213aa815171a2c6bfea8cc1253ae","created_at":1525232970}'
 
-        try:
-            apiResponseDict = json.loads(apiResponse.decode('ascii'))
-        except json.decoder.JSONDecodeError:
-            pass
-
         try:
             if(debugLevel >= 4):
                 print(time_now() + ': Car API auth response', apiResponseDict, '\n')
             carApiBearerToken = apiResponseDict['access_token']
             carApiRefreshToken = apiResponseDict['refresh_token']
             carApiTokenExpireTime = now + apiResponseDict['expires_in']
-        except KeyError:
+            car_api_result('oauth/token', None, True)
+        except (KeyError, TypeError):
             print(time_now() + ": ERROR: Can't access Tesla car via API.  Please log in again via web interface.")
+            # Bad credentials affect every car and endpoint, so this is the one
+            # error that stops all car API use for carApiErrorRetryMins.
             carApiLastErrorTime = now
             # Instead of just setting carApiLastErrorTime, erase tokens to
             # prevent further authorization attempts until user enters password
@@ -749,225 +1355,55 @@ def car_api_available(email = None, password = None, charge = None):
                   '" "https://owner-api.teslamotors.com/api/1/vehicles"'
             if(debugLevel >= 8):
                 print(time_now() + ': Car API cmd', cmd)
-            try:
-                apiResponseDict = json.loads(run_process(cmd).decode('ascii'))
-            except json.decoder.JSONDecodeError:
-                pass
+            apiResponseDict = car_api_call(cmd, 'vehicles')
+            if(apiResponseDict == None):
+                return False
 
             try:
                 if(debugLevel >= 4):
                     print(time_now() + ': Car API vehicle list', apiResponseDict, '\n')
 
-                for i in range(0, apiResponseDict['count']):
-                    carApiVehicles.append(CarApiVehicle(apiResponseDict['response'][i]['id']))
+                vehicles = []
+                for i in range(0, min(apiResponseDict['count'], carApiMaxVehicles)):
+                    vehicles.append(CarApiVehicle(apiResponseDict['response'][i]['id'],
+                                    apiResponseDict['response'][i].get('vehicle_id')))
+                carApiVehicles.extend(vehicles)
+                car_api_result('vehicles', None, True)
+
+                if(carApiStreaming):
+                    for vehicle in vehicles:
+                        vehicle.stream = CarApiStream(vehicle)
+                        vehicle.stream.start()
             except (KeyError, TypeError):
                 # This catches cases like trying to access
                 # apiResponseDict['response'] when 'response' doesn't exist in
                 # apiResponseDict.
                 print(time_now() + ": ERROR: Can't get list of vehicles via Tesla car API.  Will try again in "
                       + str(carApiErrorRetryMins) + " minutes.")
-                carApiLastErrorTime = now
+                car_api_result('vehicles', None, False, carApiErrorRetryMins*60)
                 return False
 
         if(len(carApiVehicles) > 0):
             # Wake cars if needed
-            needSleep = False
-            for vehicle in carApiVehicles:
+            for vehicle in vehicles_for_twc(TWCID):
                 if(charge == True and vehicle.stopAskingToStartCharging):
                     if(debugLevel >= 8):
                         print(time_now() + ": Don't charge vehicle " + str(vehicle.ID)
                               + " because vehicle.stopAskingToStartCharging == True")
                     continue
 
-                if(now - vehicle.lastErrorTime < carApiErrorRetryMins*60):
-                    # It's been under carApiErrorRetryMins minutes since the car
-                    # API generated an error on this vehicle. Don't send it more
-                    # commands yet.
+                if(vehicle.breaker.secs_till_closed() > 0):
+                    # The car API generated an error on this vehicle recently.
+                    # Don't send it more commands till its breaker lets us.
                     if(debugLevel >= 8):
                         print(time_now() + ": Don't send commands to vehicle " + str(vehicle.ID)
-                              + " because it returned an error in the last "
-                              + str(carApiErrorRetryMins) + " minutes.")
-                    continue
-
-                if(vehicle.ready()):
+                              + " because its breaker is open for another "
+                              + str(int(vehicle.breaker.secs_till_closed())) + " seconds.")
                     continue
 
-                if(now - vehicle.lastWakeAttemptTime <= vehicle.delayNextWakeAttempt):
-                    if(debugLevel >= 10):
-                        print(time_now() + ": car_api_available returning False because we are still delaying "
-                              + str(delayNextWakeAttempt) + " seconds after the last failed wake attempt.")
-                    return False
-
-                # It's been delayNextWakeAttempt seconds since we last failed to
-                # wake the car, or it's never been woken. Wake it.
-                vehicle.lastWakeAttemptTime = now
-                cmd = 'curl -s -m 60 -X POST -H "accept: application/json" -H "Authorization:Bearer ' + \
-                      carApiBearerToken + \
-                      '" "https://owner-api.teslamotors.com/api/1/vehicles/' + \
-                      str(vehicle.ID) + '/wake_up"'
-                if(debugLevel >= 8):
-                    print(time_now() + ': Car API cmd', cmd)
-
-                try:
-                    apiResponseDict = json.loads(run_process(cmd).decode('ascii'))
-                except json.decoder.JSONDecodeError:
-                    pass
-
-                state = 'error'
-                try:
-                    if(debugLevel >= 4):
-                        print(time_now() + ': Car API wake car response', apiResponseDict, '\n')
-
-                    state = apiResponseDict['response']['state']
-
-                except (KeyError, TypeError):
-                    # This catches unexpected cases like trying to access
-                    # apiResponseDict['response'] when 'response' doesn't exist
-                    # in apiResponseDict.
-                    state = 'error'
-
-                if(state == 'online'):
-                    # With max power saving settings, car will almost always
-                    # report 'asleep' or 'offline' the first time it's sent
-                    # wake_up.  Rarely, it returns 'online' on the first wake_up
-                    # even when the car has not been contacted in a long while.
-                    # I suspect that happens when we happen to query the car
-                    # when it periodically awakens for some reason.
-                    vehicle.firstWakeAttemptTime = 0
-                    vehicle.delayNextWakeAttempt = 0
-                    # Don't alter vehicle.lastWakeAttemptTime because
-                    # vehicle.ready() uses it to return True if the last wake
-                    # was under 2 mins ago.
-                    needSleep = True
-                else:
-                    if(vehicle.firstWakeAttemptTime == 0):
-                        vehicle.firstWakeAttemptTime = now
-
-                    if(state == 'asleep' or state == 'waking'):
-                        if(now - vehicle.firstWakeAttemptTime <= 10*60):
-                            # http://visibletesla.com has a 'force wakeup' mode
-                            # that sends wake_up messages once every 5 seconds
-                            # 15 times. This generally manages to wake my car if
-                            # it's returning 'asleep' state, but I don't think
-                            # there is any reason for 5 seconds and 15 attempts.
-                            # The car did wake in two tests with that timing,
-                            # but on the third test, it had not entered online
-                            # mode by the 15th wake_up and took another 10+
-                            # seconds to come online. In general, I hear relays
-                            # in the car clicking a few seconds after the first
-                            # wake_up but the car does not enter 'waking' or
-                            # 'online' state for a random period of time. I've
-                            # seen it take over one minute, 20 sec.
-                            #
-                            # I interpret this to mean a car in 'asleep' mode is
-                            # still receiving car API messages and will start
-                            # to wake after the first wake_up, but it may take
-                            # awhile to finish waking up. Therefore, we try
-                            # waking every 30 seconds for the first 10 mins.
-                            vehicle.delayNextWakeAttempt = 30;
-                        elif(now - vehicle.firstWakeAttemptTime <= 70*60):
-                            # Cars in 'asleep' state should wake within a
-                            # couple minutes in my experience, so we should
-                            # never reach this point. If we do, try every 5
-                            # minutes for the next hour.
-                            vehicle.delayNextWakeAttempt = 5*60;
-                        else:
-                            # Car hasn't woken for an hour and 10 mins. Try
-                            # again in 15 minutes. We'll show an error about
-                            # reaching this point later.
-                            vehicle.delayNextWakeAttempt = 15*60;
-                    elif(state == 'offline'):
-                        if(now - vehicle.firstWakeAttemptTime <= 31*60):
-                            # A car in offline state is presumably not connected
-                            # wirelessly so our wake_up command will not reach
-                            # it. Instead, the car wakes itself every 20-30
-                            # minutes and waits some period of time for a
-                            # message, then goes back to sleep. I'm not sure
-                            # what the period of time is, so I tried sending
-                            # wake_up every 55 seconds for 16 minutes but the
-                            # car failed to wake.
-                            # Next I tried once every 25 seconds for 31 mins.
-                            # This worked after 19.5 and 19.75 minutes in 2
-                            # tests but I can't be sure the car stays awake for
-                            # 30secs or if I just happened to send a command
-                            # during a shorter period of wakefulness.
-                            vehicle.delayNextWakeAttempt = 25;
-
-                            # I've run tests sending wake_up every 10-30 mins to
-                            # a car in offline state and it will go hours
-                            # without waking unless you're lucky enough to hit
-                            # it in the brief time it's waiting for wireless
-                            # commands. I assume cars only enter offline state
-                            # when set to max power saving mode, and even then,
-                            # they don't always enter the state even after 8
-                            # hours of no API contact or other interaction. I've
-                            # seen it remain in 'asleep' state when contacted
-                            # after 16.5 hours, but I also think I've seen it in
-                            # offline state after less than 16 hours, so I'm not
-                            # sure what the rules are or if maybe Tesla contacts
-                            # the car periodically which resets the offline
-                            # countdown.
-                            #
-                            # I've also seen it enter 'offline' state a few
-                            # minutes after finishing charging, then go 'online'
-                            # on the third retry every 55 seconds.  I suspect
-                            # that might be a case of the car briefly losing
-                            # wireless connection rather than actually going
-                            # into a deep sleep.
-                            # 'offline' may happen almost immediately if you
-                            # don't have the charger plugged in.
-                    else:
-                        # Handle 'error' state.
-                        if(now - vehicle.firstWakeAttemptTime <= 60*60):
-                            # We've tried to wake the car for less than an
-                            # hour.
-                            foundKnownError = False
-                            if('error' in apiResponseDict):
-                                error = apiResponseDict['error']
-                                for knownError in carApiTransientErrors:
-                                    if(knownError == error[0:len(knownError)]):
-                                        foundKnownError = True
-                                        break
-
-                            if(foundKnownError):
-                                # I see these errors often enough that I think
-                                # it's worth re-trying in 1 minute rather than
-                                # waiting 5 minutes for retry in the standard
-                                # error handler.
-                                vehicle.delayNextWakeAttempt = 60;
-                            else:
-                                # We're in an unexpected state. This could be caused
-                                # by the API servers being down, car being out of
-                                # range, or by something I can't anticipate. Try
-                                # waking the car every 5 mins.
-                                vehicle.delayNextWakeAttempt = 5*60;
-                        else:
-                            # Car hasn't woken for over an hour. Try again
-                            # in 15 minutes. We'll show an error about this
-                            # later.
-                            vehicle.delayNextWakeAttempt = 15*60;
-
-                    if(debugLevel >= 1):
-                        if(state == 'error'):
-                            print(time_now() + ": Car API wake car failed with unknown response.  " \
-                                "Will try again in "
-                                + str(vehicle.delayNextWakeAttempt) + " seconds.")
-                        else:
-                            print(time_now() + ": Car API wake car failed.  State remains: '"
-                                + state + "'.  Will try again in "
-                                + str(vehicle.delayNextWakeAttempt) + " seconds.")
-
-                if(vehicle.firstWakeAttemptTime > 0
-                   and now - vehicle.firstWakeAttemptTime > 60*60):
-                    # It should never take over an hour to wake a car.  If it
-                    # does, ask user to report an error.
-                    print(time_now() + ": ERROR: We have failed to wake a car from '"
-                        + state + "' state for %.1f hours.\n" \
-                          "Please private message user CDragon at " \
-                          "http://teslamotorsclub.com with a copy of this error. " \
-                          "Also include this: %s" % (
-                          ((now - vehicle.firstWakeAttemptTime) / 60 / 60),
-                          str(apiResponseDict)))
+                # request_wake() does nothing if the car is already online or
+                # we're waiting for the timer that sends its next wake_up.
+                vehicle.request_wake(charge, TWCID)
 
     if(now - carApiLastErrorTime < carApiErrorRetryMins*60 or carApiBearerToken == ''):
         if(debugLevel >= 8):
@@ -983,67 +1419,90 @@ def car_api_available(email = None, password = None, charge = None):
         # for commands.
         print(time_now() + ": car_api_available returning True")
 
-    if(needSleep):
-        # If you send charge_start/stop less than 1 second after calling
-        # update_location(), the charge command usually returns:
-        #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
-        # I'm not sure if the same problem exists when sending commands too
-        # quickly after we send wake_up.  I haven't seen a problem sending a
-        # command immediately, but it seems safest to sleep 5 seconds after
-        # waking before sending a command.
-        time.sleep(5);
-
     return True
 
-def car_api_charge(charge):
+def car_api_charge(charge, TWCID = None, vehicleIDs = None, attempt = 0):
     # Do not call this function directly.  Call by using background thread:
-    # queue_background_task({'cmd':'charge', 'charge':<True/False>})
+    # queue_background_task({'cmd':'charge', 'charge':<True/False>,
+    #                        'TWCID':<TWCID of slave or None>})
+    # If we've matched a car to TWCID, only that car is started or stopped.
+    # Otherwise, all cars are.
+    #
+    # Instead of sleeping when a car asks us to try again in a few seconds, we
+    # queue a retry task for just those cars. Retries have attempt > 0 and
+    # vehicleIDs set to the cars to retry.
     global debugLevel, carApiLastErrorTime, carApiErrorRetryMins, \
-           carApiTransientErrors, carApiVehicles, carApiLastStartOrStopChargeTime, \
-           homeLat, homeLon, onlyChargeMultiCarsAtHome
+           carApiTransientErrors, carApiVehicles, \
+           homeLat, homeLon, onlyChargeMultiCarsAtHome, carApiBusesRetrySecs, \
+           carApiChargeRetries
 
     now = time.time()
     apiResponseDict = {}
-    if(not charge):
+    if(not charge and attempt == 0):
         # Whenever we are going to tell vehicles to stop charging, set
-        # vehicle.stopAskingToStartCharging = False on all vehicles.
-        for vehicle in carApiVehicles:
+        # vehicle.stopAskingToStartCharging = False on those vehicles.
+        for vehicle in vehicles_for_twc(TWCID):
             vehicle.stopAskingToStartCharging = False
 
-    if(now - carApiLastStartOrStopChargeTime < 60):
-        # Don't start or stop more often than once a minute
-        if(debugLevel >= 8):
-            print(time_now() + ': car_api_charge return because under 60 sec since last carApiLastStartOrStopChargeTime')
-        return 'error'
+    if(attempt == 0):
+        # Don't start or stop the same car more often than once a minute.
+        vehicles = vehicles_for_twc(TWCID)
+        if(len(vehicles) > 0 and all(now - vehicle.lastStartOrStopChargeTime < 60
+                                     for vehicle in vehicles)):
+            if(debugLevel >= 8):
+                print(time_now() + ': car_api_charge return because under 60 sec since last vehicle.lastStartOrStopChargeTime')
+            return 'error'
 
-    if(car_api_available(charge = charge) == False):
-        if(debugLevel >= 8):
-            print(time_now() + ': car_api_charge return because car_api_available() == False')
-        return 'error'
+        if(car_api_available(charge = charge, TWCID = TWCID) == False):
+            if(debugLevel >= 8):
+                print(time_now() + ': car_api_charge return because car_api_available() == False')
+            return 'error'
 
     startOrStop = 'start' if charge else 'stop'
     result = 'success'
+    retryVehicleIDs = []
+    sentCommand = False
+
+    matchedVehicle = matched_vehicle(TWCID)
+
+    for vehicle in vehicles_for_twc(TWCID):
+        if(vehicleIDs != None and vehicle.ID not in vehicleIDs):
+            continue
 
-    for vehicle in carApiVehicles:
         if(charge and vehicle.stopAskingToStartCharging):
             if(debugLevel >= 8):
                 print(time_now() + ": Don't charge vehicle " + str(vehicle.ID)
                       + " because vehicle.stopAskingToStartCharging == True")
             continue
 
-        if(vehicle.ready() == False):
+        if(attempt == 0 and now - vehicle.lastStartOrStopChargeTime < 60):
             continue
 
-        # Only update carApiLastStartOrStopChargeTime if car_api_available() managed
-        # to wake cars.  Setting this prevents any command below from being sent
-        # more than once per minute.
-        carApiLastStartOrStopChargeTime = now
+        if(vehicle.ready() == False):
+            continue
 
-        if(onlyChargeMultiCarsAtHome and len(carApiVehicles) > 1):
+        # Only update vehicle.lastStartOrStopChargeTime if car_api_available()
+        # managed to wake the car.  Setting this prevents any command below
+        # from being sent to it more than once per minute.
+        vehicle.lastStartOrStopChargeTime = now
+        sentCommand = True
+
+        if(TWCID != None and matchedVehicle == None and len(carApiVehicles) > 1):
+            # We don't know which car is plugged in to this TWC yet. While
+            # the car is awake anyway, sample its charge state so we can learn
+            # which one it is and leave the others alone next time.
+            if(vehicle.update_charge_state()):
+                correlate_vehicle(vehicle)
+
+        if(onlyChargeMultiCarsAtHome and len(carApiVehicles) > 1
+           and matchedVehicle == None
+        ):
             # When multiple cars are enrolled in the car API, only start/stop
-            # charging cars parked at home.
-
+            # charging cars parked at home. A car we've matched to one of our
+            # TWCs must be plugged in at home, so skip the location check.
             if(vehicle.update_location() == False):
+                if(vehicle.retry_soon()):
+                    retryVehicleIDs.append(vehicle.ID)
                 result = 'error'
                 continue
 
@@ -1084,22 +1543,30 @@ def car_api_charge(charge):
             #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
             # Waiting 2 seconds seems to consistently avoid the error, but let's
             # wait 5 seconds in case of hardware differences between cars.
-            time.sleep(5)
+            # Send the command from a retry task rather than sleeping here.
+            # update_location() will reuse the location it just got.
+            if(time.time() - vehicle.timeLocationPolled < carApiBusesRetrySecs):
+                retryVehicleIDs.append(vehicle.ID)
+                continue
 
+        endpoint = 'command/charge_' + startOrStop
         cmd = 'curl -s -m 60 -X POST -H "accept: application/json" -H "Authorization:Bearer ' + \
               carApiBearerToken + \
               '" "https://owner-api.teslamotors.com/api/1/vehicles/' + \
-            str(vehicle.ID) + '/command/charge_' + startOrStop + '"'
+            str(vehicle.ID) + '/' + endpoint + '"'
 
-        # Retry up to 3 times on certain errors.
-        for retryCount in range(0, 3):
+        # Errors that clear up in a few seconds are retried by the retry task
+        # queued at the end of this function, so every path through this loop
+        # ends in break.
+        while True:
             if(debugLevel >= 8):
                 print(time_now() + ': Car API cmd', cmd)
 
-            try:
-                apiResponseDict = json.loads(run_process(cmd).decode('ascii'))
-            except json.decoder.JSONDecodeError:
-                pass
+            apiResponseDict = car_api_call(cmd, endpoint, vehicle)
+            if(apiResponseDict == None):
+                # Rate limited or breaker is open. We'll be asked again.
+                result = 'error'
+                break
 
             try:
                 if(debugLevel >= 4):
@@ -1126,32 +1593,31 @@ def car_api_charge(charge):
                 # Start or stop charging success:
                 #   {'response': {'result': True, 'reason': ''}}
                 if(apiResponseDict['response'] == None):
-                    if('error' in apiResponseDict):
-                        foundKnownError = False
-                        error = apiResponseDict['error']
-                        for knownError in carApiTransientErrors:
-                            if(knownError == error[0:len(knownError)]):
-                                # I see these errors often enough that I think
-                                # it's worth re-trying in 1 minute rather than
-                                # waiting carApiErrorRetryMins minutes for retry
-                                # in the standard error handler.
-                                if(debugLevel >= 1):
-                                    print(time_now() + ": Car API returned '"
-                                          + error
-                                          + "' when trying to start charging.  Try again in 1 minute.")
-                                time.sleep(60)
-                                foundKnownError = True
-                                break
-                        if(foundKnownError):
-                            continue
+                    result = 'error'
+                    if(car_api_transient_error(apiResponseDict)):
+                        # I see these errors often enough that I think it's
+                        # worth re-trying in 1 minute rather than waiting
+                        # carApiErrorRetryMins minutes for retry in the
+                        # standard error handler. Rather than sleeping here
+                        # and holding up every other background task, open
+                        # this vehicle's breaker for carApiTransientRetrySecs.
+                        if(debugLevel >= 1):
+                            print(time_now() + ": Car API returned '"
+                                  + str(apiResponseDict['error'])
+                                  + "' when trying to " + startOrStop + " charging.  Try again in "
+                                  + str(carApiTransientRetrySecs) + " seconds.")
+                        car_api_result(endpoint, vehicle, False, carApiTransientRetrySecs,
+                                       apiResponseDict = apiResponseDict)
+                        break
 
                     # This generally indicates a significant error like 'vehicle
                     # unavailable', but it's not something I think the caller can do
                     # anything about, so return generic 'error'.
-                    result = 'error'
                     # Don't send another command to this vehicle for
                     # carApiErrorRetryMins mins.
-                    vehicle.lastErrorTime = now
+                    car_api_result(endpoint, vehicle, False,
+                                   apiResponseDict = apiResponseDict)
+                    break
                 elif(apiResponseDict['response']['result'] == False):
                     if(charge):
                         reason = apiResponseDict['response']['reason']
@@ -1180,12 +1646,15 @@ def car_api_charge(charge):
                                 # like drive_state. Even if you delay 5 seconds
                                 # between the commands, this error still comes
                                 # up occasionally. Retrying often succeeds, so
-                                # wait 5 secs and retry.
+                                # retry in 5 secs.
                                 # If all retries fail, we'll try again in a
                                 # minute because we set
-                                # carApiLastStartOrStopChargeTime = now earlier.
-                                time.sleep(5)
-                                continue
+                                # vehicle.lastStartOrStopChargeTime = now earlier.
+                                result = 'error'
+                                car_api_result(endpoint, vehicle, False, carApiBusesRetrySecs,
+                                               apiResponseDict = apiResponseDict)
+                                retryVehicleIDs.append(vehicle.ID)
+                                break
                             else:
                                 # Start or stop charge failed with an error I
                                 # haven't seen before, so wait
@@ -1195,135 +1664,4355 @@ def car_api_charge(charge):
                                       "\nIf this error persists, please private message user CDragon at http://teslamotorsclub.com " \
                                       "with a copy of this error.")
                                 result = 'error'
-                                vehicle.lastErrorTime = now
+                                car_api_result(endpoint, vehicle, False,
+                                               apiResponseDict = apiResponseDict)
+                                break
+
+                # The car answered our command, even if it didn't do what we
+                # asked because it's done charging.
+                car_api_result(endpoint, vehicle, True)
+            except (KeyError, TypeError):
+                # This catches cases like trying to access
+                # apiResponseDict['response'] when 'response' doesn't exist in
+                # apiResponseDict.
+                print(time_now() + ': ERROR: Failed to ' + startOrStop
+                      + ' car charging via Tesla car API.  Will try again later.')
+                result = 'error'
+                car_api_result(endpoint, vehicle, False,
+                               apiResponseDict = apiResponseDict)
+            break
+
+    if(len(retryVehicleIDs) > 0):
+        if(attempt < carApiChargeRetries):
+            retry_background_task({'cmd':'charge', 'charge':charge, 'TWCID':TWCID,
+                                   'vehicleIDs':retryVehicleIDs, 'attempt':attempt},
+                                  carApiBusesRetrySecs)
+        else:
+            result = 'error'
+
+    if(debugLevel >= 1 and (sentCommand or attempt > 0)):
+        print(time_now() + ': Car API ' + startOrStop + ' charge result: ' + result)
+
+    return result
+
+
+def background_task_key(task):
+    # Tasks aimed at a particular TWC, like a charge command for the car plugged
+    # in to it, are only duplicates of tasks for the same TWC. A retry has the
+    # same key as the task it retries, so a newer command for the TWC replaces
+    # it. See queue_background_task().
+    taskKey = task['cmd']
+    if('TWCID' in task and task['TWCID'] != None):
+        taskKey += ':' + hex_str(task['TWCID'])
+    if(task['cmd'] == 'saveSession'):
+        # Every finished session must be saved, even if another session on the
+        # same TWC is still waiting to be.
+        taskKey += ':%.3f' % (task['record']['start'])
+    return taskKey
+
+def background_task_type(task):
+    # Return (priority, deadlineSecs, group) for task. See backgroundTaskTypes.
+    global backgroundTaskTypes
+
+    try:
+        return backgroundTaskTypes[task['cmd']]
+    except KeyError:
+        return backgroundTaskTypes['default']
+
+def background_task_stats(cmd):
+    # Return the stats dict for tasks with cmd, creating it if needed. Must be
+    # called with backgroundTasksCond held.
+    global backgroundTaskStats
+
+    try:
+        return backgroundTaskStats[cmd]
+    except KeyError:
+        backgroundTaskStats[cmd] = {
+            'depth': 0, 'queued': 0, 'run': 0, 'failed': 0, 'retried': 0,
+            'cancelled': 0, 'expired': 0,
+            'waitSecs': 0.0, 'maxWaitSecs': 0.0,
+            'runSecs': 0.0, 'maxRunSecs': 0.0,
+        }
+        return backgroundTaskStats[cmd]
+
+def push_background_task(task):
+    # Add task to backgroundTasksHeap. Must be called with backgroundTasksCond
+    # held.
+    global backgroundTasksHeap, backgroundTasksSeq
+
+    (priority, deadlineSecs, group) = background_task_type(task)
+    now = time.time()
+    task['state'] = 'queued'
+    task['timeQueued'] = now
+    if(deadlineSecs != None):
+        task['deadline'] = now + deadlineSecs
+
+    backgroundTasksSeq += 1
+    heapq.heappush(backgroundTasksHeap, [priority, backgroundTasksSeq, task])
+
+    stats = background_task_stats(task['cmd'])
+    stats['depth'] += 1
+    stats['queued'] += 1
+
+    backgroundTasksCond.notify()
+
+def queue_background_task(task):
+    global backgroundTasksCond, backgroundTasksCmds, backgroundTaskRetries
+
+    backgroundTasksCond.acquire()
+    taskKey = background_task_key(task)
+    if(task['cmd'] == 'charge' and task.get('attempt', 0) == 0):
+        retry = backgroundTaskRetries.get(taskKey)
+        if(retry != None and retry[1]['charge'] != task['charge']):
+            # A retry of the opposite command is waiting on its timer. Don't
+            # let it undo this one when it fires.
+            cancel_timer(retry[0])
+            del backgroundTaskRetries[taskKey]
+    if(taskKey in backgroundTasksCmds):
+        queuedTask = backgroundTasksCmds[taskKey]
+        if(task['cmd'] == 'charge' and queuedTask['state'] == 'queued'
+           and queuedTask['charge'] != task['charge']
+           and task.get('attempt', 0) == 0
+        ):
+            # We changed our mind about charging the car on this TWC before
+            # the last command was sent, so send the new one instead.
+            cancel_background_task(queuedTask)
+        else:
+            # Some tasks, like cmd='charge', will be called once per second
+            # until a charge starts or we determine the car is done charging.
+            # To avoid wasting memory queing up a bunch of these tasks when
+            # we're handling a charge cmd already, don't queue two of the same
+            # task.
+            backgroundTasksCond.release()
+            return
+
+    # Insert taskKey in backgroundTasksCmds to prevent queuing another
+    # task['cmd'] till we've finished handling this one.
+    backgroundTasksCmds[taskKey] = task
+
+    # Queue the task to be handled by a background_tasks_thread.
+    push_background_task(task)
+    backgroundTasksCond.release()
+
+def cancel_background_task(task):
+    # Stop task from running if a worker hasn't started it yet. Returns True if
+    # it was cancelled.
+    global backgroundTasksCond, backgroundTasksCmds
+
+    backgroundTasksCond.acquire()
+    cancelled = False
+    if(task.get('state') == 'queued'):
+        # The heap entry is discarded when a worker comes across it.
+        task['state'] = 'cancelled'
+        taskKey = background_task_key(task)
+        if(backgroundTasksCmds.get(taskKey) is task):
+            del backgroundTasksCmds[taskKey]
+        stats = background_task_stats(task['cmd'])
+        stats['depth'] -= 1
+        stats['cancelled'] += 1
+        backgroundTasksCond.notify_all()
+        cancelled = True
+    backgroundTasksCond.release()
+    return cancelled
+
+def retry_background_task(task, delay):
+    # Queue another attempt at task in delay seconds. Use this instead of
+    # sleeping in a worker, which would hold up other tasks in the same group.
+    global backgroundTasksCond
+
+    retryTask = {}
+    for key in task:
+        if(key not in ('state', 'timeQueued', 'deadline')):
+            retryTask[key] = task[key]
+    retryTask['attempt'] = task.get('attempt', 0) + 1
+
+    backgroundTasksCond.acquire()
+    background_task_stats(task['cmd'])['retried'] += 1
+    # Remember the timer so a newer command for the same TWC can cancel the
+    # retry before it's queued.
+    backgroundTaskRetries[background_task_key(retryTask)] = (
+        schedule_timer(delay, lambda: queue_retry_task(retryTask)), retryTask)
+    backgroundTasksCond.release()
+
+    return retryTask
+
+def queue_retry_task(retryTask):
+    global backgroundTasksCond, backgroundTaskRetries
+
+    backgroundTasksCond.acquire()
+    taskKey = background_task_key(retryTask)
+    if(taskKey in backgroundTaskRetries and backgroundTaskRetries[taskKey][1] is retryTask):
+        del backgroundTaskRetries[taskKey]
+    backgroundTasksCond.release()
+    queue_background_task(retryTask)
+
+
+def schedule_timer(delay, callback):
+    # Call callback() from a background_tasks_thread once delay seconds have
+    # passed. Returns a timer that can be passed to cancel_timer().
+    #
+    # Timer callbacks run as 'timer' tasks, so they never run at the same time
+    # as car API tasks.
+    global backgroundTasksCond, timerHeap, timerSeq
+
+    backgroundTasksCond.acquire()
+    timerSeq += 1
+    timer = [time.time() + delay, timerSeq, callback]
+    heapq.heappush(timerHeap, timer)
+    if(timerHeap[0] is timer):
+        # Workers may be waiting for a later timer or for the next task. Wake
+        # one so it recalculates how long to wait.
+        backgroundTasksCond.notify()
+    backgroundTasksCond.release()
+
+    return timer
+
+def cancel_timer(timer):
+    # A cancelled timer stays in timerHeap till it's due, but does nothing.
+    if(timer != None):
+        timer[2] = None
+
+def next_background_task():
+    # Wait for the highest priority task that's ready to run and whose group
+    # isn't busy with another task, then return it. Must be called with
+    # backgroundTasksCond held.
+    global backgroundTasksCond, backgroundTasksHeap, backgroundTasksCmds, \
+           backgroundTasksBusyGroups, timerHeap
+
+    while True:
+        now = time.time()
+
+        # Turn timers that are due into tasks.
+        waitSecs = None
+        while(len(timerHeap) > 0):
+            timer = timerHeap[0]
+            if(timer[0] > now):
+                waitSecs = timer[0] - now
+                break
+            heapq.heappop(timerHeap)
+            if(timer[2] != None):
+                push_background_task({'cmd':'timer', 'callback':timer[2]})
+
+        # backgroundTasksHeap is small, so looking through it in priority
+        # order is cheap.
+        chosenEntry = None
+        staleEntries = []
+        for entry in sorted(backgroundTasksHeap):
+            task = entry[2]
+            if(task['state'] != 'queued'):
+                staleEntries.append(entry)
+                continue
+
+            if('deadline' in task and now > task['deadline']):
+                # Nobody cares about the result of this task anymore. For
+                # example, we queue another charge task every second that
+                # charging needs to start or stop.
+                if(debugLevel >= 8):
+                    print(time_now() + ': Background task ' + background_task_key(task)
+                          + ' expired after waiting %.1f seconds.' % (now - task['timeQueued']))
+                task['state'] = 'expired'
+                taskKey = background_task_key(task)
+                if(backgroundTasksCmds.get(taskKey) is task):
+                    del backgroundTasksCmds[taskKey]
+                stats = background_task_stats(task['cmd'])
+                stats['depth'] -= 1
+                stats['expired'] += 1
+                staleEntries.append(entry)
+                continue
+
+            taskGroup = background_task_type(task)[2]
+            if(taskGroup != None and taskGroup in backgroundTasksBusyGroups):
+                continue
+
+            chosenEntry = entry
+            break
+
+        if(len(staleEntries) > 0 or chosenEntry != None):
+            for entry in staleEntries:
+                backgroundTasksHeap.remove(entry)
+            if(chosenEntry != None):
+                backgroundTasksHeap.remove(chosenEntry)
+            heapq.heapify(backgroundTasksHeap)
+            backgroundTasksCond.notify_all()
+
+        if(chosenEntry != None):
+            return chosenEntry[2]
+
+        backgroundTasksCond.wait(waitSecs)
+
+def run_background_task(task):
+    global carApiLastErrorTime
+
+    if(task['cmd'] == 'charge'):
+        # car_api_charge does nothing if it's been under 60 secs since it
+        # was last used so we shouldn't have to worry about calling this
+        # too frequently.
+        car_api_charge(task['charge'], task.get('TWCID'),
+                       task.get('vehicleIDs'), task.get('attempt', 0))
+    elif(task['cmd'] == 'correlate'):
+        correlate_ready_vehicles()
+    elif(task['cmd'] == 'carApiEmailPassword'):
+        carApiLastErrorTime = 0
+        car_api_available(task['email'], task['password'])
+    elif(task['cmd'] == 'checkGreenEnergy'):
+        check_green_energy()
+    elif(task['cmd'] == 'timer'):
+        task['callback']()
+    elif(task['cmd'] == 'saveRollups'):
+        rollups.save()
+    elif(task['cmd'] == 'saveSession'):
+        sessionStore.add(task['record'])
+    elif(task['cmd'] == 'saveFleetSnapshot'):
+        # After a handoff, the new process keeps the snapshot up to date.
+        if(not handoffDone):
+            save_fleet_snapshot(task['snapshot'])
+    elif(task['cmd'] == 'memorySample'):
+        memoryMonitor.sample()
+    elif(task['cmd'] == 'memoryTraceStart'):
+        memoryMonitor.trace_start(task['frames'])
+    elif(task['cmd'] == 'memoryTraceDiff'):
+        memoryMonitor.trace_diff(task['limit'])
+    elif(task['cmd'] == 'memoryTraceStop'):
+        memoryMonitor.trace_stop()
+
+def background_tasks_thread():
+    # backgroundTaskWorkers copies of this thread run tasks queued by
+    # queue_background_task() in priority order. A slow task, like a curl
+    # command that takes 60 seconds to time out, only holds up other tasks in
+    # its group.
+    global backgroundTasksCond, backgroundTasksCmds, backgroundTasksBusyGroups, \
+           backgroundTasksRunning
+
+    while True:
+        backgroundTasksCond.acquire()
+        task = next_background_task()
+        group = background_task_type(task)[2]
+        if(group != None):
+            backgroundTasksBusyGroups.add(group)
+        task['state'] = 'running'
+        backgroundTasksRunning += 1
+        timeStarted = time.time()
+        stats = background_task_stats(task['cmd'])
+        stats['depth'] -= 1
+        waitSecs = timeStarted - task['timeQueued']
+        stats['waitSecs'] += waitSecs
+        stats['maxWaitSecs'] = max(stats['maxWaitSecs'], waitSecs)
+        backgroundTasksCond.release()
+
+        failed = False
+        try:
+            run_background_task(task)
+        except Exception:
+            # Print info about unhandled exceptions, then continue with the
+            # next task.
+            traceback.print_exc()
+            failed = True
+
+        backgroundTasksCond.acquire()
+        runSecs = time.time() - timeStarted
+        stats['run'] += 1
+        stats['runSecs'] += runSecs
+        stats['maxRunSecs'] = max(stats['maxRunSecs'], runSecs)
+        if(failed):
+            stats['failed'] += 1
+
+        task['state'] = 'done'
+        if(group != None):
+            backgroundTasksBusyGroups.discard(group)
+        backgroundTasksRunning -= 1
+
+        # Delete task's key from backgroundTasksCmds such that
+        # queue_background_task() can queue another task['cmd'] in the future.
+        taskKey = background_task_key(task)
+        if(backgroundTasksCmds.get(taskKey) is task):
+            del backgroundTasksCmds[taskKey]
+
+        # Other workers may be waiting for this task's group or, in
+        # wait_background_tasks(), for all tasks to finish.
+        backgroundTasksCond.notify_all()
+        backgroundTasksCond.release()
+
+def wait_background_tasks():
+    # Block until every queued task has run. Timers that aren't due yet don't
+    # count.
+    global backgroundTasksCond, backgroundTasksCmds, backgroundTasksRunning
+
+    backgroundTasksCond.acquire()
+    while(len(backgroundTasksCmds) > 0 or backgroundTasksRunning > 0):
+        backgroundTasksCond.wait()
+    backgroundTasksCond.release()
+
+def background_task_stats_str():
+    # Return one line per task type with how many are waiting and how long
+    # they wait and run on average.
+    global backgroundTasksCond, backgroundTaskStats
+
+    lines = []
+    backgroundTasksCond.acquire()
+    for cmd in sorted(backgroundTaskStats):
+        stats = backgroundTaskStats[cmd]
+        started = max(1, stats['run'])
+        lines.append('%s: depth %d, run %d, failed %d, retried %d, cancelled %d, '
+                     'expired %d, wait avg %.2fs max %.2fs, run avg %.2fs max %.2fs'
+                     % (cmd, stats['depth'], stats['run'], stats['failed'],
+                        stats['retried'], stats['cancelled'], stats['expired'],
+                        stats['waitSecs'] / started, stats['maxWaitSecs'],
+                        stats['runSecs'] / started, stats['maxRunSecs']))
+    backgroundTasksCond.release()
+    return '\n'.join(lines)
+
+def log_background_task_stats():
+    global backgroundTaskStatsLogMins
+
+    if(debugLevel >= 2):
+        print(time_now() + ': Background task stats:\n' + background_task_stats_str())
+    schedule_timer(backgroundTaskStatsLogMins*60, log_background_task_stats)
+
+def check_green_energy():
+    global debugLevel, maxAmpsToDivideAmongSlaves, greenEnergyAmpsOffset, \
+           minAmpsPerTWC, backgroundTasksLock, greenEnergyWatts, \
+           timeGreenEnergyWatts
+
+    # I check solar panel generation using an API exposed by The
+    # Energy Detective (TED). It's a piece of hardware available
+    # at http://www. theenergydetective.com
+    # You may also be able to find a way to query a solar system
+    # on the roof using an API provided by your solar installer.
+    # Most of those systems only update the amount of power the
+    # system is producing every 15 minutes at most, but that's
+    # fine for tweaking your car charging.
+    #
+    # In the worst case, you could skip finding realtime green
+    # energy data and simply direct the car to charge at certain
+    # rates at certain times of day that typically have certain
+    # levels of solar or wind generation. To do so, use the hour
+    # and min variables as demonstrated just above this line:
+    #   queue_background_task({'cmd':'checkGreenEnergy'})
+    #
+    # The curl command used below can be used to communicate
+    # with almost any web API, even ones that require POST
+    # values or authentication. The -s option prevents curl from
+    # displaying download stats. -m 60 prevents the whole
+    # operation from taking over 60 seconds.
+    greenEnergyData = run_process('curl -s -m 60 "http://192.168.13.58/history/export.csv?T=1&D=0&M=1&C=1"')
+
+    # In case, greenEnergyData will contain something like this:
+    #   MTU, Time, Power, Cost, Voltage
+    #   Solar,11/11/2017 14:20:43,-2.957,-0.29,124.3
+    # The only part we care about is -2.957 which is negative
+    # kW currently being generated. When 0kW is generated, the
+    # negative disappears so we make it optional in the regex
+    # below.
+    m = re.search(b'^Solar,[^,]+,-?([^, ]+),', greenEnergyData, re.MULTILINE)
+    if(m):
+        solarW = int(float(m.group(1)) * 1000)
+
+        # Use backgroundTasksLock to prevent changing maxAmpsToDivideAmongSlaves
+        # if the main thread is in the middle of examining and later using
+        # that value.
+        backgroundTasksLock.acquire()
+
+        # Watts = Volts * Amps
+        # Car charges at 240 volts in North America so we figure
+        # out how many amps * 240 = solarW and limit the car to
+        # that many amps.
+        maxAmpsToDivideAmongSlaves = (solarW / 240) + \
+                                      greenEnergyAmpsOffset
+        greenEnergyWatts = solarW
+        timeGreenEnergyWatts = time.time()
+
+        if(debugLevel >= 1):
+            print("%s: Solar generating %dW so limit car charging to:\n" \
+                 "          %.2fA + %.2fA = %.2fA.  Charge when above %.0fA (minAmpsPerTWC)." % \
+                 (time_now(), solarW, (solarW / 240),
+                 greenEnergyAmpsOffset, maxAmpsToDivideAmongSlaves,
+                 minAmpsPerTWC))
+
+        backgroundTasksLock.release()
+    else:
+        print(time_now() +
+            " ERROR: Can't determine current solar generation from:\n" +
+            str(greenEnergyData))
+
+def matched_vehicle(TWCID):
+    # Return the CarApiVehicle that correlate_vehicle() has matched to the
+    # slave TWC with TWCID, or None if we don't know which car is plugged in.
+    global slaveTWCs, carApiVehicles
+
+    if(TWCID == None):
+        return None
+
+    try:
+        slaveTWC = slaveTWCs[TWCID]
+    except KeyError:
+        return None
+
+    if(slaveTWC.matchedVehicleID == None):
+        return None
+
+    for vehicle in carApiVehicles:
+        if(vehicle.ID == slaveTWC.matchedVehicleID):
+            return vehicle
+
+    return None
+
+def vehicles_for_twc(TWCID):
+    # Return the list of cars a car API command on behalf of TWCID should go
+    # to. That's just the matched car if we know it, otherwise every car that
+    # isn't matched to another TWC. A TWCID of None means every car.
+    global slaveTWCRoundRobin, carApiVehicles
+
+    vehicle = matched_vehicle(TWCID)
+    if(vehicle != None):
+        return [vehicle]
+
+    if(TWCID == None):
+        return carApiVehicles
+
+    otherVehicleIDs = set()
+    for slaveTWC in slaveTWCRoundRobin:
+        if(slaveTWC.TWCID != TWCID and slaveTWC.matchedVehicleID != None):
+            otherVehicleIDs.add(slaveTWC.matchedVehicleID)
+
+    return [vehicle for vehicle in carApiVehicles
+            if vehicle.ID not in otherVehicleIDs]
+
+def twc_plug_event(slaveTWC):
+    # Called when a car is plugged in to or unplugged from slaveTWC. A
+    # different car may be plugged in now, so halve our confidence in every
+    # match for this TWC and let new charge state samples decide.
+    for vehicleID, score in list(slaveTWC.vehicleMatchScores.items()):
+        slaveTWC.vehicleMatchScores[vehicleID] = score / 2
+
+    update_twc_match(slaveTWC)
+
+    if(slaveTWC.pluggedIn):
+        # Sample any car that happens to be awake. This doesn't wake cars.
+        queue_background_task({'cmd':'correlate'})
+
+def correlate_vehicle(vehicle):
+    # Compare the charge state vehicle just reported with the amps and plug
+    # state each slave TWC reports, and update how confident we are that
+    # vehicle is plugged in to each TWC.
+    #
+    # Each TWC keeps a score per vehicle between -1 and 1 that moves
+    # carApiMatchLearnRate of the way toward each new piece of evidence:
+    #   1    Car and TWC both charging at about the same amps shortly after we
+    #        changed the amps offered by the TWC. Two cars can easily charge at
+    #        the same steady rate, but it's unlikely a car we don't control
+    #        would follow our amp step.
+    #   0.5  Car and TWC charging at about the same amps.
+    #   0.25 Car and TWC both plugged in and neither is charging.
+    #   -1   One is plugged in or charging and the other isn't, or both are
+    #        charging at different amps.
+    global slaveTWCRoundRobin, carApiMatchLearnRate, carApiMatchAmpsTolerance
+
+    now = time.time()
+    carPluggedIn = (vehicle.chargingState != None
+                    and vehicle.chargingState != 'Disconnected')
+    carAmps = vehicle.chargerActualCurrent
+
+    for slaveTWC in list(slaveTWCRoundRobin):
+        twcAmps = slaveTWC.reportedAmpsActual
+        if(not carPluggedIn):
+            if(not slaveTWC.pluggedIn):
+                # Neither is plugged in, which tells us nothing.
+                continue
+            evidence = -1
+        elif(not slaveTWC.pluggedIn):
+            evidence = -1
+        elif(now - slaveTWC.timeReportedAmpsActualChangedSignificantly < 15):
+            # Amps used on this TWC are still changing, so the value the car
+            # reported may not have caught up yet.
+            continue
+        elif(twcAmps >= 1.0 or carAmps >= 1.0):
+            if(abs(twcAmps - carAmps) > carApiMatchAmpsTolerance):
+                evidence = -1
+            elif(now - slaveTWC.timeLastAmpsOfferedChanged < 5*60):
+                evidence = 1
+            else:
+                evidence = 0.5
+        else:
+            evidence = 0.25
+
+        score = slaveTWC.vehicleMatchScores.get(vehicle.ID, 0)
+        score += carApiMatchLearnRate * (evidence - score)
+        slaveTWC.vehicleMatchScores[vehicle.ID] = score
+
+        if(debugLevel >= 8):
+            print(time_now() + ": Vehicle " + str(vehicle.ID) + " '"
+                  + str(vehicle.chargingState) + "' %.2fA vs TWC %02X%02X %.2fA: "
+                  "evidence %.2f, score %.2f" % (carAmps, slaveTWC.TWCID[0],
+                  slaveTWC.TWCID[1], twcAmps, evidence, score))
+
+        update_twc_match(slaveTWC)
+
+def update_twc_match(slaveTWC):
+    # Pick the car with the best score for slaveTWC. Our confidence is how far
+    # its score is ahead of the next best car. Only treat the car as matched if
+    # confidence is at least carApiMatchMinConfidence and no other TWC is more
+    # confident it has the same car.
+    global slaveTWCRoundRobin, carApiMatchMinConfidence
+
+    bestVehicleID = None
+    bestScore = 0
+    secondScore = 0
+    for vehicleID, score in list(slaveTWC.vehicleMatchScores.items()):
+        if(bestVehicleID == None or score > bestScore):
+            secondScore = max(secondScore, bestScore)
+            bestVehicleID = vehicleID
+            bestScore = score
+        elif(score > secondScore):
+            secondScore = score
+
+    confidence = min(1.0, bestScore - max(secondScore, 0))
+    matchedVehicleID = None
+    if(bestVehicleID != None and confidence >= carApiMatchMinConfidence):
+        matchedVehicleID = bestVehicleID
+        for otherTWC in list(slaveTWCRoundRobin):
+            if(otherTWC is not slaveTWC
+               and otherTWC.matchedVehicleID == bestVehicleID
+               and otherTWC.matchedVehicleConfidence > confidence
+            ):
+                matchedVehicleID = None
+                break
+
+    if(matchedVehicleID != slaveTWC.matchedVehicleID):
+        if(matchedVehicleID == None):
+            log(1, ": TWC %02X%02X no longer matched to a vehicle.",
+                slaveTWC.TWCID[0], slaveTWC.TWCID[1])
+        else:
+            log(1, ": TWC %02X%02X matched to vehicle %s with confidence %.2f.",
+                slaveTWC.TWCID[0], slaveTWC.TWCID[1], matchedVehicleID, confidence)
+
+    slaveTWC.matchedVehicleID = matchedVehicleID
+    slaveTWC.matchedVehicleConfidence = (confidence if matchedVehicleID != None else 0)
+
+def correlate_ready_vehicles():
+    # Sample charge state of every car that's already awake and use it to match
+    # cars with TWCs. Cars that are asleep are left alone.
+    global carApiVehicles
+
+    for vehicle in carApiVehicles:
+        if(vehicle.ready() and vehicle.update_charge_state()):
+            correlate_vehicle(vehicle)
+
+def send_user_twc_msg(hexMsg):
+    # Send a TWC message typed in by a user, for debugging. Messages known to
+    # crash or disable a TWC are refused. Returns True if the message was
+    # sent, after which lastTWCResponseMsg collects the TWC's response.
+    global slaveTWCRoundRobin, lastTWCResponseMsg
+
+    twcMsg = trim_pad(bytearray.fromhex(hexMsg),
+                      15 if len(slaveTWCRoundRobin) == 0
+                      or slaveTWCRoundRobin[0].protocolVersion == 2 else 13)
+    if((twcMsg[0:2] == b'\xFC\x19') or (twcMsg[0:2] == b'\xFC\x1A')):
+        print("\n*** ERROR: Request to send command:\n"
+              + hex_str(twcMsg)
+              + "\nwhich could permanently disable the TWC.  Aborting.\n")
+        return False
+    elif(twcMsg[0:2] == b'\xFB\xE8'):
+        print("\n*** ERROR: Request to send command:\n"
+              + hex_str(twcMsg)
+              + "\nwhich could crash the TWC.  Aborting.\n")
+        return False
+
+    lastTWCResponseMsg = bytearray()
+    send_msg(twcMsg)
+    return True
+
+def fleet_status():
+    # Return a dict of the state dashboards show, with one entry per slave
+    # TWC under 'slaves'. Values are JSON-serializable.
+    global maxAmpsToDivideAmongSlaves, chargeNowAmps, chargeNowTimeEnd, \
+           nonScheduledAmpsMax, slaveTWCRoundRobin
+
+    status = {
+        'maxAmpsToDivideAmongSlaves': round(maxAmpsToDivideAmongSlaves, 2),
+        'nonScheduledAmpsMax': nonScheduledAmpsMax,
+        'chargeNowAmps': chargeNowAmps,
+        'chargeNowTimeEnd': chargeNowTimeEnd,
+        'busHealthScore': busHealth.score(busHealth.totals),
+        'busDiagnosis': busHealth.diagnosis(busHealth.totals),
+        'slaves': {},
+    }
+    for slaveTWC in slaveTWCRoundRobin:
+        status['slaves']['%02X%02X' % (slaveTWC.TWCID[0], slaveTWC.TWCID[1])] = {
+            'maxAmps': slaveTWC.maxAmps,
+            'reportedAmpsMax': slaveTWC.reportedAmpsMax,
+            'reportedAmpsActual': slaveTWC.reportedAmpsActual,
+            'lastAmpsOffered': slaveTWC.lastAmpsOffered,
+            'reportedState': slaveTWC.reportedState,
+            'pluggedIn': slaveTWC.pluggedIn,
+            'protocolVersion': slaveTWC.protocolVersion,
+            'matchedVehicleID': slaveTWC.matchedVehicleID,
+        }
+    return status
+
+def fleet_status_delta(oldStatus, newStatus):
+    # Return the parts of newStatus that differ from oldStatus, in the same
+    # shape. A slave that's gone is given as None.
+    delta = {}
+    for name, value in newStatus.items():
+        if(name != 'slaves' and oldStatus.get(name) != value):
+            delta[name] = value
+
+    oldSlaves = oldStatus.get('slaves', {})
+    slaves = {}
+    for TWCID, slave in newStatus['slaves'].items():
+        if(TWCID not in oldSlaves):
+            slaves[TWCID] = slave
+            continue
+        changes = {}
+        for name, value in slave.items():
+            if(oldSlaves[TWCID].get(name) != value):
+                changes[name] = value
+        if(len(changes) > 0):
+            slaves[TWCID] = changes
+    for TWCID in oldSlaves:
+        if(TWCID not in newStatus['slaves']):
+            slaves[TWCID] = None
+    if(len(slaves) > 0):
+        delta['slaves'] = slaves
+
+    return delta
+
+def web_msg_response(webMsg):
+    # Handle one request from the web interface and return the text to send
+    # back, or '' if there's nothing to send.
+    global debugLevel, fakeMaster, rs485Adapter, maxAmpsToDivideAmongSlaves, \
+           wiringMaxAmpsAllTWCs, minAmpsPerTWC, chargeNowAmps, \
+           chargeNowTimeEnd, nonScheduledAmpsMax, scheduledAmpsMax, \
+           scheduledAmpsStartHour, scheduledAmpsEndHour, \
+           scheduledAmpsDaysBitmap, hourResumeTrackGreenEnergy, \
+           carApiBearerToken, slaveTWCRoundRobin, lastTWCResponseMsg, \
+           overrideMasterHeartbeatData, settingsLock
+
+    now = time.time()
+    webResponseMsg = ''
+
+    if(webMsg == b'getStatus'):
+        webResponseMsg = (
+            "%.2f" % (maxAmpsToDivideAmongSlaves) +
+            '`' + "%.2f" % (wiringMaxAmpsAllTWCs) +
+            '`' + "%.2f" % (minAmpsPerTWC) +
+            '`' + "%.2f" % (chargeNowAmps) +
+            '`' + str(nonScheduledAmpsMax) +
+            '`' + str(scheduledAmpsMax) +
+            '`' + "%02d:%02d" % (int(scheduledAmpsStartHour),
+                                 int((scheduledAmpsStartHour % 1) * 60)) +
+            '`' + "%02d:%02d" % (int(scheduledAmpsEndHour),
+                                 int((scheduledAmpsEndHour % 1) * 60)) +
+            '`' + str(scheduledAmpsDaysBitmap) +
+            '`' + "%02d:%02d" % (int(hourResumeTrackGreenEnergy),
+                                 int((hourResumeTrackGreenEnergy % 1) * 60)) +
+            # Send 1 if we need an email/password entered for car api,
+            # otherwise send 0.
+            '`' + ('1' if carApiBearerToken == '' else '0') +
+            '`' + str(len(slaveTWCRoundRobin))
+        )
+        for slaveTWC in slaveTWCRoundRobin:
+            webResponseMsg += (
+                '`' + "%02X%02X" % (slaveTWC.TWCID[0], slaveTWC.TWCID[1]) +
+                '~' + str(slaveTWC.maxAmps) +
+                '~' + "%.2f" % (slaveTWC.reportedAmpsActual) +
+                '~' + str(slaveTWC.lastAmpsOffered) +
+                '~' + str(slaveTWC.reportedState)
+            )
+    elif(webMsg[0:20] == b'setNonScheduledAmps='):
+        m = re.search(b'([-0-9]+)', webMsg[20:])
+        if(m):
+            settingsLock.acquire()
+            nonScheduledAmpsMax = int(m.group(1))
+            settingsLock.release()
+
+            # Save nonScheduledAmpsMax to SD card so the setting isn't lost on
+            # power failure or script restart.
+            save_settings()
+    elif(webMsg[0:17] == b'setScheduledAmps='):
+        m = re.search(b'([-0-9]+)\nstartTime=([-0-9]+):([0-9]+)\nendTime=([-0-9]+):([0-9]+)\ndays=([0-9]+)',
+                      webMsg[17:], re.MULTILINE)
+        if(m):
+            settingsLock.acquire()
+            scheduledAmpsMax = int(m.group(1))
+            scheduledAmpsStartHour = int(m.group(2)) + (int(m.group(3)) / 60)
+            scheduledAmpsEndHour = int(m.group(4)) + (int(m.group(5)) / 60)
+            scheduledAmpsDaysBitmap = int(m.group(6))
+            settingsLock.release()
+            save_settings()
+    elif(webMsg[0:30] == b'setResumeTrackGreenEnergyTime='):
+        m = re.search(b'([-0-9]+):([0-9]+)', webMsg[30:], re.MULTILINE)
+        if(m):
+            settingsLock.acquire()
+            hourResumeTrackGreenEnergy = int(m.group(1)) + (int(m.group(2)) / 60)
+            settingsLock.release()
+            save_settings()
+    elif(webMsg[0:11] == b'sendTWCMsg='):
+        m = re.search(b'([0-9a-fA-F]+)', webMsg[11:], re.MULTILINE)
+        if(m):
+            send_user_twc_msg(m.group(1).decode('ascii'))
+    elif(webMsg == b'getLastTWCMsgResponse'):
+        if(lastTWCResponseMsg != None and lastTWCResponseMsg != b''):
+            webResponseMsg = hex_str(lastTWCResponseMsg)
+        else:
+            webResponseMsg = 'None'
+    elif(webMsg[0:20] == b'carApiEmailPassword='):
+        m = re.search(b'([^\n]+)\n([^\n]+)', webMsg[20:], re.MULTILINE)
+        if(m):
+            queue_background_task({'cmd':'carApiEmailPassword',
+                                   'email':m.group(1).decode('ascii'),
+                                   'password':m.group(2).decode('ascii')})
+    elif(webMsg[0:23] == b'setMasterHeartbeatData='):
+        m = re.search(b'([0-9a-fA-F]*)', webMsg[23:], re.MULTILINE)
+        if(m):
+            if(len(m.group(1)) > 0):
+                overrideMasterHeartbeatData = trim_pad(
+                    bytearray.fromhex(m.group(1).decode('ascii')),
+                    9 if len(slaveTWCRoundRobin) > 0
+                    and slaveTWCRoundRobin[0].protocolVersion == 2 else 7)
+            else:
+                overrideMasterHeartbeatData = b''
+    elif(webMsg == b'chargeNow'):
+        chargeNowAmps = wiringMaxAmpsAllTWCs
+        chargeNowTimeEnd = now + 60*60*24
+    elif(webMsg == b'chargeNowCancel'):
+        chargeNowAmps = 0
+        chargeNowTimeEnd = 0
+    elif(webMsg == b'dumpState'):
+        # dumpState is used for debugging. It's requested using a web page:
+        #   http://(Pi address)/index.php?submit=1&dumpState=1
+        webResponseMsg = ('time=' + str(now) + ', fakeMaster=' + str(fakeMaster)
+            + ', rs485Adapter=' + rs485Adapter
+            + ', debugLevel=' + str(debugLevel)
+            + ', maxAmpsToDivideAmongSlaves=' + str(maxAmpsToDivideAmongSlaves)
+            + ', chargeNowAmps=' + str(chargeNowAmps)
+            + ', chargeNowTimeEnd=' + str(chargeNowTimeEnd)
+            + ', backgroundTasks=' + background_task_stats_str().replace('\n', '; '))
+        for slaveTWC in slaveTWCRoundRobin:
+            webResponseMsg += (', slave %02X%02X: lastAmpsOffered=%s, '
+                'reportedAmpsActual=%.2f, reportedState=%d, protocolVersion=%d, '
+                'masterHeartbeatData=%s' % (slaveTWC.TWCID[0], slaveTWC.TWCID[1],
+                str(slaveTWC.lastAmpsOffered), slaveTWC.reportedAmpsActual,
+                slaveTWC.reportedState, slaveTWC.protocolVersion,
+                hex_str(slaveTWC.masterHeartbeatData)))
+    elif(webMsg[0:14] == b'setDebugLevel='):
+        m = re.search(b'([-0-9]+)', webMsg[14:], re.MULTILINE)
+        if(m):
+            debugLevel = int(m.group(1))
+    else:
+        print(time_now() + ": Unknown IPC request from web server: " + str(webMsg))
+
+    return webResponseMsg
+
+def send_web_response(webMsgTime, webMsgID, webResponseMsg):
+    # Send webResponseMsg to the web interface. A response that won't fit in
+    # one webMsgMaxSize message is sent as a message holding the number of
+    # packets to expect, followed by that many packets. Sends never block, so
+    # a web server that stopped reading can't stall heartbeats.
+    global debugLevel, webIPCqueue, webMsgMaxSize
+
+    headerSize = struct.calcsize('=LH')
+    packetSize = webMsgMaxSize - headerSize
+    webResponseMsg = webResponseMsg.encode('ascii', 'replace')
+
+    try:
+        if(len(webResponseMsg) <= packetSize):
+            webIPCqueue.send(struct.pack('=LH', webMsgTime, webMsgID)
+                             + webResponseMsg, block=False)
+        else:
+            numPackets = (len(webResponseMsg) + packetSize - 1) // packetSize
+            if(numPackets > 255):
+                numPackets = 255
+                log(0, ": WARNING: Web response truncated to %d bytes.",
+                    numPackets * packetSize)
+            webIPCqueue.send(struct.pack('=LHB', webMsgTime, webMsgID, numPackets),
+                             block=False)
+            for i in range(0, numPackets):
+                webIPCqueue.send(struct.pack('=LH', webMsgTime, webMsgID)
+                                 + webResponseMsg[i*packetSize:(i+1)*packetSize],
+                                 block=False)
+    except sysv_ipc.BusyError:
+        log(0, ": Error: IPC queue full when trying to send response.")
+
+def service_web_ipc_queue():
+    # Called once per trip through the main loop to answer every request the
+    # web interface has queued, without ever waiting on the queue. If answering
+    # them takes more than webIPCBudgetSecs, the rest wait for the next trip
+    # so we don't delay a heartbeat. The main loop comes around every ~25ms
+    # when it has nothing else to do, so requests are answered well within
+    # 100ms.
+    #
+    # Requests are type 2 messages holding a 4-byte time and 2-byte ID the
+    # web interface uses to match our type 1 response to its request.
+    global debugLevel, webIPCqueue, webIPCBudgetSecs, webMsgPacked
+
+    if(webIPCqueue == None):
+        return
+
+    timeStart = time.time()
+    while(time.time() - timeStart < webIPCBudgetSecs):
+        try:
+            (webMsgPacked, webMsgType) = webIPCqueue.receive(False, 2)
+        except sysv_ipc.BusyError:
+            # No web message is waiting.
+            return
+
+        if(len(webMsgPacked) < 6):
+            continue
+        (webMsgTime, webMsgID) = struct.unpack('=LH', webMsgPacked[0:6])
+        webMsg = webMsgPacked[6:]
+
+        if(debugLevel >= 1):
+            webMsgRedacted = webMsg
+            # Hide car password in web request to send password to Tesla.
+            m = re.search(b'^(carApiEmailPassword=[^\n]+\n)', webMsg, re.MULTILINE)
+            if(m):
+                webMsgRedacted = m.group(1) + b'[HIDDEN]'
+            log(1, ": Web query: '%r', id %d, time %d", webMsgRedacted,
+                webMsgID, webMsgTime)
+
+        webResponseMsg = web_msg_response(webMsg)
+        if(len(webResponseMsg) > 0):
+            log(5, ": Web query response: '%s'", webResponseMsg)
+            send_web_response(webMsgTime, webMsgID, webResponseMsg)
+
+def parse_export_time(value):
+    # Accept seconds since the epoch, 'YYYY-MM-DD', or 'YYYY-MM-DD HH:MM[:SS]'
+    # in local time.
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("can't understand time '" + value + "'")
+
+class ExportWriter:
+    # Writes chunks of columns to CSV or Parquet so export_history() never
+    # holds more than one chunk in memory.
+    fmt = None
+    columns = None
+    fh = None
+    csvWriter = None
+    parquetWriter = None
+    outputName = None
+    rowsWritten = 0
+
+    # Dict of column name to pyarrow type for columns whose type can't be
+    # guessed from the first chunk, like a column that's None in every row of
+    # it.
+    types = None
+
+    def __init__(self, fmt, outputName, columns, types = None):
+        self.fmt = fmt
+        self.outputName = outputName
+        self.columns = columns
+        self.types = (types if types != None else {})
+
+        if(fmt == 'parquet'):
+            if(pyarrow == None):
+                raise RuntimeError('Install pyarrow to export Parquet files.')
+            if(outputName == '-'):
+                raise RuntimeError("Parquet can't be written to stdout. Use --output.")
+        elif(outputName == '-'):
+            self.fh = sys.stdout
+        else:
+            self.fh = open(outputName, 'w', newline='')
+
+        if(self.fh != None):
+            self.csvWriter = csv.writer(self.fh)
+            self.csvWriter.writerow(columns)
+
+    def write(self, chunk):
+        # chunk is a dict of column name to a list or numpy array, all the same
+        # length.
+        numRows = len(chunk[self.columns[0]])
+        if(numRows == 0):
+            return
+
+        if(self.fmt == 'parquet'):
+            table = pyarrow.table([pyarrow.array(chunk[name], type=self.types.get(name))
+                                   for name in self.columns],
+                                  names=self.columns)
+            if(self.parquetWriter == None):
+                self.parquetWriter = pyarrow.parquet.ParquetWriter(self.outputName,
+                                                                   table.schema)
+            self.parquetWriter.write_table(table)
+        else:
+            values = []
+            for name in self.columns:
+                column = chunk[name]
+                values.append(column.tolist() if hasattr(column, 'tolist') else column)
+            self.csvWriter.writerows(zip(*values))
+
+        self.rowsWritten += numRows
+
+    def close(self):
+        if(self.parquetWriter != None):
+            self.parquetWriter.close()
+        if(self.fh != None and self.fh != sys.stdout):
+            self.fh.close()
+        elif(self.fh != None):
+            self.fh.flush()
+
+def export_samples(args, writer):
+    global sampleStoreDir
+
+    if(numpy == None):
+        raise RuntimeError('Install numpy to export samples.')
+
+    twcIndexes = {}
+    try:
+        fh = open(os.path.join(sampleStoreDir, 'twcids.txt'), 'r')
+        for line in fh:
+            if(line.strip() != ''):
+                twcIndexes[len(twcIndexes)] = line.strip().upper()
+        fh.close()
+    except FileNotFoundError:
+        return
+
+    # twcid isn't stored, but it's easier to use than the index in the twc
+    # column.
+    twcNames = numpy.array([twcIndexes.get(i, '') for i in range(0, 256)])
+    wantedIndexes = None
+    if(args.twcid != None):
+        wantedIndexes = [i for i in twcIndexes
+                         if twcIndexes[i] in [twcid.upper() for twcid in args.twcid]]
+
+    for day in SampleStore.days(sampleStoreDir):
+        dayStart = time.mktime(time.strptime(day, '%Y-%m-%d'))
+        if(args.end != None and dayStart >= args.end):
+            break
+        if(args.start != None and dayStart + 25*3600 <= args.start):
+            continue
+
+        rows = SampleStore.read_day(sampleStoreDir, day)
+        timestamps = rows['timestamp']
+
+        # Samples are appended in time order, so find the range we want with a
+        # binary search instead of comparing every row.
+        first = 0
+        last = len(timestamps)
+        if(args.start != None):
+            first = int(numpy.searchsorted(timestamps, args.start))
+        if(args.end != None):
+            last = int(numpy.searchsorted(timestamps, args.end))
+
+        for chunkStart in range(first, last, args.chunk_rows):
+            chunkEnd = min(chunkStart + args.chunk_rows, last)
+            twc = rows['twc'][chunkStart:chunkEnd]
+            mask = None
+            if(wantedIndexes != None):
+                mask = numpy.isin(twc, wantedIndexes)
+
+            chunk = {}
+            for name in writer.columns:
+                if(name == 'twcid'):
+                    column = twcNames[twc]
+                else:
+                    column = rows[name][chunkStart:chunkEnd]
+                if(mask is not None):
+                    # mask is a numpy array, so != None would compare each
+                    # element.
+                    column = column[mask]
+                chunk[name] = column
+            writer.write(chunk)
+
+def export_rollups(args, writer):
+    global rollupsFileName
+
+    levels = {'minute': 60, 'hour': 3600, 'day': 86400}
+    level = levels[args.level]
+    try:
+        fh = open(rollupsFileName, 'r')
+        rows = json.load(fh)
+        fh.close()
+    except FileNotFoundError:
+        return
+
+    chunk = None
+    for (rowLevel, series, start, bucket) in sorted(rows, key=lambda row: row[2]):
+        if(rowLevel != level
+           or (args.twcid != None and series not in [twcid.upper() for twcid in args.twcid])
+           or (args.start != None and start < args.start)
+           or (args.end != None and start >= args.end)
+        ):
+            continue
+
+        if(chunk == None):
+            chunk = {}
+            for name in writer.columns:
+                chunk[name] = []
+
+        row = dict(bucket)
+        row['start'] = start
+        row['twcid'] = series
+        for name in writer.columns:
+            chunk[name].append(row.get(name))
+
+        if(len(chunk[writer.columns[0]]) >= args.chunk_rows):
+            writer.write(chunk)
+            chunk = None
+
+    if(chunk != None):
+        writer.write(chunk)
+
+def export_sessions(args, writer):
+    global sessionsFileName
+
+    if(not os.path.exists(sessionsFileName)):
+        return
+
+    store = SessionStore(sessionsFileName)
+    (where, params) = store.where(args.twcid, args.vehicle, args.start,
+                                  args.end, None)
+    cursor = store.db.execute('SELECT ' + ','.join(writer.columns)
+                              + ' FROM sessions' + where + ' ORDER BY start', params)
+    while True:
+        rows = cursor.fetchmany(args.chunk_rows)
+        if(len(rows) == 0):
+            break
+        chunk = {}
+        for i in range(0, len(writer.columns)):
+            chunk[writer.columns[i]] = [row[i] for row in rows]
+        writer.write(chunk)
+    store.db.close()
+
+def export_history(argv):
+    # Run as:
+    #   simpleTWCcontrol.py export [options]
+    # to write stored history as CSV or Parquet without starting the
+    # controller. This runs in its own process, so a long export doesn't slow
+    # the RS485 loop of the controller that's running. Data is read and written
+    # in chunks of --chunk-rows rows, so months of samples don't need to fit in
+    # memory.
+    #
+    # Examples:
+    #   simpleTWCcontrol.py export --start 2018-01-01 --end 2018-02-01 \
+    #       --twcid 1234 --columns timestamp,reportedAmpsActual -o jan.csv
+    #   simpleTWCcontrol.py export --dataset rollups --level day \
+    #       --format parquet -o days.parquet
+    #   simpleTWCcontrol.py export --dataset sessions --vehicle 12345678 \
+    #       --start 2018-01-01 -o sessions.csv
+    datasetColumns = {
+        'samples': ['timestamp', 'twcid'] + [name for (name, dtype) in SampleStore.columns
+                                             if name != 'timestamp'],
+        'rollups': ['start', 'twcid', 'energyWh', 'minAmps', 'maxAmps',
+                    'ampSecs', 'secs', 'chargingSecs', 'offerChanges'],
+        'sessions': SessionStore.columns,
+    }
+    datasetTypes = {}
+    if(pyarrow != None):
+        datasetTypes['sessions'] = {'vehicleID': pyarrow.string()}
+
+    parser = argparse.ArgumentParser(prog='simpleTWCcontrol.py export',
+        description='Export TWCManager history as CSV or Parquet.')
+    parser.add_argument('--dataset', choices=sorted(datasetColumns), default='samples')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-o', '--output', default='-',
+                        help="file to write, or '-' for stdout (CSV only)")
+    parser.add_argument('--start', type=parse_export_time,
+                        help="local time like '2018-01-31' or '2018-01-31 18:00', or epoch seconds")
+    parser.add_argument('--end', type=parse_export_time)
+    parser.add_argument('--twcid', action='append',
+                        help="hex TWCID like 1234 or 'site' for rollups. May be repeated.")
+    parser.add_argument('--vehicle',
+                        help='Tesla vehicle ID. Only used with --dataset sessions.')
+    parser.add_argument('--columns',
+                        help='comma-separated columns to include. Default is all.')
+    parser.add_argument('--level', choices=['minute', 'hour', 'day'], default='hour',
+                        help='rollup bucket size')
+    parser.add_argument('--chunk-rows', type=int, default=65536)
+    args = parser.parse_args(argv)
+
+    columns = datasetColumns[args.dataset]
+    if(args.columns != None):
+        columns = args.columns.split(',')
+        for name in columns:
+            if(name not in datasetColumns[args.dataset]):
+                parser.error("unknown column '" + name + "'.  Choose from "
+                             + ','.join(datasetColumns[args.dataset]))
+
+    # Stay out of the way of a controller running on the same pi.
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+    try:
+        writer = ExportWriter(args.format, args.output, columns,
+                              datasetTypes.get(args.dataset))
+        if(args.dataset == 'samples'):
+            export_samples(args, writer)
+        elif(args.dataset == 'sessions'):
+            export_sessions(args, writer)
+        else:
+            export_rollups(args, writer)
+        writer.close()
+    except RuntimeError as e:
+        print('ERROR: ' + str(e), file=sys.stderr)
+        return 1
+
+    if(args.output != '-'):
+        print('Exported ' + str(writer.rowsWritten) + ' rows to ' + args.output,
+              file=sys.stderr)
+    return 0
+
+#
+# End functions
+#
+##############################
+
+
+##############################
+#
+# Begin counter journal class
+#
+
+class CounterJournal:
+    # Persists counters that change many times a minute, like kWhDelivered,
+    # without rewriting the settings file on the SD card each time.
+    #
+    # set() only updates a dict, so it's cheap enough to call from the main
+    # loop on every heartbeat. A writer thread appends one fixed-size record per
+    # counter that changed to the journal file every syncSecs and fsyncs once
+    # for all of them. When the journal grows past maxBytes, the writer saves
+    # every counter to a snapshot file and empties the journal.
+    #
+    # On startup, recover() reads the snapshot and replays the journal on top
+    # of it. A record cut short or garbled by a power cut fails its CRC, so
+    # replay stops there and the journal is truncated to the last good record.
+    #
+    # Each record is a counter ID (its index in names, so only ever append to
+    # names), a float64 value, and a CRC32 of the two.
+    recordFormat = '<HdI'
+    recordSize = struct.calcsize('<HdI')
+
+    fileName = None
+    snapshotFileName = None
+    names = None
+    syncSecs = 30
+    maxBytes = 65536
+
+    values = None
+    pending = None
+    lock = None
+    stopEvent = None
+    thread = None
+    fh = None
+    journalBytes = 0
+
+    def __init__(self, fileName, names, syncSecs, maxBytes):
+        self.fileName = fileName
+        self.snapshotFileName = re.sub(r'\.[^./]*$', '', fileName) + '.snapshot'
+        self.names = names
+        self.syncSecs = syncSecs
+        self.maxBytes = maxBytes
+        self.values = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+
+    def pack(self, name, value):
+        data = struct.pack('<Hd', self.names.index(name), value)
+        return data + struct.pack('<I', zlib.crc32(data))
+
+    def read_records(self, fileName):
+        # Read records from fileName into self.values. Returns the number of
+        # bytes of good records.
+        try:
+            fh = open(fileName, 'rb')
+            data = fh.read()
+            fh.close()
+        except FileNotFoundError:
+            return 0
+
+        goodBytes = 0
+        while(goodBytes + self.recordSize <= len(data)):
+            (nameID, value, crc) = struct.unpack_from(self.recordFormat, data, goodBytes)
+            if(zlib.crc32(data[goodBytes:goodBytes + 10]) != crc
+               or nameID >= len(self.names)
+            ):
+                break
+            self.values[self.names[nameID]] = value
+            goodBytes += self.recordSize
+
+        if(goodBytes < len(data) and debugLevel >= 1):
+            print(time_now() + ': Ignoring ' + str(len(data) - goodBytes)
+                  + ' bytes of damaged records at end of ' + fileName + '.')
+        return goodBytes
+
+    def recover(self):
+        # Load the latest value of every counter and open the journal for
+        # appending. Returns a dict of counter name to value.
+        self.values = {}
+        self.read_records(self.snapshotFileName)
+        self.journalBytes = self.read_records(self.fileName)
+
+        self.fh = open(self.fileName, 'ab')
+        if(self.fh.tell() != self.journalBytes):
+            self.fh.truncate(self.journalBytes)
+            self.fh.seek(self.journalBytes)
+
+        return dict(self.values)
+
+    def set(self, name, value):
+        self.lock.acquire()
+        self.values[name] = value
+        self.pending[name] = value
+        self.lock.release()
+
+    def get(self, name, default = None):
+        return self.values.get(name, default)
+
+    def flush(self):
+        # Write and fsync records for every counter that changed since the last
+        # flush.
+        self.lock.acquire()
+        pending = self.pending
+        self.pending = {}
+        self.lock.release()
+
+        if(len(pending) == 0 or self.fh == None):
+            return
+
+        records = b''
+        for name in pending:
+            records += self.pack(name, pending[name])
+        self.fh.write(records)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.journalBytes += len(records)
+
+        if(self.journalBytes >= self.maxBytes):
+            self.compact()
+
+    def compact(self):
+        # Save every counter to the snapshot file, then empty the journal. If we
+        # lose power before the journal is emptied, replaying it on top of the
+        # new snapshot still ends at the same values.
+        self.lock.acquire()
+        values = dict(self.values)
+        self.lock.release()
+
+        records = b''
+        for name in values:
+            records += self.pack(name, values[name])
+
+        tmpFileName = self.snapshotFileName + '.tmp'
+        fh = open(tmpFileName, 'wb')
+        fh.write(records)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.replace(tmpFileName, self.snapshotFileName)
+
+        self.fh.truncate(0)
+        self.fh.seek(0)
+        os.fsync(self.fh.fileno())
+        self.journalBytes = 0
+
+        if(debugLevel >= 8):
+            print(time_now() + ': Compacted ' + self.fileName + ' into '
+                  + self.snapshotFileName + '.')
+
+    def run(self):
+        while(not self.stopEvent.wait(self.syncSecs)):
+            try:
+                self.flush()
+            except OSError:
+                # Keep the values in memory and try again next time. An SD
+                # card that's full or failing shouldn't stop us charging.
+                traceback.print_exc()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, args = ())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.stopEvent.set()
+        if(self.thread != None):
+            self.thread.join()
+        self.flush()
+        if(self.fh != None):
+            self.fh.close()
+            self.fh = None
+
+#
+# End counter journal class
+#
+##############################
+
+
+
+##############################
+#
+# Begin sample store class
+#
+
+class SampleStore:
+    # Keeps a history of every heartbeat from every slave TWC on disk, with one
+    # file per column per day so a month of samples can be analysed with numpy
+    # instead of searching logs. For example:
+    #   rows = SampleStore.read_day(sampleStoreDir, '2018-01-31')
+    #   kWh = (rows['reportedAmpsActual'][:-1] * 240
+    #          * numpy.diff(rows['timestamp'])).sum() / 3600 / 1000
+    #
+    # Each day is a directory named YYYY-MM-DD holding <column>.bin for each
+    # column in SampleStore.columns, plus rows.bin, a single int64 with how
+    # many rows are valid. Column files are extended in whole chunks of
+    # segmentRows rows as sparse files and memory mapped.
+    #
+    # append() copies a sample into preallocated batch arrays so the control
+    # loop doesn't allocate anything per sample. Every batchRows samples or
+    # flushSecs seconds, whichever comes first, flush() hands the batch to a
+    # writer thread and carries on with a spare one. The writer copies batches
+    # into the memory maps, flushes them to disk, and creates or grows the
+    # files for a new day, so none of that waits on the SD card in the control
+    # loop. If the writer falls behind by numSpareBatches batches, we drop
+    # samples and count them in numDropped rather than allocate more.
+    #
+    # The twc column is an index into twcids.txt in the store directory, which
+    # lists one hex TWCID per line.
+    columns = [
+        ('timestamp', '<f8'),
+        ('twc', 'u1'),
+        ('reportedAmpsActual', '<f4'),
+        ('reportedAmpsMax', '<f4'),
+        ('lastAmpsOffered', '<f4'),
+        ('state', 'u1'),
+        ('volts', '<u2'),
+    ]
+
+    storeDir = None
+    batchRows = 60
+    flushSecs = 10
+    segmentRows = 86400
+    numSpareBatches = 3
+
+    batch = None
+    batchLen = 0
+    timeBatchStarted = 0
+
+    # pending holds (batch, batchLen) waiting for the writer thread, and spares
+    # the batches it's finished with. Both are guarded by cond.
+    spares = None
+    pending = None
+    cond = None
+    thread = None
+    stopping = False
+    numDropped = 0
+
+    twcIndexes = None
+    day = None
+    dayEnd = 0
+    maps = None
+    rows = None
+    capacity = 0
+
+    def __init__(self, storeDir, batchRows, flushSecs, segmentRows):
+        self.storeDir = storeDir
+        self.batchRows = batchRows
+        self.flushSecs = flushSecs
+        self.segmentRows = segmentRows
+        self.batch = self.new_batch()
+        self.spares = []
+        for i in range(self.numSpareBatches):
+            self.spares.append(self.new_batch())
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+
+        os.makedirs(storeDir, exist_ok=True)
+        self.twcIndexes = {}
+        try:
+            fh = open(os.path.join(storeDir, 'twcids.txt'), 'r')
+            for line in fh:
+                if(line.strip() != ''):
+                    self.twcIndexes[bytes.fromhex(line.strip())] = len(self.twcIndexes)
+            fh.close()
+        except FileNotFoundError:
+            pass
+
+    def new_batch(self):
+        batch = {}
+        for (name, dtype) in self.columns:
+            batch[name] = numpy.zeros(self.batchRows, dtype=dtype)
+        return batch
+
+    def twc_index(self, TWCID):
+        try:
+            return self.twcIndexes[bytes(TWCID)]
+        except KeyError:
+            pass
+
+        index = len(self.twcIndexes)
+        fh = open(os.path.join(self.storeDir, 'twcids.txt'), 'a')
+        fh.write('%02X%02X\n' % (TWCID[0], TWCID[1]))
+        fh.close()
+        self.twcIndexes[bytes(TWCID)] = index
+        return index
+
+    def append(self, slaveTWC):
+        now = time.time()
+        i = self.batchLen
+        if(i == 0):
+            self.timeBatchStarted = now
+
+        batch = self.batch
+        batch['timestamp'][i] = now
+        batch['twc'][i] = self.twc_index(slaveTWC.TWCID)
+        batch['reportedAmpsActual'][i] = slaveTWC.reportedAmpsActual
+        batch['reportedAmpsMax'][i] = slaveTWC.reportedAmpsMax
+        batch['lastAmpsOffered'][i] = slaveTWC.lastAmpsOffered
+        batch['state'][i] = slaveTWC.reportedState
+        batch['volts'][i] = slaveTWC.reportedVolts
+        self.batchLen = i + 1
+
+        if(self.batchLen >= self.batchRows):
+            self.flush()
+
+    def flush_if_due(self):
+        if(self.batchLen > 0 and time.time() - self.timeBatchStarted >= self.flushSecs):
+            self.flush()
+
+    def open_day(self, timestamp):
+        # Memory map the column files for the day timestamp falls in.
+        self.close_day()
+
+        lt = time.localtime(timestamp)
+        self.day = time.strftime('%Y-%m-%d', lt)
+        self.dayEnd = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1,
+                                   0, 0, 0, 0, 0, -1))
+        dayDir = os.path.join(self.storeDir, self.day)
+        os.makedirs(dayDir, exist_ok=True)
+
+        rowsFile = os.path.join(dayDir, 'rows.bin')
+        if(not os.path.exists(rowsFile)):
+            numpy.zeros(1, dtype='<i8').tofile(rowsFile)
+        self.rows = numpy.memmap(rowsFile, dtype='<i8', mode='r+', shape=(1,))
+
+        self.capacity = 0
+        self.grow(int(self.rows[0]))
+
+    def grow(self, minRows):
+        # Make the column files big enough for at least minRows rows, in whole
+        # segments, and map them again.
+        capacity = max(self.segmentRows,
+                       -(-minRows // self.segmentRows) * self.segmentRows)
+        if(capacity <= self.capacity and self.maps != None):
+            return
+
+        dayDir = os.path.join(self.storeDir, self.day)
+        self.maps = {}
+        for (name, dtype) in self.columns:
+            fileName = os.path.join(dayDir, name + '.bin')
+            size = capacity * numpy.dtype(dtype).itemsize
+            fh = open(fileName, 'ab')
+            if(fh.tell() < size):
+                # Extending with truncate() makes a sparse file, so unused rows
+                # don't take space on the SD card.
+                fh.truncate(size)
+            fh.close()
+            self.maps[name] = numpy.memmap(fileName, dtype=dtype, mode='r+',
+                                           shape=(capacity,))
+        self.capacity = capacity
+
+    def close_day(self):
+        if(self.maps != None):
+            for name in self.maps:
+                self.maps[name].flush()
+        self.maps = None
+        self.rows = None
+        self.day = None
+
+    def flush(self):
+        # Hand the current batch to the writer thread.
+        if(self.batchLen == 0):
+            return
+
+        self.cond.acquire()
+        if(len(self.spares) == 0):
+            self.numDropped += self.batchLen
+            self.cond.release()
+            log(1, ": WARNING: Sample store writer is behind. Dropped %d samples.",
+                self.batchLen)
+        else:
+            self.pending.append((self.batch, self.batchLen))
+            self.batch = self.spares.pop()
+            self.cond.notify()
+            self.cond.release()
+        self.batchLen = 0
+
+    def write(self, batch, batchLen):
+        # Called on the writer thread.
+        start = 0
+        while(start < batchLen):
+            timestamp = batch['timestamp'][start]
+            if(self.day == None or timestamp >= self.dayEnd):
+                self.open_day(timestamp)
+
+            # Only copy samples that belong to this day.
+            end = start + int(numpy.searchsorted(
+                batch['timestamp'][start:batchLen], self.dayEnd))
+            rows = int(self.rows[0])
+            if(rows + end - start > self.capacity):
+                self.grow(rows + end - start)
+
+            for (name, dtype) in self.columns:
+                self.maps[name][rows:rows + end - start] = batch[name][start:end]
+                self.maps[name].flush()
+
+            # Only count the new rows once their data is on disk.
+            self.rows[0] = rows + end - start
+            self.rows.flush()
+            start = end
+
+    def run(self):
+        # Write pending batches until close() is called and none are left.
+        while(True):
+            self.cond.acquire()
+            while(len(self.pending) == 0 and not self.stopping):
+                self.cond.wait()
+            if(len(self.pending) == 0):
+                self.cond.release()
+                return
+            (batch, batchLen) = self.pending[0]
+            self.cond.release()
+
+            try:
+                self.write(batch, batchLen)
+            except OSError:
+                # Give up on this batch. An SD card that's full or failing
+                # shouldn't stop us charging.
+                traceback.print_exc()
+
+            self.cond.acquire()
+            self.pending.popleft()
+            self.spares.append(batch)
+            self.cond.release()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, args = ())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        # Write everything we have and close the day's files. The last batch
+        # goes to the writer even if it has no spare to give us back.
+        self.cond.acquire()
+        if(self.batchLen > 0):
+            self.pending.append((self.batch, self.batchLen))
+            self.batchLen = 0
+        self.stopping = True
+        self.cond.notify()
+        self.cond.release()
+        if(self.thread != None):
+            self.thread.join()
+        else:
+            self.run()
+        self.close_day()
+
+    @staticmethod
+    def days(storeDir):
+        # Return a sorted list of days that have samples.
+        return sorted(name for name in os.listdir(storeDir)
+                      if re.match(r'^\d{4}-\d\d-\d\d$', name))
+
+    @staticmethod
+    def read_day(storeDir, day):
+        # Return a dict of read-only memory maps of each column's valid rows
+        # for day.
+        dayDir = os.path.join(storeDir, day)
+        rows = int(numpy.fromfile(os.path.join(dayDir, 'rows.bin'), dtype='<i8')[0])
+        result = {}
+        for (name, dtype) in SampleStore.columns:
+            if(rows == 0):
+                result[name] = numpy.zeros(0, dtype=dtype)
+            else:
+                result[name] = numpy.memmap(os.path.join(dayDir, name + '.bin'),
+                                            dtype=dtype, mode='r', shape=(rows,))
+        return result
+
+#
+# End sample store class
+#
+##############################
+
+
+
+##############################
+#
+# Begin rollups class
+#
+
+class Rollups:
+    # Keeps per-minute, per-hour and per-day totals of how each slave TWC and
+    # the whole site were used, updated as each heartbeat arrives, so questions
+    # like "kWh per day per charger" or "peak total amps this month" can be
+    # answered without going through raw samples.
+    #
+    # Each bucket is a dict of:
+    #   energyWh      Energy delivered, from amps * volts * time between
+    #                 heartbeats.
+    #   minAmps       Lowest and highest amps in use. For the site, the total
+    #   maxAmps       of all TWCs.
+    #   ampSecs       Amps integrated over time. Divide by secs for the average.
+    #   secs          Seconds of heartbeats this bucket covers.
+    #   chargingSecs  Seconds with at least 1A in use.
+    #   offerChanges  How many times we changed the amps offered.
+    #
+    # Minute and hour buckets start at whole minutes and hours since the epoch.
+    # Day buckets start at local midnight so days match the calendar.
+    levels = [86400, 3600, 60]
+
+    fileName = None
+    retentionSecs = None
+    maxGapSecs = 10
+    defaultVolts = 240
+
+    # buckets[level][(series, bucketStart)] is a bucket dict. series is a hex
+    # TWCID like '1234' or 'site'. Buckets are created as time goes by, so
+    # each dict is in order of bucketStart, give or take the clock being set
+    # back.
+    buckets = None
+
+    # dirty holds (level, key) of every bucket add() changed since the last
+    # save_if_due(), which copies just those into pending for save() to merge
+    # into saved. saved is save()'s own copy of every bucket, so the main loop
+    # never has to copy all of them. pending is guarded by lock and saved is
+    # only used by save().
+    dirty = None
+    pending = None
+    saved = None
+    lock = None
+
+    # lastSample[series] is [time, amps, amps offered] of the last heartbeat
+    # from that TWC. siteLast is [time, total amps] for the site.
+    lastSample = None
+    siteLast = None
+
+    timeLastSave = 0
+
+    def __init__(self, fileName, retentionSecs, maxGapSecs, defaultVolts):
+        self.fileName = fileName
+        self.retentionSecs = retentionSecs
+        self.maxGapSecs = maxGapSecs
+        self.defaultVolts = defaultVolts
+        self.buckets = {}
+        self.saved = {}
+        for level in self.levels:
+            self.buckets[level] = {}
+            self.saved[level] = {}
+        self.dirty = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.lastSample = {}
+        self.timeLastSave = time.time()
+
+    def bucket_start(self, level, t):
+        if(level == 86400):
+            lt = time.localtime(t)
+            return time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday,
+                                0, 0, 0, 0, 0, -1))
+        return t - (t % level)
+
+    def bucket_end(self, level, start):
+        if(level == 86400):
+            # Days are 23 or 25 hours long when daylight saving time changes.
+            return self.bucket_start(level, start + 86400 + 3*3600)
+        return start + level
+
+    def add(self, series, t, dt, amps, energyWh, offerChanged):
+        for level in self.levels:
+            key = (series, self.bucket_start(level, t))
+            try:
+                bucket = self.buckets[level][key]
+            except KeyError:
+                bucket = {'energyWh': 0.0, 'minAmps': amps, 'maxAmps': amps,
+                          'ampSecs': 0.0, 'secs': 0.0, 'chargingSecs': 0.0,
+                          'offerChanges': 0}
+                self.buckets[level][key] = bucket
+            self.dirty.add((level, key))
+
+            bucket['energyWh'] += energyWh
+            if(amps < bucket['minAmps']):
+                bucket['minAmps'] = amps
+            if(amps > bucket['maxAmps']):
+                bucket['maxAmps'] = amps
+            bucket['ampSecs'] += amps * dt
+            bucket['secs'] += dt
+            if(amps >= 1.0):
+                bucket['chargingSecs'] += dt
+            if(offerChanged):
+                bucket['offerChanges'] += 1
+
+    def add_sample(self, slaveTWC, now):
+        # Called with each heartbeat from slaveTWC. The amps from the previous
+        # heartbeat are assumed to have been in use until now. Gaps over
+        # maxGapSecs, like after a restart, count as maxGapSecs.
+        series = '%02X%02X' % (slaveTWC.TWCID[0], slaveTWC.TWCID[1])
+        volts = slaveTWC.reportedVolts
+        if(volts <= 0):
+            volts = self.defaultVolts
+
+        energyWh = 0.0
+        last = self.lastSample.get(series)
+        if(last != None):
+            dt = min(now - last[0], self.maxGapSecs)
+            energyWh = last[1] * volts * dt / 3600
+            self.add(series, now, dt, last[1], energyWh,
+                     slaveTWC.lastAmpsOffered != last[2])
+        self.lastSample[series] = [now, slaveTWC.reportedAmpsActual,
+                                   slaveTWC.lastAmpsOffered]
+
+        if(self.siteLast != None):
+            dt = min(now - self.siteLast[0], self.maxGapSecs)
+            self.add('site', now, dt, self.siteLast[1], energyWh,
+                     last != None and slaveTWC.lastAmpsOffered != last[2])
+
+        # Don't count TWCs we stopped hearing from in the site total.
+        totalAmps = 0.0
+        for sample in self.lastSample.values():
+            if(now - sample[0] <= self.maxGapSecs):
+                totalAmps += sample[1]
+        self.siteLast = [now, totalAmps]
+
+    def query(self, series, start, end):
+        # Return a bucket dict totalling series from start to end, to the
+        # nearest minute, or None if there's no data. It's assembled from the
+        # biggest buckets that fit entirely in the interval, so a month takes
+        # about 30 day buckets plus up to a couple of days of hour and minute
+        # buckets at each end.
+        start = self.bucket_start(60, start)
+        end = self.bucket_start(60, end)
+
+        result = None
+        t = start
+        while(t < end):
+            for level in self.levels:
+                bucketStart = self.bucket_start(level, t)
+                bucketEnd = self.bucket_end(level, bucketStart)
+                if(bucketStart == t and bucketEnd <= end):
+                    break
+
+            bucket = self.buckets[level].get((series, bucketStart))
+            if(bucket != None):
+                if(result == None):
+                    result = dict(bucket)
+                else:
+                    result['energyWh'] += bucket['energyWh']
+                    result['minAmps'] = min(result['minAmps'], bucket['minAmps'])
+                    result['maxAmps'] = max(result['maxAmps'], bucket['maxAmps'])
+                    result['ampSecs'] += bucket['ampSecs']
+                    result['secs'] += bucket['secs']
+                    result['chargingSecs'] += bucket['chargingSecs']
+                    result['offerChanges'] += bucket['offerChanges']
+            t = bucketEnd
+
+        if(result != None):
+            result['avgAmps'] = (result['ampSecs'] / result['secs']
+                                 if result['secs'] > 0 else 0.0)
+        return result
+
+    def query_buckets(self, series, level, start, end):
+        # Return a list of (bucketStart, bucket dict) for every level bucket of
+        # series that starts from start up to end, oldest first. Useful for
+        # charts, like kWh per day.
+        result = []
+        for (key, bucket) in self.buckets[level].items():
+            if(key[0] == series and start <= key[1] < end):
+                result.append((key[1], bucket))
+        result.sort(key=lambda item: item[0])
+        return result
+
+    def series(self):
+        return sorted(set(key[0] for key in self.buckets[86400]))
+
+    def prune(self, buckets, now):
+        # Forget buckets older than retentionSecs for their level. buckets is
+        # self.buckets or self.saved. Both are in bucketStart order, so we stop
+        # at the first bucket we're keeping rather than look at them all.
+        for level in self.levels:
+            keepSecs = self.retentionSecs.get(level)
+            if(keepSecs == None):
+                continue
+            oldKeys = []
+            for key in buckets[level]:
+                if(key[1] >= now - keepSecs):
+                    break
+                oldKeys.append(key)
+            for key in oldKeys:
+                del buckets[level][key]
+
+    def snapshot(self):
+        # Return a list of every bucket, like to hand to the process that takes
+        # over from us.
+        rows = []
+        for level in self.levels:
+            for (key, bucket) in self.buckets[level].items():
+                rows.append([level, key[0], key[1], dict(bucket)])
+        return rows
+
+    def queue_changes(self):
+        # Copy the buckets add() changed since last time for save(). Called on
+        # the main thread. If a save is already queued, it picks these up too.
+        changes = {}
+        for (level, key) in self.dirty:
+            bucket = self.buckets[level].get(key)
+            if(bucket != None):
+                changes[(level, key)] = dict(bucket)
+        self.dirty = set()
+
+        self.lock.acquire()
+        self.pending.update(changes)
+        self.lock.release()
+
+    def save_if_due(self, saveSecs):
+        now = time.time()
+        if(now - self.timeLastSave < saveSecs):
+            return
+        self.timeLastSave = now
+        self.prune(self.buckets, now)
+        self.queue_changes()
+        queue_background_task({'cmd':'saveRollups'})
+
+    def save(self):
+        # Merge changes from queue_changes() into saved and write it all out.
+        self.lock.acquire()
+        changes = self.pending
+        self.pending = {}
+        self.lock.release()
+
+        # New buckets go on the end, which keeps saved in bucketStart order.
+        for ((level, key), bucket) in sorted(changes.items(),
+                                             key=lambda item: item[0][1][1]):
+            self.saved[level][key] = bucket
+        self.prune(self.saved, time.time())
+
+        rows = []
+        for level in self.levels:
+            for (key, bucket) in self.saved[level].items():
+                rows.append([level, key[0], key[1], bucket])
+
+        tmpFileName = self.fileName + '.tmp'
+        fh = open(tmpFileName, 'w')
+        json.dump(rows, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.replace(tmpFileName, self.fileName)
+
+    def load(self):
+        try:
+            fh = open(self.fileName, 'r')
+            rows = json.load(fh)
+            fh.close()
+        except FileNotFoundError:
+            return
+        except ValueError:
+            print(time_now() + ': WARNING: Ignoring damaged rollups file ' + self.fileName)
+            return
+        self.restore(rows)
+
+    def restore(self, rows):
+        # Replace every bucket with rows from snapshot(), like the ones handed
+        # to us by take_over_serial_port(). Called before we start saving.
+        for level in self.levels:
+            self.buckets[level] = {}
+            self.saved[level] = {}
+        for (level, series, start, bucket) in rows:
+            if(level in self.buckets):
+                self.buckets[level][(series, start)] = bucket
+                self.saved[level][(series, start)] = dict(bucket)
+        self.dirty = set()
+
+#
+# End rollups class
+#
+##############################
+
+
+
+##############################
+#
+# Begin charging session classes
+#
+
+class ChargingSession:
+    # Totals for one car plugged in to one slave TWC, from plug in to unplug.
+    # update() is called with every heartbeat and does a constant amount of
+    # work no matter how long the session lasts.
+    #
+    # Energy is integrated from amps and volts between heartbeats. If the TWC
+    # reported its lifetime kWh counter at the start and end of the session, we
+    # use the difference instead because it's what the TWC metered.
+    TWCID = None
+    vehicleID = None
+    timeStart = 0
+    timeEnd = 0
+    energyWh = 0.0
+    kWhCounterStart = None
+    kWhCounterEnd = None
+    peakAmps = 0.0
+    offerChanges = 0
+    chargingSecs = 0.0
+
+    timeLastUpdate = 0
+    lastAmps = 0.0
+    lastAmpsOffered = -1
+
+    # Attributes saved in the fleet snapshot. See save_fleet_snapshot().
+    snapshotAttrs = ['vehicleID', 'timeStart', 'timeEnd', 'energyWh',
+                     'kWhCounterStart', 'kWhCounterEnd', 'peakAmps',
+                     'offerChanges', 'chargingSecs', 'timeLastUpdate',
+                     'lastAmps', 'lastAmpsOffered']
+
+    def __init__(self, slaveTWC, now):
+        self.TWCID = bytes(slaveTWC.TWCID)
+        self.timeStart = now
+        self.timeEnd = now
+        self.timeLastUpdate = now
+        self.lastAmps = slaveTWC.reportedAmpsActual
+        self.lastAmpsOffered = slaveTWC.lastAmpsOffered
+        self.peakAmps = slaveTWC.reportedAmpsActual
+        self.kWhCounterStart = slaveTWC.reportedKWhCounter
+
+    def update(self, slaveTWC, now):
+        global sessionsMaxGapSecs, defaultVolts
+
+        volts = slaveTWC.reportedVolts
+        if(volts <= 0):
+            volts = defaultVolts
+
+        dt = min(now - self.timeLastUpdate, sessionsMaxGapSecs)
+        self.energyWh += self.lastAmps * volts * dt / 3600
+        if(self.lastAmps >= 1.0):
+            self.chargingSecs += dt
+
+        amps = slaveTWC.reportedAmpsActual
+        if(amps > self.peakAmps):
+            self.peakAmps = amps
+        if(slaveTWC.lastAmpsOffered != self.lastAmpsOffered):
+            self.offerChanges += 1
+        if(slaveTWC.matchedVehicleID != None):
+            self.vehicleID = slaveTWC.matchedVehicleID
+        if(slaveTWC.reportedKWhCounter != None):
+            if(self.kWhCounterStart == None):
+                self.kWhCounterStart = slaveTWC.reportedKWhCounter
+            self.kWhCounterEnd = slaveTWC.reportedKWhCounter
+
+        self.lastAmps = amps
+        self.lastAmpsOffered = slaveTWC.lastAmpsOffered
+        self.timeLastUpdate = now
+        self.timeEnd = now
+
+    def snapshot(self):
+        # Return this session's state for the fleet snapshot so a restart
+        # doesn't split one charge into two sessions.
+        state = {}
+        for name in self.snapshotAttrs:
+            state[name] = getattr(self, name)
+        return state
+
+    def restore(self, state):
+        for name in self.snapshotAttrs:
+            if(name in state):
+                setattr(self, name, state[name])
+
+    def record(self):
+        # Return a dict of this session's totals as stored by SessionStore.
+        kWh = self.energyWh / 1000
+        metered = False
+        if(self.kWhCounterStart != None and self.kWhCounterEnd != None
+           and self.kWhCounterEnd > self.kWhCounterStart
+        ):
+            kWh = self.kWhCounterEnd - self.kWhCounterStart
+            metered = True
+
+        return {
+            'twcid': '%02X%02X' % (self.TWCID[0], self.TWCID[1]),
+            'vehicleID': (str(self.vehicleID) if self.vehicleID != None else None),
+            'start': self.timeStart,
+            'end': self.timeEnd,
+            'day': time.strftime('%Y-%m-%d', time.localtime(self.timeStart)),
+            'kWh': kWh,
+            'kWhMetered': metered,
+            'kWhEstimated': self.energyWh / 1000,
+            'durationSecs': self.timeEnd - self.timeStart,
+            'chargingSecs': self.chargingSecs,
+            'peakAmps': self.peakAmps,
+            'offerChanges': self.offerChanges,
+        }
+
+
+class SessionStore:
+    # Stores finished charging sessions in an SQLite database indexed by TWC,
+    # vehicle, and day so we can bill each user of a shared garage without
+    # going through logs.
+    columns = ['id', 'twcid', 'vehicleID', 'start', 'end', 'day', 'kWh',
+               'kWhMetered', 'kWhEstimated', 'durationSecs', 'chargingSecs',
+               'peakAmps', 'offerChanges']
+
+    fileName = None
+    db = None
+    lock = None
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+
+        # Sessions are added by a background task and may be queried from
+        # other threads, so share one connection and serialize access with
+        # self.lock.
+        self.db = sqlite3.connect(fileName, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            twcid TEXT NOT NULL,
+            vehicleID TEXT,
+            start REAL NOT NULL,
+            end REAL NOT NULL,
+            day TEXT NOT NULL,
+            kWh REAL NOT NULL,
+            kWhMetered INTEGER NOT NULL,
+            kWhEstimated REAL NOT NULL,
+            durationSecs REAL NOT NULL,
+            chargingSecs REAL NOT NULL,
+            peakAmps REAL NOT NULL,
+            offerChanges INTEGER NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sessions_twcid ON sessions (twcid, start)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sessions_vehicle ON sessions (vehicleID, start)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sessions_day ON sessions (day)')
+        self.db.commit()
+
+    def add(self, record):
+        names = [name for name in self.columns if name != 'id']
+        self.lock.acquire()
+        try:
+            self.db.execute('INSERT INTO sessions (' + ','.join(names) + ') VALUES ('
+                            + ','.join('?' * len(names)) + ')',
+                            [record[name] for name in names])
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def query(self, twcid = None, vehicleID = None, start = None, end = None,
+              day = None, limit = None):
+        # Return a list of session dicts, oldest first, that match every
+        # argument given. start and end select sessions that started in that
+        # time range. day is a local date like '2018-01-31'.
+        (where, params) = self.where(twcid, vehicleID, start, end, day)
+        sql = 'SELECT ' + ','.join(self.columns) + ' FROM sessions' + where \
+              + ' ORDER BY start'
+        if(limit != None):
+            sql += ' LIMIT ' + str(int(limit))
+
+        self.lock.acquire()
+        try:
+            rows = self.db.execute(sql, params).fetchall()
+        finally:
+            self.lock.release()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    @staticmethod
+    def where(twcid, vehicleID, start, end, day):
+        conditions = []
+        params = []
+        if(twcid != None):
+            if(type(twcid) != list):
+                twcid = [twcid]
+            conditions.append('twcid IN (' + ','.join('?' * len(twcid)) + ')')
+            params.extend([value.upper() for value in twcid])
+        if(vehicleID != None):
+            conditions.append('vehicleID = ?')
+            params.append(str(vehicleID))
+        if(start != None):
+            conditions.append('start >= ?')
+            params.append(start)
+        if(end != None):
+            conditions.append('start < ?')
+            params.append(end)
+        if(day != None):
+            conditions.append('day = ?')
+            params.append(day)
+
+        if(len(conditions) == 0):
+            return ('', params)
+        return (' WHERE ' + ' AND '.join(conditions), params)
+
+#
+# End charging session classes
+#
+##############################
+
+
+
+##############################
+#
+# Begin car API rate limit classes
+#
+
+class TokenBucket:
+    # Allows bursts of up to capacity requests, refilled at perMinute requests
+    # per minute.
+    capacity = 0
+    refillPerSec = 0
+    tokens = 0
+    timeLastRefill = 0
+
+    def __init__(self, capacity, perMinute):
+        self.capacity = capacity
+        self.refillPerSec = perMinute / 60
+        self.tokens = capacity
+        self.timeLastRefill = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.timeLastRefill) * self.refillPerSec)
+        self.timeLastRefill = now
+
+    def has_token(self):
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    def secs_till_token(self):
+        self.refill()
+        if(self.tokens >= 1):
+            return 0
+        if(self.refillPerSec <= 0):
+            return carApiErrorRetryMins*60
+        return (1 - self.tokens) / self.refillPerSec
+
+
+class CircuitBreaker:
+    # A breaker is 'closed' while requests succeed. After failureThreshold
+    # failures in a row it 'open's and blocks requests for openSecs. After that,
+    # it's 'half-open' and lets one probe request through. If the probe
+    # succeeds the breaker closes, otherwise it opens again for twice as long,
+    # up to carApiBreakerMaxOpenMins.
+    name = ''
+    state = 'closed'
+    failureThreshold = 1
+    failures = 0
+    baseOpenSecs = 0
+    openSecs = 0
+    timeOpened = 0
+    probeInFlight = False
+    timeProbeSent = 0
+
+    # If nobody reports how a probe request went within this many seconds,
+    # assume it was lost and allow another.
+    probeTimeoutSecs = 120
+
+    def __init__(self, name, failureThreshold, openSecs):
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.baseOpenSecs = openSecs
+
+    def secs_till_closed(self):
+        # Seconds till this breaker lets a request through, or 0 if it would
+        # let one through now.
+        if(self.state == 'open'):
+            return max(0, self.openSecs - (time.time() - self.timeOpened))
+        if(self.state == 'half-open' and self.probeInFlight):
+            return max(0, self.probeTimeoutSecs - (time.time() - self.timeProbeSent))
+        return 0
+
+    def allow(self):
+        if(self.state == 'open'):
+            if(time.time() - self.timeOpened < self.openSecs):
+                return False
+
+            self.state = 'half-open'
+            self.probeInFlight = False
+            if(debugLevel >= 8):
+                print(time_now() + ': Car API breaker for ' + self.name
+                      + ' is half-open.  Sending probe request.')
+
+        if(self.state == 'half-open'):
+            if(self.probeInFlight
+               and time.time() - self.timeProbeSent < self.probeTimeoutSecs
+            ):
+                return False
+            self.probeInFlight = True
+            self.timeProbeSent = time.time()
+
+        return True
+
+    def success(self):
+        if(self.state != 'closed' and debugLevel >= 1):
+            print(time_now() + ': Car API breaker for ' + self.name + ' closed.')
+        self.state = 'closed'
+        self.failures = 0
+        self.openSecs = 0
+        self.probeInFlight = False
+
+    def failure(self, openSecs = None):
+        # openSecs overrides how long to stay open for errors that we know
+        # clear up sooner or later than usual.
+        self.failures += 1
+        self.probeInFlight = False
+
+        if(self.state == 'half-open' and openSecs == None):
+            openSecs = min(self.openSecs * 2, carApiBreakerMaxOpenMins*60)
+        elif(self.failures < self.failureThreshold and openSecs == None):
+            return
+        elif(openSecs == None):
+            openSecs = self.baseOpenSecs
+
+        self.state = 'open'
+        self.openSecs = openSecs
+        self.timeOpened = time.time()
+        if(debugLevel >= 1):
+            print(time_now() + ': Car API breaker for ' + self.name
+                  + ' open for ' + str(int(openSecs)) + ' seconds after '
+                  + str(self.failures) + ' failure(s).')
+
+#
+# End car API rate limit classes
+#
+##############################
+
+
+##############################
+#
+# Begin car API streaming class
+#
+
+class CarApiStream:
+    # Keeps one long-lived websocket connection open to the Tesla streaming
+    # API for a car and copies the location and power it reports into the
+    # CarApiVehicle as soon as they arrive. update_location() uses that instead
+    # of polling drive_state while the stream is fresh, and falls back to
+    # polling when it isn't.
+    #
+    # Each stream runs in its own thread because reading the socket blocks.
+    # The thread only ever assigns attributes of its vehicle, so it doesn't
+    # need to coordinate with background_tasks_thread.
+    #
+    # Set carApiStreamingURL to 'ws://127.0.0.1:8765/streaming/' to test
+    # against fakeTeslaStreaming.py instead of Tesla's servers.
+    vehicle = None
+    thread = None
+    sock = None
+    buffer = b''
+    stopEvent = None
+
+    # Seconds to wait before the next reconnect. Doubles after each failure up
+    # to carApiStreamingReconnectSecs[1] and goes back to
+    # carApiStreamingReconnectSecs[0] once the stream sends data again.
+    reconnectSecs = 0
+
+    timeLastData = 0
+
+    def __init__(self, vehicle):
+        global carApiStreamingReconnectSecs
+
+        self.vehicle = vehicle
+        self.stopEvent = threading.Event()
+        self.reconnectSecs = carApiStreamingReconnectSecs[0]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, args = ())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.close()
+
+    def fresh(self):
+        # Return True if the stream has sent data recently enough that we can
+        # trust what it told us about the car.
+        global carApiStreamingStaleSecs
+
+        return (time.time() - self.timeLastData < carApiStreamingStaleSecs)
+
+    def run(self):
+        global carApiBearerToken, carApiStreamingReconnectSecs
+
+        while(not self.stopEvent.is_set()):
+            if(carApiBearerToken == '' or self.vehicle.streamID == None):
+                # We can't subscribe until car_api_available() logs in and
+                # finds this car's vehicle_id.
+                self.stopEvent.wait(carApiStreamingReconnectSecs[1])
+                continue
+
+            try:
+                self.connect()
+                self.subscribe()
+                while(not self.stopEvent.is_set()):
+                    (opcode, payload) = self.recv_message()
+                    if(opcode == 0x8):
+                        if(debugLevel >= 8):
+                            print(time_now() + ': Car API stream for vehicle '
+                                  + str(self.vehicle.ID) + ' closed by server.')
+                        break
+                    if(self.handle_message(payload) == False):
+                        break
+            except (OSError, ValueError) as e:
+                # socket.timeout and ssl.SSLError are both subclasses of
+                # OSError.
+                if(debugLevel >= 1 and not self.stopEvent.is_set()):
+                    print(time_now() + ': Car API stream for vehicle '
+                          + str(self.vehicle.ID) + ' failed: ' + str(e))
+
+            self.close()
+            if(self.stopEvent.is_set()):
+                break
+
+            # Add some jitter so streams for several cars that failed at the
+            # same time don't all reconnect at once.
+            waitSecs = self.reconnectSecs * random.uniform(0.5, 1.0)
+            self.reconnectSecs = min(self.reconnectSecs * 2,
+                                     carApiStreamingReconnectSecs[1])
+            if(debugLevel >= 8):
+                print(time_now() + ': Reconnect car API stream for vehicle '
+                      + str(self.vehicle.ID) + ' in ' + str(int(waitSecs))
+                      + ' seconds.')
+            self.stopEvent.wait(waitSecs)
+
+    def connect(self):
+        global carApiStreamingURL, carApiStreamingStaleSecs
+
+        url = urllib.parse.urlsplit(carApiStreamingURL)
+        port = url.port
+        if(port == None):
+            port = (443 if url.scheme == 'wss' else 80)
+
+        # If we don't get any data for carApiStreamingStaleSecs, recv() raises
+        # socket.timeout and we reconnect.
+        self.sock = socket.create_connection((url.hostname, port),
+                                             carApiStreamingStaleSecs)
+        if(url.scheme == 'wss'):
+            self.sock = ssl.create_default_context().wrap_socket(self.sock,
+                                                  server_hostname = url.hostname)
+
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = 'GET ' + (url.path or '/') + ' HTTP/1.1\r\n' \
+                  'Host: ' + url.netloc + '\r\n' \
+                  'Upgrade: websocket\r\n' \
+                  'Connection: Upgrade\r\n' \
+                  'Sec-WebSocket-Key: ' + key + '\r\n' \
+                  'Sec-WebSocket-Version: 13\r\n\r\n'
+        self.sock.sendall(request.encode('ascii'))
+
+        response = b''
+        while(b'\r\n\r\n' not in response):
+            data = self.sock.recv(1024)
+            if(len(data) == 0 or len(response) > 8192):
+                raise ValueError('bad websocket handshake')
+            response += data
+
+        (header, self.buffer) = response.split(b'\r\n\r\n', 1)
+        lines = header.decode('latin-1').split('\r\n')
+        if(len(lines[0].split(' ')) < 2 or lines[0].split(' ')[1] != '101'):
+            raise ValueError('websocket handshake refused: ' + lines[0])
+
+        # The server proves it understood our handshake by hashing our key
+        # with a GUID from RFC 6455.
+        accept = base64.b64encode(hashlib.sha1((key
+                    + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('ascii')
+                 ).digest()).decode('ascii')
+        for line in lines[1:]:
+            (name, sep, value) = line.partition(':')
+            if(name.strip().lower() == 'sec-websocket-accept'
+               and value.strip() == accept
+            ):
+                break
+        else:
+            raise ValueError('bad Sec-WebSocket-Accept in websocket handshake')
+
+        if(debugLevel >= 8):
+            print(time_now() + ': Car API stream for vehicle ' + str(self.vehicle.ID)
+                  + ' connected to ' + carApiStreamingURL)
+
+    def close(self):
+        sock = self.sock
+        self.sock = None
+        self.buffer = b''
+        if(sock != None):
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def subscribe(self):
+        global carApiBearerToken, carApiStreamingColumns
+
+        msg = {
+            'msg_type': 'data:subscribe_oauth',
+            'token': carApiBearerToken,
+            'value': carApiStreamingColumns,
+            'tag': str(self.vehicle.streamID),
+        }
+        self.send_frame(0x1, json.dumps(msg).encode('utf-8'))
+
+    def send_frame(self, opcode, payload):
+        # Frames from a client must be masked, so the mask key is always sent.
+        header = bytearray([0x80 | opcode])
+        if(len(payload) < 126):
+            header.append(0x80 | len(payload))
+        elif(len(payload) < 0x10000):
+            header.append(0x80 | 126)
+            header += struct.pack('>H', len(payload))
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack('>Q', len(payload))
+
+        mask = os.urandom(4)
+        masked = bytearray(payload)
+        for i in range(0, len(masked)):
+            masked[i] ^= mask[i % 4]
+
+        self.sock.sendall(bytes(header) + mask + bytes(masked))
+
+    def recv_exact(self, numBytes):
+        while(len(self.buffer) < numBytes):
+            data = self.sock.recv(4096)
+            if(len(data) == 0):
+                raise ValueError('connection closed')
+            self.buffer += data
+
+        data = self.buffer[0:numBytes]
+        self.buffer = self.buffer[numBytes:]
+        return data
+
+    def recv_message(self):
+        # Return (opcode, payload) of the next complete text, binary, or close
+        # message. Fragments are joined and pings are answered here.
+        msgOpcode = None
+        fragments = []
+        while(True):
+            (byte0, byte1) = self.recv_exact(2)
+            opcode = byte0 & 0x0F
+            length = byte1 & 0x7F
+            if(length == 126):
+                length = struct.unpack('>H', self.recv_exact(2))[0]
+            elif(length == 127):
+                length = struct.unpack('>Q', self.recv_exact(8))[0]
+            if(length > 0x100000):
+                raise ValueError('websocket frame of ' + str(length) + ' bytes is too big')
+
+            mask = None
+            if(byte1 & 0x80):
+                mask = self.recv_exact(4)
+            payload = bytearray(self.recv_exact(length))
+            if(mask != None):
+                for i in range(0, len(payload)):
+                    payload[i] ^= mask[i % 4]
+
+            if(opcode == 0x9):
+                self.send_frame(0xA, bytes(payload))
+                continue
+            if(opcode == 0xA):
+                continue
+            if(opcode == 0x8):
+                return (opcode, bytes(payload))
+
+            if(opcode != 0x0):
+                msgOpcode = opcode
+                fragments = []
+            fragments.append(bytes(payload))
+            if(byte0 & 0x80 and msgOpcode != None):
+                return (msgOpcode, b''.join(fragments))
+
+    def handle_message(self, payload):
+        # Return False if we should drop the connection and subscribe again.
+        global carApiStreamingColumns, carApiStreamingReconnectSecs
+
+        try:
+            msg = json.loads(payload.decode('utf-8'))
+            msgType = msg['msg_type']
+        except (ValueError, KeyError, TypeError):
+            if(debugLevel >= 1):
+                print(time_now() + ': Car API stream for vehicle ' + str(self.vehicle.ID)
+                      + ' sent unexpected message ' + str(payload[0:200]))
+            return True
+
+        if(debugLevel >= 11):
+            print(time_now() + ': Car API stream message', msg)
+
+        if(msgType == 'data:update'):
+            # value is a comma-separated list of a timestamp in ms followed by
+            # the columns we subscribed to. Columns the car doesn't know right
+            # now are empty.
+            columns = ['timestamp'] + carApiStreamingColumns.split(',')
+            values = dict(zip(columns, str(msg.get('value', '')).split(',')))
+
+            try:
+                lat = float(values['est_lat'])
+                lon = float(values['est_lng'])
+                self.vehicle.lat = lat
+                self.vehicle.lon = lon
+                self.vehicle.timeLocationUpdated = time.time()
+            except (KeyError, ValueError):
+                pass
+
+            try:
+                # Power in kW. It's negative while the car is charging or
+                # regenerating.
+                self.vehicle.streamPower = float(values['power'])
+            except (KeyError, ValueError):
+                pass
+            self.vehicle.streamShiftState = values.get('shift_state', '')
+
+            self.timeLastData = time.time()
+            self.reconnectSecs = carApiStreamingReconnectSecs[0]
+        elif(msgType == 'data:error'):
+            # The stream sends 'vehicle_disconnected' when the car stops
+            # streaming, for example because it fell asleep. We have to
+            # subscribe again to get more data.
+            if(debugLevel >= 8 or (debugLevel >= 1
+               and msg.get('error_type') != 'vehicle_disconnected')
+            ):
+                print(time_now() + ': Car API stream for vehicle ' + str(self.vehicle.ID)
+                      + " returned error '" + str(msg.get('error_type')) + "': "
+                      + str(msg.get('value')))
+            return False
+
+        # Ignore other messages like 'control:hello'.
+        return True
+
+#
+# End car API streaming class
+#
+##############################
+
+
+
+##############################
+#
+# Begin sampling profiler class
+#
+
+class SamplingProfiler:
+    # Finds where our CPU time goes without stopping us. While running, a
+    # thread wakes every intervalSecs, looks at what every other thread is
+    # doing with sys._current_frames(), and counts each stack it sees. When
+    # it's done, it writes the counts in the collapsed stack format read by
+    # flamegraph.pl and speedscope:
+    #   MainThread;<module> (simpleTWCcontrol.py:8101);send_msg (simpleTWCcontrol.py:627) 42
+    #
+    # Functions are labelled with the line they start on, so every call to one
+    # adds up to one frame. The main loop is all in <module>, which would then
+    # be a single frame, so <module> frames and the frame we're sampling in are
+    # labelled with the line being run.
+    #
+    # When it isn't running, there's no thread and no cost at all.
+    #
+    # Start and stop it with 'kill -USR2 <pid>', or the control API's profile
+    # and profileStop commands.
+    thread = None
+    stopEvent = None
+    fileNamePrefix = None
+
+    def __init__(self, fileNamePrefix):
+        self.fileNamePrefix = fileNamePrefix
+        self.stopEvent = threading.Event()
+
+    def running(self):
+        return self.thread != None and self.thread.is_alive()
+
+    def start(self, secs, intervalSecs):
+        if(self.running()):
+            return False
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, args = (secs, intervalSecs),
+                                       name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        # Stop early. The samples taken so far are still written.
+        self.stopEvent.set()
+
+    def run(self, secs, intervalSecs):
+        myID = threading.get_ident()
+        counts = {}
+        numSamples = 0
+        print(time_now() + ": Profiling for %d seconds." % (secs))
+
+        timeEnd = time.time() + secs
+        while(time.time() < timeEnd and not self.stopEvent.wait(intervalSecs)):
+            names = {}
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for (threadID, frame) in sys._current_frames().items():
+                if(threadID == myID):
+                    continue
+                stack = []
+                while(frame != None):
+                    code = frame.f_code
+                    if(len(stack) == 0 or code.co_name == '<module>'):
+                        lineNum = frame.f_lineno
+                    else:
+                        lineNum = code.co_firstlineno
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                                 os.path.basename(code.co_filename), lineNum))
+                    frame = frame.f_back
+                stack.append(names.get(threadID, 'thread-' + str(threadID)))
+                stack = ';'.join(reversed(stack))
+                counts[stack] = counts.get(stack, 0) + 1
+            numSamples += 1
+
+        fileName = self.fileNamePrefix + time.strftime('-%Y%m%d-%H%M%S.txt')
+        try:
+            fh = open(fileName, 'w')
+            for (stack, count) in sorted(counts.items()):
+                fh.write(stack + ' ' + str(count) + '\n')
+            fh.close()
+            print(time_now() + ": Wrote %d profile samples to %s." % (numSamples, fileName))
+        except OSError as e:
+            print(time_now() + ": ERROR: Can't write profile " + fileName + ": " + str(e))
+
+#
+# End sampling profiler class
+#
+##############################
+
+
+
+##############################
+#
+# Begin log writer class
+#
+
+class LogBytes:
+    # Wraps a bytes arg to log() so %s prints it the way hex_str() does and %r
+    # prints it as usual.
+    data = None
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return hex_str(self.data)
+
+    def __repr__(self):
+        return repr(self.data)
+
+class LogWriter:
+    # Prints log messages from a thread of its own, so a slow stdout (an SSH
+    # session, journald, a full pipe) can't hold up heartbeats on the main
+    # thread.
+    #
+    # log() appends (seq, time, format, args) to self.events without
+    # formatting anything. deque.append() and popleft() are atomic, so the
+    # main thread never waits on a lock. This thread wakes every flushSecs,
+    # formats whatever is waiting, and writes it in one go to stdout and, if
+    # fileName is set, to fileName. When fileName grows past maxBytes, it's
+    # renamed to fileName.1.gz (compressed here, not on the main thread) and
+    # older copies move up to fileName.<numBackups>.gz.
+    #
+    # If we can't write as fast as messages come in, we keep the newest
+    # maxEvents. self.events has a maxlen of maxEvents, so append() drops the
+    # oldest event itself. seq comes from seqCounter, which any thread can
+    # take the next number from without a lock, so this thread counts how
+    # many we dropped from the gaps in seq.
+    #
+    # Messages printed with print() instead of log() go straight to stdout,
+    # so they can appear up to flushSecs ahead of log() messages queued
+    # before them.
+    events = None
+    maxEvents = 0
+    seqCounter = None
+    lastSeq = 0
+    numDropped = 0
+    flushSecs = 0
+    fileName = ''
+    maxBytes = 0
+    numBackups = 0
+    fh = None
+    thread = None
+    stopEvent = None
+
+    # Formatting a time with strftime is slow, so we only do it once a
+    # second.
+    cachedSecond = None
+    cachedTimeStr = ''
+
+    def __init__(self, maxEvents, flushSecs, fileName, maxBytes, numBackups):
+        self.events = collections.deque(maxlen=maxEvents)
+        self.maxEvents = maxEvents
+        self.seqCounter = itertools.count(1)
+        self.flushSecs = flushSecs
+        self.fileName = fileName
+        self.maxBytes = maxBytes
+        self.numBackups = numBackups
+        self.stopEvent = threading.Event()
+
+    def start(self):
+        if(self.fileName != ''):
+            self.fh = open(self.fileName, 'a')
+        self.thread = threading.Thread(target=self.run, args = (), name='logWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # Write everything still waiting and stop the thread.
+        if(self.thread == None):
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+        if(self.fh != None):
+            self.fh.close()
+            self.fh = None
+
+    def run(self):
+        while(not self.stopEvent.wait(self.flushSecs)):
+            self.write_events()
+        self.write_events()
+
+    def format_time(self, eventTime):
+        second = int(eventTime)
+        if(second != self.cachedSecond):
+            self.cachedSecond = second
+            self.cachedTimeStr = time.strftime('%H:%M:%S', time.localtime(second))
+        if(displayMilliseconds):
+            return self.cachedTimeStr + '.%06d' % ((eventTime - second) * 1000000)
+        return self.cachedTimeStr
+
+    def format_event(self, event):
+        (seq, eventTime, fmt, args) = event
+        if(len(args) > 0):
+            fmt = fmt % tuple((LogBytes(arg) if isinstance(arg, bytes) else arg)
+                              for arg in args)
+        return self.format_time(eventTime) + fmt + '\n'
+
+    def write_events(self):
+        lines = []
+        events = self.events
+        while(len(events) > 0):
+            event = events.popleft()
+            seq = event[0]
+            if(seq > self.lastSeq):
+                # Events between the last one we saw and this one were pushed
+                # out of the full deque.
+                self.numDropped += seq - self.lastSeq - 1
+                self.lastSeq = seq
+            else:
+                # Another thread queued this event just after one with a
+                # higher seq, so we counted it as dropped when we saw that one.
+                self.numDropped -= 1
+            try:
+                lines.append(self.format_event(event))
+            except (TypeError, ValueError) as e:
+                lines.append(self.format_time(event[1]) + ': ERROR: Bad log message '
+                             + repr(event[2]) + ': ' + str(e) + '\n')
+        if(self.numDropped > 0):
+            lines.append(self.format_time(time.time()) + ': WARNING: Dropped %d log '
+                         'messages because we could not write them fast enough.\n'
+                         % (self.numDropped))
+            self.numDropped = 0
+        if(len(lines) == 0):
+            return
+
+        text = ''.join(lines)
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except OSError:
+            pass
+        if(self.fh != None):
+            try:
+                self.fh.write(text)
+                self.fh.flush()
+                if(self.fh.tell() >= self.maxBytes):
+                    self.rotate()
+            except OSError as e:
+                sys.stdout.write(self.format_time(time.time()) + ': ERROR: Can\'t write '
+                                 + self.fileName + ': ' + str(e) + '\n')
+
+    def rotate(self):
+        self.fh.close()
+        for i in range(self.numBackups - 1, 0, -1):
+            try:
+                os.replace(self.fileName + '.' + str(i) + '.gz',
+                           self.fileName + '.' + str(i + 1) + '.gz')
+            except FileNotFoundError:
+                pass
+        if(self.numBackups > 0):
+            with open(self.fileName, 'rb') as fhIn:
+                with gzip.open(self.fileName + '.1.gz.tmp', 'wb') as fhOut:
+                    shutil.copyfileobj(fhIn, fhOut)
+            os.replace(self.fileName + '.1.gz.tmp', self.fileName + '.1.gz')
+        self.fh = open(self.fileName, 'w')
+
+#
+# End log writer class
+#
+##############################
+
+
+
+##############################
+#
+# Begin loop timer class
+#
+
+class LoopTimer:
+    # Times each stage of the main loop so a stall shows up as a stall in a
+    # named stage instead of a mysterious slave timeout.
+    #
+    # The main loop calls next_iteration() at the top of each pass, then
+    # enter('stage') as it moves from one stage to the next. Time is charged
+    # to whichever stage we're in, so there's no 'end' call to forget before a
+    # 'continue'. enter() returns the stage we were in so code like
+    # print_status that runs in the middle of another stage can charge its
+    # time separately and then go back:
+    #   stage = loopTimer.enter('print')
+    #   ...
+    #   loopTimer.enter(stage)
+    #
+    # An enter() costs one time.monotonic() call and a dict update. Stage
+    # times go to the loop_stage_seconds histogram once per iteration. If a
+    # whole iteration takes longer than budgetSecs, we print where the time
+    # went.
+    budgetSecs = 0
+    stage = None
+    timeIterationStart = 0
+    timeStageStart = 0
+
+    # stageSecs[stage] is the time spent in stage so far this iteration.
+    stageSecs = None
+
+    def __init__(self, budgetSecs):
+        self.budgetSecs = budgetSecs
+        self.stageSecs = {}
+
+    def enter(self, stage):
+        now = time.monotonic()
+        prevStage = self.stage
+        if(prevStage != None):
+            self.stageSecs[prevStage] = self.stageSecs.get(prevStage, 0) \
+                                        + now - self.timeStageStart
+        self.stage = stage
+        self.timeStageStart = now
+        return prevStage
+
+    def next_iteration(self, stage = 'sleep'):
+        self.enter(stage)
+        now = self.timeStageStart
+        if(self.timeIterationStart > 0):
+            self.finish_iteration(now - self.timeIterationStart)
+        self.timeIterationStart = now
+        self.stageSecs = {}
+
+    def finish_iteration(self, iterationSecs):
+        for stage, secs in self.stageSecs.items():
+            metrics.observe('loop_stage_seconds', secs, {'stage': stage})
+        metrics.observe('loop_iteration_seconds', iterationSecs)
+
+        if(self.budgetSecs > 0 and iterationSecs > self.budgetSecs):
+            metrics.inc('loop_lag_total')
+            if(debugLevel >= 1):
+                log(1, ": WARNING: Main loop took %dms (budget %dms): %s",
+                    iterationSecs * 1000, self.budgetSecs * 1000,
+                    ', '.join('%s %dms' % (stage, secs * 1000) for (stage, secs)
+                              in sorted(self.stageSecs.items(),
+                                        key=lambda item: item[1], reverse=True)))
+
+#
+# End loop timer class
+#
+##############################
+
+
+
+##############################
+#
+# Begin bus timing class
+#
+
+class BusTiming:
+    # Measures how long each slave takes to answer us and how the bus is used
+    # between messages, so heartbeat spacing can be tuned to the slowest TWC on
+    # the bus instead of guessed.
+    #
+    # We can't see bytes on the wire, only how many are waiting in the serial
+    # driver's buffer. So poll() is called with ser.inWaiting() whenever we
+    # check it, and we remember when the buffer grew. read() then tells us
+    # when each byte we read actually arrived, even if it sat in the buffer
+    # while we slept. Arrival times are only as good as how often we poll,
+    # which is why wait() polls every busPollSecs while we give a slave time
+    # to respond.
+    #
+    # Our own last TX byte isn't timed by ser.write(), which returns as soon
+    # as the message is queued. We work it out from the message length and
+    # baud rate instead.
+    #
+    # All times are time.monotonic().
+    secsPerByte = 0
+    timeTxStart = 0
+    timeTxEnd = 0
+
+    # Bytes we've read from the serial port, and bytes we've seen arrive.
+    rxBytesRead = 0
+    rxBytesArrived = 0
+
+    # arrivals is a deque of (rxBytesArrived, time) for each poll() that saw
+    # new bytes. A byte arrived at the time of the first entry whose count
+    # includes it.
+    arrivals = None
+
+    # When the last message on the bus ended, sent by us or anyone else.
+    timeLastFrameEnd = 0
+
+    # pendingResponses[TWCID] is (timeTxEnd, timeNextTx) for a message we sent
+    # that TWCID and haven't heard an answer to. timeNextTx is when we plan to
+    # transmit next. An answer still arriving then will collide with it.
+    pendingResponses = None
+    timeLastCollisionWarning = None
+
+    def __init__(self, baud):
+        # Each byte is a start bit, 8 data bits, and a stop bit.
+        self.secsPerByte = 10 / baud
+        # We read everything that arrives within a few trips through the main
+        # loop, so this is only a limit if something goes badly wrong.
+        self.arrivals = collections.deque(maxlen=4096)
+        self.pendingResponses = {}
+        self.timeLastCollisionWarning = {}
+
+    def tx(self, numBytes):
+        now = time.monotonic()
+        # If our last message is still going out, this one waits behind it.
+        self.timeTxStart = max(now, self.timeTxEnd)
+        self.timeTxEnd = self.timeTxStart + numBytes * self.secsPerByte
+        self.timeLastFrameEnd = self.timeTxEnd
+
+    def expect_response(self, TWCID, nextTxSecs):
+        # Call after sending TWCID a message it should answer. nextTxSecs is
+        # how long after this message we'll transmit again.
+        self.pendingResponses[bytes(TWCID)] = (self.timeTxEnd,
+                                               self.timeTxStart + nextTxSecs)
+
+    def poll(self, numBytesWaiting):
+        arrived = self.rxBytesRead + numBytesWaiting
+        if(arrived > self.rxBytesArrived):
+            self.rxBytesArrived = arrived
+            self.arrivals.append((arrived, time.monotonic()))
+
+    def read(self, numBytes):
+        # Return when the last of numBytes just read from the port arrived.
+        self.rxBytesRead += numBytes
+        arrivals = self.arrivals
+        while(len(arrivals) > 0 and arrivals[0][0] < self.rxBytesRead):
+            arrivals.popleft()
+        if(len(arrivals) == 0):
+            # The byte arrived without poll() seeing it, so the best we can
+            # say is it's here now.
+            self.rxBytesArrived = self.rxBytesRead
+            return time.monotonic()
+        return arrivals[0][1]
+
+    def wait(self, secs):
+        # Sleep for secs, but keep an eye on the serial port so we know when
+        # bytes arrive.
+        timeEnd = time.monotonic() + secs
+        while True:
+            self.poll(ser.inWaiting())
+            timeLeft = timeEnd - time.monotonic()
+            if(timeLeft <= 0):
+                break
+            time.sleep(min(timeLeft, busPollSecs))
+
+    def frame(self, TWCID, timeFirstByte, timeLastByte):
+        # Record a good message from TWCID that started arriving at
+        # timeFirstByte and finished at timeLastByte.
+        labels = {'twcid': '%02X%02X' % (TWCID[0], TWCID[1])}
+        metrics.observe('twc_frame_seconds', timeLastByte - timeFirstByte, labels)
+        if(self.timeLastFrameEnd > 0):
+            metrics.observe('twc_interframe_gap_seconds',
+                            max(0, timeFirstByte - self.timeLastFrameEnd), labels)
+        self.timeLastFrameEnd = timeLastByte
+
+        try:
+            (timeTxEnd, timeNextTx) = self.pendingResponses.pop(bytes(TWCID))
+        except KeyError:
+            return
+        metrics.observe('twc_heartbeat_latency_seconds',
+                        max(0, timeFirstByte - timeTxEnd), labels)
+        if(timeLastByte >= timeNextTx - busCollisionMarginSecs):
+            metrics.inc('twc_response_collisions_total', labels)
+            busHealth.count('collisions', TWCID)
+            if(debugLevel >= 1
+               and timeLastByte - self.timeLastCollisionWarning.get(labels['twcid'], -60) >= 60
+            ):
+                self.timeLastCollisionWarning[labels['twcid']] = timeLastByte
+                log(1, ": WARNING: TWC %s took %dms to finish answering us, which "
+                    "is too close to our next message %dms later.  Consider "
+                    "raising heartbeatSecs.", labels['twcid'],
+                    (timeLastByte - timeTxEnd) * 1000,
+                    (timeNextTx - timeTxEnd) * 1000)
+
+#
+# End bus timing class
+#
+##############################
+
+
+
+##############################
+#
+# Begin bus health class
+#
+
+class BusHealth:
+    # Counts everything that goes wrong on the RS485 bus, per window of
+    # windowSecs and per TWC where we can tell who sent it, and turns that into
+    # a score from 0 to 100 with a guess at the cause.
+    #
+    # We keep the last numWindows windows in a ring, plus running totals over
+    # the ring so status() costs the same no matter how many windows we keep.
+    #
+    # The two common problems look different:
+    #   - Missing termination or bias resistors leave the bus floating while no
+    #     one is talking, so we see noise bytes between messages, messages that
+    #     never end, and garbled DB escapes.
+    #   - Collisions happen when two TWCs talk at once, so one message is cut
+    #     short by the C0 of another, or a slave's answer runs into our next
+    #     message.
+    # Checksum errors happen either way and count against the score but not
+    # toward the diagnosis.
+    kinds = ('frames', 'noiseBytes', 'noiseBursts', 'shortFrames',
+             'checksumErrors', 'badLengths', 'badEscapes', 'rxTimeouts',
+             'collisions', 'unknown')
+    noiseKinds = ('noiseBursts', 'badLengths', 'badEscapes', 'rxTimeouts')
+    collisionKinds = ('shortFrames', 'collisions')
+    errorKinds = noiseKinds + collisionKinds + ('checksumErrors',)
+
+    windowSecs = 0
+    maxTWCs = 0
+    maxUnknownKinds = 0
+
+    # windows is a deque of dicts with an entry for each of kinds, plus
+    # 'start', 'twcs' ({'TWCID hex': {kind: count}}) and 'unknownOpcodes'
+    # ({'opcode hex': count}).
+    windows = None
+    window = None
+    totals = None
+    twcTotals = None
+
+    def __init__(self, windowSecs, numWindows, maxTWCs, maxUnknownKinds):
+        self.windowSecs = windowSecs
+        self.maxTWCs = maxTWCs
+        self.maxUnknownKinds = maxUnknownKinds
+        self.windows = collections.deque(maxlen=numWindows)
+        self.totals = dict.fromkeys(self.kinds, 0)
+        self.twcTotals = {}
+        self.new_window(time.time())
+
+    def new_window(self, start):
+        if(len(self.windows) == self.windows.maxlen):
+            # Forget the oldest window.
+            oldWindow = self.windows[0]
+            for kind in self.kinds:
+                self.totals[kind] -= oldWindow[kind]
+            for twcid, counts in oldWindow['twcs'].items():
+                twcTotals = self.twcTotals[twcid]
+                for kind, count in counts.items():
+                    twcTotals[kind] -= count
+                if(sum(twcTotals.values()) <= 0):
+                    del self.twcTotals[twcid]
+        self.window = dict.fromkeys(self.kinds, 0)
+        self.window['start'] = start
+        self.window['twcs'] = {}
+        self.window['unknownOpcodes'] = {}
+        self.windows.append(self.window)
+
+    def check_window(self, now):
+        if(now - self.window['start'] < self.windowSecs):
+            return
+        self.print_window()
+        # If nothing at all happened for a while, fill the ring with empty
+        # windows for that time.
+        numWindows = int((now - self.window['start']) // self.windowSecs)
+        start = self.window['start'] + numWindows * self.windowSecs
+        for i in range(min(numWindows, self.windows.maxlen) - 1, 0, -1):
+            self.new_window(start - i * self.windowSecs)
+        self.new_window(start)
+
+    def count(self, kind, TWCID = None, n = 1):
+        self.check_window(time.time())
+        self.window[kind] += n
+        self.totals[kind] += n
+        if(TWCID == None):
+            return
+
+        twcid = '%02X%02X' % (TWCID[0], TWCID[1])
+        twcs = self.window['twcs']
+        if(twcid not in twcs):
+            if(twcid not in self.twcTotals and len(self.twcTotals) >= self.maxTWCs):
+                # Corrupt messages can claim to be from any TWCID. Don't let
+                # them grow our tables without limit.
+                return
+            twcs[twcid] = {}
+        twcs[twcid][kind] = twcs[twcid].get(kind, 0) + n
+        twcTotals = self.twcTotals.setdefault(twcid, {'frames': 0})
+        twcTotals[kind] = twcTotals.get(kind, 0) + n
+
+    def unknown(self, msg, TWCID = None):
+        # Count a message we didn't recognize. Return True the first time we
+        # see its opcode in this window so the caller can print it. Repeats
+        # are summed up by print_window().
+        self.count('unknown', TWCID)
+        opcode = '%02X%02X' % (msg[0], msg[1])
+        unknown = self.window['unknownOpcodes']
+        if(opcode in unknown):
+            unknown[opcode] += 1
+            return False
+        if(len(unknown) >= self.maxUnknownKinds):
+            opcode = 'other'
+        unknown[opcode] = unknown.get(opcode, 0) + 1
+        return unknown[opcode] == 1
+
+    def score(self, counts):
+        # Return the percent of messages that arrived intact.
+        numErrors = sum(counts.get(kind, 0) for kind in self.errorKinds)
+        numFrames = counts.get('frames', 0)
+        if(numFrames + numErrors == 0):
+            return 100
+        return int(100 * numFrames / (numFrames + numErrors))
+
+    def diagnosis(self, counts):
+        if(self.score(counts) >= 99):
+            return 'ok'
+        if(sum(counts.get(kind, 0) for kind in self.noiseKinds)
+           >= sum(counts.get(kind, 0) for kind in self.collisionKinds)):
+            return 'noise'
+        return 'collisions'
+
+    def status(self):
+        # Return the score, diagnosis, and counts over every window we have.
+        twcs = {}
+        for twcid, counts in self.twcTotals.items():
+            twcs[twcid] = dict(counts)
+            twcs[twcid]['score'] = self.score(counts)
+        return {
+            'score': self.score(self.totals),
+            'diagnosis': self.diagnosis(self.totals),
+            'secs': self.windowSecs * len(self.windows),
+            'totals': dict(self.totals),
+            'twcs': twcs,
+            'windows': [dict((kind, window[kind]) for kind in self.kinds + ('start',))
+                        for window in self.windows],
+        }
+
+    def print_window(self):
+        window = self.window
+        numErrors = sum(window[kind] for kind in self.errorKinds) + window['unknown']
+        if(debugLevel < 1 or numErrors == 0):
+            return
+
+        diagnosis = self.diagnosis(window)
+        log(1, ": Bus health over %d seconds: score %d (%s), %d messages, "
+            "%d noise bytes in %d bursts, %d short, %d bad checksum, %d bad length, "
+            "%d bad escape, %d timed out, %d collided, %d unknown%s",
+            self.windowSecs, self.score(window),
+            {'ok': 'ok', 'noise': 'check termination and bias resistors',
+             'collisions': 'TWCs talking over each other'}[diagnosis],
+            window['frames'], window['noiseBytes'], window['noiseBursts'],
+            window['shortFrames'], window['checksumErrors'], window['badLengths'],
+            window['badEscapes'], window['rxTimeouts'], window['collisions'],
+            window['unknown'],
+            ''.join(' %s x%d' % (opcode, count) for (opcode, count)
+                    in sorted(window['unknownOpcodes'].items())))
+
+#
+# End bus health class
+#
+##############################
+
+
+
+##############################
+#
+# Begin memory monitor class
+#
+
+class MemoryMonitor:
+    # Keeps an eye on how much memory we use, so slow growth shows up in
+    # months-old graphs instead of as the kernel's OOM killer stopping us in
+    # the middle of a charge.
+    #
+    # sample() runs as a background task every memoryStatsSecs. It reads our
+    # RSS from /proc/self/statm, gc's counts, and the size of every
+    # collection registered with watch(). Results go to the memory metrics
+    # and the control API's getMemory command. We warn when RSS passes
+    # rssWarnBytes, or grows more than growthWarnBytes past what we used
+    # baselineSecs after starting.
+    #
+    # To find what's growing, the memoryTraceStart control command starts
+    # tracemalloc and takes a baseline snapshot, and memoryTraceDiff reports
+    # the source lines that allocated the most since then. Tracing slows every
+    # allocation and costs memory of its own, so it's off until asked for, and
+    # snapshots are taken on a background thread.
+    rssWarnBytes = 0
+    growthWarnBytes = 0
+    baselineSecs = 0
+    timeStart = 0
+    timeLastWarning = 0
+    rssBaseline = 0
+
+    # sizeFuncs[name] returns the size of a collection we keep an eye on.
+    sizeFuncs = None
+
+    # The last sample() and trace_diff() results.
+    stats = None
+    traceDiff = None
+    traceBaseline = None
+
+    def __init__(self, rssWarnBytes, growthWarnBytes, baselineSecs):
+        self.rssWarnBytes = rssWarnBytes
+        self.growthWarnBytes = growthWarnBytes
+        self.baselineSecs = baselineSecs
+        self.timeStart = time.time()
+        self.sizeFuncs = {}
+        self.stats = {}
+        self.traceDiff = []
+
+    def watch(self, name, func):
+        self.sizeFuncs[name] = func
+
+    def rss_bytes(self):
+        try:
+            fh = open('/proc/self/statm', 'r')
+            pages = int(fh.read().split()[1])
+            fh.close()
+            return pages * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def sample(self):
+        now = time.time()
+        rss = self.rss_bytes()
+        if(self.rssBaseline == 0 and now - self.timeStart >= self.baselineSecs):
+            self.rssBaseline = rss
+
+        sizes = {}
+        for name, func in list(self.sizeFuncs.items()):
+            try:
+                sizes[name] = func()
+            except Exception:
+                # A collection can change size while we look at it from this
+                # thread. We'll get it next time.
+                pass
+
+        gcStats = gc.get_stats()
+        stats = {
+            'time': now,
+            'rssBytes': rss,
+            'rssBaselineBytes': self.rssBaseline,
+            'gcCounts': list(gc.get_count()),
+            'gcCollections': [generation['collections'] for generation in gcStats],
+            'gcCollected': [generation['collected'] for generation in gcStats],
+            'gcUncollectable': len(gc.garbage),
+            'sizes': sizes,
+        }
+        self.stats = stats
+
+        metrics.set('process_resident_memory_bytes', rss)
+        metrics.set('python_gc_uncollectable_objects', len(gc.garbage))
+        for i in range(0, len(gcStats)):
+            metrics.set('python_gc_collections_total', gcStats[i]['collections'],
+                        {'generation': str(i)})
+        for name, size in sizes.items():
+            metrics.set('collection_size', size, {'name': name})
+
+        log(2, ": Memory: RSS %dKB, gc counts %s, collections %s",
+            rss / 1024, stats['gcCounts'],
+            ', '.join('%s %d' % (name, size) for (name, size) in sorted(sizes.items())))
+
+        if((rss > self.rssWarnBytes
+            or (self.rssBaseline > 0 and rss - self.rssBaseline > self.growthWarnBytes))
+           and now - self.timeLastWarning >= 3600
+        ):
+            self.timeLastWarning = now
+            log(1, ": WARNING: Using %dKB of memory, baseline %dKB.  Largest "
+                "collections: %s.  Use the control API's memoryTraceStart and "
+                "memoryTraceDiff commands to find what's growing.",
+                rss / 1024, self.rssBaseline / 1024,
+                ', '.join('%s %d' % (name, size) for (name, size)
+                          in sorted(sizes.items(), key=lambda item: item[1],
+                                    reverse=True)[0:5]))
+        return stats
+
+    def trace_start(self, numFrames):
+        if(not tracemalloc.is_tracing()):
+            tracemalloc.start(numFrames)
+        self.traceBaseline = tracemalloc.take_snapshot()
+        self.traceDiff = []
+        log(1, ": Memory tracing started with %d frames per allocation.", numFrames)
+
+    def trace_diff(self, limit):
+        if(self.traceBaseline == None):
+            log(1, ": ERROR: Use memoryTraceStart before memoryTraceDiff.")
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        self.traceDiff = [{
+                'file': stat.traceback[0].filename,
+                'line': stat.traceback[0].lineno,
+                'sizeBytes': stat.size,
+                'sizeDiffBytes': stat.size_diff,
+                'countDiff': stat.count_diff,
+            } for stat in snapshot.compare_to(self.traceBaseline, 'lineno')[0:limit]]
+        for entry in self.traceDiff:
+            log(1, ": Memory grew %+dKB (%+d blocks) at %s:%d",
+                entry['sizeDiffBytes'] / 1024, entry['countDiff'],
+                entry['file'], entry['line'])
+
+    def trace_stop(self):
+        self.traceBaseline = None
+        tracemalloc.stop()
+        log(1, ": Memory tracing stopped.")
+
+    def status(self):
+        return {
+            'stats': self.stats,
+            'tracing': tracemalloc.is_tracing(),
+            'traceDiff': self.traceDiff,
+        }
+
+#
+# End memory monitor class
+#
+##############################
+
+
+
+##############################
+#
+# Begin metrics classes
+#
+
+class Metrics:
+    # Counters, gauges, and histograms we export in Prometheus text format so
+    # bus, control, and car API health can be graphed over months without
+    # scraping logs. See MetricsHTTPHandler.
+    #
+    # Metrics are updated from the main thread and background threads, so
+    # every update takes self.lock. It's almost never contended, so an update
+    # costs well under a microsecond.
+    #
+    # labels is a dict like {'opcode': 'FDE0'}, or None.
+    #
+    # Labels can come from what TWCs send us, and a corrupt message with a good
+    # checksum can claim any opcode or TWCID. So each metric keeps at most
+    # maxSeries sets of labels, and updates for new ones past that are
+    # dropped and counted in numDropped.
+    defaultBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    maxSeries = 256
+    numDropped = 0
+
+    lock = None
+
+    # types[name] is (type, help, buckets). values[name][labelKey] is a number
+    # for counters and gauges, or [bucket counts, sum, count] for histograms.
+    # gaugeFuncs[name] is a function called at scrape time that returns the
+    # value.
+    types = None
+    values = None
+    gaugeFuncs = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        self.gaugeFuncs = {}
+
+    def describe(self, name, metricType, help, buckets = None):
+        self.types[name] = (metricType, help,
+                            (buckets if buckets != None else self.defaultBuckets))
+        self.values[name] = {}
+
+    def gauge_func(self, name, help, func):
+        self.describe(name, 'gauge', help)
+        self.gaugeFuncs[name] = func
+
+    def label_key(self, labels):
+        if(labels == None):
+            return ()
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels = None, value = 1):
+        key = self.label_key(labels)
+        self.lock.acquire()
+        values = self.values[name]
+        if(key in values):
+            values[key] += value
+        elif(len(values) < self.maxSeries):
+            values[key] = value
+        else:
+            self.numDropped += 1
+        self.lock.release()
+
+    def set(self, name, value, labels = None):
+        key = self.label_key(labels)
+        self.lock.acquire()
+        values = self.values[name]
+        if(key in values or len(values) < self.maxSeries):
+            values[key] = value
+        else:
+            self.numDropped += 1
+        self.lock.release()
+
+    def observe(self, name, value, labels = None):
+        key = self.label_key(labels)
+        buckets = self.types[name][2]
+        self.lock.acquire()
+        try:
+            histogram = self.values[name][key]
+        except KeyError:
+            if(len(self.values[name]) >= self.maxSeries):
+                self.numDropped += 1
+                self.lock.release()
+                return
+            histogram = [[0] * len(buckets), 0.0, 0]
+            self.values[name][key] = histogram
+        for i in range(0, len(buckets)):
+            if(value <= buckets[i]):
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+        self.lock.release()
+
+    @staticmethod
+    def format_labels(labelKey, extra = ()):
+        labelKey = tuple(labelKey) + tuple(extra)
+        if(len(labelKey) == 0):
+            return ''
+        return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                           .replace('"', '\\"').replace('\n', '\\n'))
+                              for (name, value) in labelKey) + '}'
+
+    def render(self):
+        # Return every metric in Prometheus text exposition format.
+        funcValues = {}
+        for name, func in self.gaugeFuncs.items():
+            try:
+                funcValues[name] = func()
+            except Exception as e:
+                print(time_now() + ": WARNING: Metric " + name + " failed: " + str(e))
+
+        lines = []
+        self.lock.acquire()
+        try:
+            for name in sorted(self.types):
+                (metricType, help, buckets) = self.types[name]
+                lines.append('# HELP ' + name + ' ' + help)
+                lines.append('# TYPE ' + name + ' ' + metricType)
+                if(name in funcValues):
+                    lines.append(name + ' ' + repr(float(funcValues[name])))
+                    continue
+                for key, value in sorted(self.values[name].items()):
+                    if(metricType != 'histogram'):
+                        lines.append(name + self.format_labels(key) + ' '
+                                     + repr(float(value)))
+                        continue
+                    cumulative = 0
+                    for i in range(0, len(buckets)):
+                        cumulative += value[0][i]
+                        lines.append(name + '_bucket'
+                                     + self.format_labels(key, [('le', repr(float(buckets[i])))])
+                                     + ' ' + str(cumulative))
+                    lines.append(name + '_bucket' + self.format_labels(key, [('le', '+Inf')])
+                                 + ' ' + str(value[2]))
+                    lines.append(name + '_sum' + self.format_labels(key) + ' ' + repr(value[1]))
+                    lines.append(name + '_count' + self.format_labels(key) + ' ' + str(value[2]))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHTTPHandler(http.server.BaseHTTPRequestHandler):
+    # Serves GET /metrics for Prometheus. See serve_metrics().
+    def do_GET(self):
+        global metrics
+
+        if(self.path.split('?')[0] != '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every scrape.
+        pass
+
+#
+# End metrics classes
+#
+##############################
+
+
+
+##############################
+#
+# Begin status snapshot class
+#
+
+class StatusSnapshot:
+    # A fixed-layout binary copy of fleet state in a memory-mapped file that we
+    # rewrite after every trip through the main loop. Any number of local
+    # programs can map the same file and read our state without asking us for
+    # it, so they cost the main loop nothing.
+    #
+    # The file starts with a header:
+    #   magic 'TWCS', version, maxSlaves, seq, timeWritten,
+    #   maxAmpsToDivideAmongSlaves, wiringMaxAmpsAllTWCs, nonScheduledAmpsMax,
+    #   scheduledAmpsMax, scheduledAmpsStartHour, scheduledAmpsEndHour,
+    #   scheduledAmpsDaysBitmap, scheduledAmpsActive, chargeNowAmps,
+    #   chargeNowTimeEnd, greenEnergyWatts, timeGreenEnergyWatts, numSlaves
+    # followed by maxSlaves slave records of:
+    #   TWCID, reportedState, protocolVersion, pluggedIn, reportedAmpsMax,
+    #   reportedAmpsActual, lastAmpsOffered, timeLastRx, lastRxAgeSecs
+    # All values are little-endian. See headerFormat and slaveFormat.
+    #
+    # seq is a sequence lock. We make it odd before we start writing and even
+    # again when we're done, so a reader that sees the same even seq before and
+    # after copying the file knows its copy isn't torn. read() does that.
+    headerFormat = '<4sHHIdffffffBBfdfdB'
+    slaveFormat = '<2sBBBfffdf'
+    seqOffset = 8
+    version = 1
+
+    fileName = None
+    maxSlaves = 0
+    fh = None
+    mm = None
+    seq = 0
+
+    def __init__(self, fileName, maxSlaves = 0, writable = False):
+        # Writers give maxSlaves and writable = True. Readers only need
+        # fileName and get maxSlaves from the file.
+        self.fileName = fileName
+        headerSize = struct.calcsize(self.headerFormat)
+        if(writable):
+            self.maxSlaves = maxSlaves
+            self.fh = open(fileName, 'a+b')
+            self.fh.truncate(headerSize + maxSlaves * struct.calcsize(self.slaveFormat))
+            self.mm = mmap.mmap(self.fh.fileno(), 0)
+            self.seq = struct.unpack_from('<I', self.mm, self.seqOffset)[0]
+            if(self.seq % 2):
+                # We crashed in the middle of a write last time.
+                self.seq += 1
+        else:
+            self.fh = open(fileName, 'rb')
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maxSlaves = struct.unpack_from('<H', self.mm, 6)[0]
+
+    def write(self, now):
+        global maxAmpsToDivideAmongSlaves, wiringMaxAmpsAllTWCs, \
+               nonScheduledAmpsMax, scheduledAmpsMax, scheduledAmpsStartHour, \
+               scheduledAmpsEndHour, scheduledAmpsDaysBitmap, \
+               scheduledAmpsActive, chargeNowAmps, chargeNowTimeEnd, \
+               greenEnergyWatts, timeGreenEnergyWatts, slaveTWCRoundRobin
+
+        slaves = slaveTWCRoundRobin[0:self.maxSlaves]
+        data = bytearray(struct.pack(self.headerFormat, b'TWCS', self.version,
+            self.maxSlaves, self.seq + 1, now, maxAmpsToDivideAmongSlaves,
+            wiringMaxAmpsAllTWCs, nonScheduledAmpsMax, scheduledAmpsMax,
+            scheduledAmpsStartHour, scheduledAmpsEndHour,
+            scheduledAmpsDaysBitmap & 0xFF, int(scheduledAmpsActive),
+            chargeNowAmps, chargeNowTimeEnd, greenEnergyWatts,
+            timeGreenEnergyWatts, len(slaves)))
+        for slaveTWC in slaves:
+            data += struct.pack(self.slaveFormat, bytes(slaveTWC.TWCID),
+                slaveTWC.reportedState, slaveTWC.protocolVersion,
+                int(slaveTWC.pluggedIn), slaveTWC.reportedAmpsMax,
+                slaveTWC.reportedAmpsActual, slaveTWC.lastAmpsOffered,
+                slaveTWC.timeLastRx, now - slaveTWC.timeLastRx)
+
+        # data already holds the odd seq, so writing it starts the write. Only
+        # the even seq written after it ends the write.
+        self.seq += 1
+        struct.pack_into('<I', self.mm, self.seqOffset, self.seq)
+        self.mm[0:len(data)] = data
+        self.seq += 1
+        struct.pack_into('<I', self.mm, self.seqOffset, self.seq)
+
+    def read(self, maxTries = 1000):
+        # Return the snapshot as a dict, or None if the writer never stopped
+        # writing long enough for us to get a clean copy in maxTries.
+        for i in range(0, maxTries):
+            seq = struct.unpack_from('<I', self.mm, self.seqOffset)[0]
+            if(seq % 2):
+                continue
+            data = self.mm[:]
+            if(struct.unpack_from('<I', self.mm, self.seqOffset)[0] == seq):
+                return self.parse(data)
+        return None
+
+    def parse(self, data):
+        names = ['magic', 'version', 'maxSlaves', 'seq', 'timeWritten',
+                 'maxAmpsToDivideAmongSlaves', 'wiringMaxAmpsAllTWCs',
+                 'nonScheduledAmpsMax', 'scheduledAmpsMax',
+                 'scheduledAmpsStartHour', 'scheduledAmpsEndHour',
+                 'scheduledAmpsDaysBitmap', 'scheduledAmpsActive',
+                 'chargeNowAmps', 'chargeNowTimeEnd', 'greenEnergyWatts',
+                 'timeGreenEnergyWatts', 'numSlaves']
+        snapshot = dict(zip(names, struct.unpack_from(self.headerFormat, data)))
+        if(snapshot['magic'] != b'TWCS' or snapshot['version'] != self.version):
+            raise ValueError(self.fileName + ' is not a version '
+                             + str(self.version) + ' status snapshot')
+        del snapshot['magic']
+        snapshot['scheduledAmpsActive'] = bool(snapshot['scheduledAmpsActive'])
+
+        names = ['TWCID', 'reportedState', 'protocolVersion', 'pluggedIn',
+                 'reportedAmpsMax', 'reportedAmpsActual', 'lastAmpsOffered',
+                 'timeLastRx', 'lastRxAgeSecs']
+        offset = struct.calcsize(self.headerFormat)
+        slaveSize = struct.calcsize(self.slaveFormat)
+        snapshot['slaves'] = []
+        for i in range(0, snapshot['numSlaves']):
+            slave = dict(zip(names, struct.unpack_from(self.slaveFormat, data,
+                                                       offset + i * slaveSize)))
+            slave['TWCID'] = '%02X%02X' % (slave['TWCID'][0], slave['TWCID'][1])
+            slave['pluggedIn'] = bool(slave['pluggedIn'])
+            snapshot['slaves'].append(slave)
+        return snapshot
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+#
+# End status snapshot class
+#
+##############################
+
+
+
+##############################
+#
+# Begin status HTTP server class
+#
+
+class StatusHTTPServer:
+    # A small HTTP and WebSocket server so a browser or another host can watch
+    # us. It runs an asyncio event loop in its own thread so slow clients never
+    # hold up the main loop.
+    #
+    #   GET /status     fleet_status() as JSON.
+    #   GET /history    Rollups. With series=1234 or site, start, and end (see
+    #                   parse_export_time()), returns totals for that time.
+    #                   Add level=minute, hour or day for a list of buckets.
+    #   GET /sessions   Charging sessions. Takes twcid, vehicle, start, end,
+    #                   and limit.
+    #   GET /ws         WebSocket. Sends {"event": "status", "status": {...}}
+    #                   when opened, then {"event": "status", "delta": {...}}
+    #                   with only what changed, like ControlServer.
+    #
+    # The main thread calls publish() once per trip through the main loop. It
+    # serializes the status and any delta once, and every client gets those
+    # same bytes, so 100 open dashboards cost about the same as one.
+    address = None
+    port = None
+    loop = None
+    thread = None
+
+    # Cached /status response body, full status, and WebSocket clients. Only
+    # touched on the event loop thread after start().
+    statusBody = b'{}'
+    status = None
+    wsClients = None
+
+    # Rollups aren't thread safe, so /history queries are run on the main
+    # thread by service(). Each is [method, args, future].
+    mainThreadCalls = None
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.status = {}
+        self.wsClients = set()
+        self.mainThreadCalls = collections.deque()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, args = ())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Keep trying if the port is in use, like by the process we took over
+        # from, which will exit soon.
+        while True:
+            try:
+                loop.run_until_complete(asyncio.start_server(self.handle_client,
+                                                             self.address, self.port))
+                break
+            except OSError as e:
+                if(debugLevel >= 1):
+                    print(time_now() + ": Can't start status HTTP server on port "
+                          + str(self.port) + " yet: " + str(e))
+                time.sleep(30)
+
+        # Only publish to the loop once it's serving.
+        self.loop = loop
+        loop.run_forever()
+
+    def publish(self, status):
+        # Called on the main thread with fleet_status().
+        if(self.loop == None or status == self.status):
+            return
+        delta = fleet_status_delta(self.status, status)
+        self.status = status
+        statusBody = json.dumps(status, separators=(',', ':')).encode('utf-8')
+        frame = self.ws_frame(0x1, json.dumps({'event': 'status', 'delta': delta},
+                                              separators=(',', ':')).encode('utf-8'))
+        self.loop.call_soon_threadsafe(self.broadcast, statusBody, frame)
+
+    def service(self, maxCalls):
+        # Called on the main thread to run up to maxCalls queries that need
+        # to be run there.
+        for i in range(0, maxCalls):
+            try:
+                (method, args, future) = self.mainThreadCalls.popleft()
+            except IndexError:
+                return
+            try:
+                result = method(*args)
+                self.loop.call_soon_threadsafe(self.set_future, future, result, None)
+            except Exception as e:
+                self.loop.call_soon_threadsafe(self.set_future, future, None, e)
+
+    def set_future(self, future, result, exception):
+        if(future.cancelled()):
+            return
+        if(exception != None):
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def call_on_main_thread(self, method, *args):
+        global httpServerMaxQueuedCalls
+
+        future = self.loop.create_future()
+        if(len(self.mainThreadCalls) >= httpServerMaxQueuedCalls):
+            future.set_exception(ValueError('too many queries waiting, try again later'))
+        else:
+            self.mainThreadCalls.append([method, args, future])
+        return future
+
+    def broadcast(self, statusBody, frame):
+        self.statusBody = statusBody
+        for writer in list(self.wsClients):
+            if(writer.transport.get_write_buffer_size() > controlMaxQueuedBytes):
+                # This client isn't reading. Drop it.
+                self.wsClients.discard(writer)
+                writer.close()
+                continue
+            writer.write(frame)
+
+    @staticmethod
+    def ws_frame(opcode, payload):
+        # Frames from a server aren't masked.
+        header = bytearray([0x80 | opcode])
+        if(len(payload) < 126):
+            header.append(len(payload))
+        elif(len(payload) < 0x10000):
+            header.append(126)
+            header += struct.pack('>H', len(payload))
+        else:
+            header.append(127)
+            header += struct.pack('>Q', len(payload))
+        return bytes(header) + payload
+
+    async def handle_client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = request.decode('latin-1').split('\r\n')
+            (method, target, version) = (lines[0].split(' ') + ['', '', ''])[0:3]
+            headers = {}
+            for line in lines[1:]:
+                (name, sep, value) = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            url = urllib.parse.urlsplit(target)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if(method != 'GET'):
+                self.respond(writer, 405, {'error': 'only GET is supported'})
+            elif(url.path == '/ws'
+                 and headers.get('upgrade', '').lower() == 'websocket'
+            ):
+                await self.handle_websocket(reader, writer, headers)
+                return
+            elif(url.path == '/status'):
+                self.respond(writer, 200, self.statusBody)
+            elif(url.path == '/history'):
+                self.respond(writer, 200, await self.history(params))
+            elif(url.path == '/sessions'):
+                self.respond(writer, 200, await self.sessions(params))
+            else:
+                self.respond(writer, 404, {'error': 'not found'})
+            await writer.drain()
+        except (KeyError, ValueError, argparse.ArgumentTypeError) as e:
+            self.respond(writer, 400, {'error': str(e)})
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError):
+            pass
+        writer.close()
+
+    def respond(self, writer, code, body):
+        if(type(body) != bytes):
+            body = json.dumps(body, separators=(',', ':')).encode('utf-8')
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                   405: 'Method Not Allowed'}
+        writer.write(('HTTP/1.1 %d %s\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: %d\r\n'
+                      'Access-Control-Allow-Origin: *\r\n'
+                      'Connection: close\r\n\r\n' % (code, reasons[code], len(body))
+                     ).encode('ascii') + body)
+
+    async def history(self, params):
+        global rollups
+
+        series = params.get('series', 'site').upper()
+        if(series == 'SITE'):
+            series = 'site'
+        end = parse_export_time(params['end']) if 'end' in params else time.time()
+        start = parse_export_time(params['start']) if 'start' in params else end - 86400
+        if('level' in params):
+            level = {'minute': 60, 'hour': 3600, 'day': 86400}[params['level']]
+            buckets = await self.call_on_main_thread(rollups.query_buckets,
+                                                     series, level, start, end)
+            return [dict(bucket, start=bucketStart) for (bucketStart, bucket) in buckets]
+        return await self.call_on_main_thread(rollups.query, series, start, end)
+
+    async def sessions(self, params):
+        global sessionStore
+
+        # SessionStore is thread safe, but sqlite would block the event loop,
+        # so run the query in the loop's thread pool.
+        return await self.loop.run_in_executor(None, lambda: sessionStore.query(
+            twcid=params.get('twcid'), vehicleID=params.get('vehicle'),
+            start=parse_export_time(params['start']) if 'start' in params else None,
+            end=parse_export_time(params['end']) if 'end' in params else None,
+            limit=int(params.get('limit', 1000))))
+
+    async def handle_websocket(self, reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key']
+                    + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('ascii')
+                 ).digest()).decode('ascii')
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: ' + accept + '\r\n\r\n').encode('ascii'))
+        writer.write(self.ws_frame(0x1, b'{"event":"status","status":'
+                                        + self.statusBody + b'}'))
+        self.wsClients.add(writer)
+
+        # We don't expect anything from the client but ping and close.
+        try:
+            while True:
+                (byte0, byte1) = await reader.readexactly(2)
+                length = byte1 & 0x7F
+                if(length == 126):
+                    length = struct.unpack('>H', await reader.readexactly(2))[0]
+                elif(length == 127):
+                    length = struct.unpack('>Q', await reader.readexactly(8))[0]
+                if(length > 65536):
+                    break
+                mask = (await reader.readexactly(4)) if byte1 & 0x80 else b'\x00' * 4
+                payload = bytes(b ^ mask[i % 4] for (i, b)
+                                in enumerate(await reader.readexactly(length)))
+                opcode = byte0 & 0x0F
+                if(opcode == 0x8):
+                    writer.write(self.ws_frame(0x8, payload[0:2]))
+                    break
+                elif(opcode == 0x9):
+                    writer.write(self.ws_frame(0xA, payload))
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.wsClients.discard(writer)
+            writer.close()
+
+#
+# End status HTTP server class
+#
+##############################
+
+
+
+##############################
+#
+# Begin control socket class
+#
 
-            except (KeyError, TypeError):
-                # This catches cases like trying to access
-                # apiResponseDict['response'] when 'response' doesn't exist in
-                # apiResponseDict.
-                print(time_now() + ': ERROR: Failed to ' + startOrStop
-                      + ' car charging via Tesla car API.  Will try again later.')
-                vehicle.lastErrorTime = now
-            break
+class ControlServer:
+    # Serves a control API on a Unix domain socket to any number of local
+    # clients, like dashboards and scripts, from the main thread. service() is
+    # called once per trip through the main loop and never blocks.
+    #
+    # Each frame is a 4-byte big-endian length followed by that many bytes of
+    # JSON. Clients send requests like:
+    #   {"id": 1, "cmd": "setNonScheduledAmps", "amps": 12}
+    # and get back a response with the same id:
+    #   {"id": 1, "ok": true}
+    # or {"id": 1, "ok": false, "error": "..."}.
+    #
+    # Commands:
+    #   getStatus                   Responds with 'status' from fleet_status().
+    #   getBusHealth                Responds with 'busHealth' from
+    #                               BusHealth.status().
+    #   setNonScheduledAmps amps    Set and save nonScheduledAmpsMax.
+    #   chargeNow [amps] [secs]     Charge at amps (default wiringMaxAmpsAllTWCs)
+    #                               for secs (default one day).
+    #   chargeNowCancel
+    #   sendTWCMsg hex              Send a raw TWC message. Responds with the
+    #                               hex of lastTWCResponseMsg once the TWC
+    #                               answers or controlTWCResponseSecs passes.
+    #   subscribe                   Responds with the full 'status', then sends
+    #                               {"event": "status", "delta": {...}} with only
+    #                               what changed whenever anything changes.
+    #   unsubscribe
+    #   profile [secs]              Run the SamplingProfiler for secs (default
+    #                               profilerSecs).
+    #   profileStop                 Stop the profiler early and write its output.
+    #   getMemory                   Responds with 'memory' from
+    #                               MemoryMonitor.status().
+    #   memoryTraceStart [frames]   Start tracemalloc keeping frames stack frames
+    #                               per allocation (default memoryTraceFrames)
+    #                               and take a baseline snapshot.
+    #   memoryTraceDiff [limit]     Compare a new snapshot to the baseline. The
+    #                               top limit lines (default memoryTraceLimit)
+    #                               show up in getMemory's 'traceDiff'.
+    #   memoryTraceStop
+    fileName = None
+    listener = None
+    selector = None
+    clients = None
+    subscribers = None
+    lastStatus = None
+
+    # Requests waiting for a TWC to respond to sendTWCMsg, as
+    # (client, id, time sent).
+    twcMsgRequests = None
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.clients = {}
+        self.subscribers = set()
+        self.lastStatus = {}
+        self.twcMsgRequests = []
 
-    if(debugLevel >= 1 and carApiLastStartOrStopChargeTime == now):
-        print(time_now() + ': Car API ' + startOrStop + ' charge result: ' + result)
+        try:
+            os.unlink(fileName)
+        except FileNotFoundError:
+            pass
 
-    return result
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(fileName)
+        os.chmod(fileName, 0o660)
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def service(self, budgetSecs):
+        # Accept clients, answer requests, and push status deltas to
+        # subscribers, spending about budgetSecs at most.
+        timeStart = time.time()
+        for (key, events) in self.selector.select(0):
+            if(key.fileobj == self.listener):
+                self.accept()
+                continue
 
+            conn = key.fileobj
+            if(conn not in self.clients):
+                continue
+            if(events & selectors.EVENT_WRITE):
+                self.flush(conn)
+            if(events & selectors.EVENT_READ and conn in self.clients):
+                self.receive(conn)
+            if(time.time() - timeStart >= budgetSecs):
+                break
 
-def queue_background_task(task):
-    global backgroundTasksQueue, backgroundTasksCmds
-    if(task['cmd'] in backgroundTasksCmds):
-        # Some tasks, like cmd='charge', will be called once per second until
-        # a charge starts or we determine the car is done charging.  To avoid
-        # wasting memory queing up a bunch of these tasks when we're handling
-        # a charge cmd already, don't queue two of the same task.
-        return
+        self.check_twc_msg_requests()
+        if(len(self.subscribers) > 0):
+            self.publish()
 
-    # Insert task['cmd'] in backgroundTasksCmds to prevent queuing another
-    # task['cmd'] till we've finished handling this one.
-    backgroundTasksCmds[task['cmd']] = True
+    def accept(self):
+        global controlMaxClients
 
-    # Queue the task to be handled by background_tasks_thread.
-    backgroundTasksQueue.put(task)
+        while True:
+            try:
+                (conn, addr) = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
 
+            if(len(self.clients) >= controlMaxClients):
+                conn.close()
+                continue
 
-def background_tasks_thread():
-    global backgroundTasksQueue, backgroundTasksCmds, carApiLastErrorTime
+            conn.setblocking(False)
+            self.clients[conn] = {'in': bytearray(), 'out': bytearray()}
+            self.selector.register(conn, selectors.EVENT_READ)
 
-    while True:
-        task = backgroundTasksQueue.get()
-
-        if(task['cmd'] == 'charge'):
-            # car_api_charge does nothing if it's been under 60 secs since it
-            # was last used so we shouldn't have to worry about calling this
-            # too frequently.
-            car_api_charge(task['charge'])
-        elif(task['cmd'] == 'carApiEmailPassword'):
-            carApiLastErrorTime = 0
-            car_api_available(task['email'], task['password'])
-        elif(task['cmd'] == 'checkGreenEnergy'):
-            check_green_energy()
-
-        # Delete task['cmd'] from backgroundTasksCmds such that
-        # queue_background_task() can queue another task['cmd'] in the future.
-        del backgroundTasksCmds[task['cmd']]
+    def receive(self, conn):
+        global controlMaxFrameBytes
 
-        # task_done() must be called to let the queue know the task is finished.
-        # backgroundTasksQueue.join() can then be used to block until all tasks
-        # in the queue are done.
-        backgroundTasksQueue.task_done()
+        try:
+            data = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if(len(data) == 0):
+            self.close(conn)
+            return
+
+        buf = self.clients[conn]['in']
+        buf += data
+        while(len(buf) >= 4):
+            frameLen = struct.unpack('>I', buf[0:4])[0]
+            if(frameLen > controlMaxFrameBytes):
+                self.close(conn)
+                return
+            if(len(buf) < 4 + frameLen):
+                break
+            frame = bytes(buf[4:4 + frameLen])
+            del buf[0:4 + frameLen]
 
-def check_green_energy():
-    global debugLevel, maxAmpsToDivideAmongSlaves, greenEnergyAmpsOffset, \
-           minAmpsPerTWC, backgroundTasksLock
+            try:
+                request = json.loads(frame.decode('utf-8'))
+                if(type(request) != dict):
+                    raise ValueError('request must be an object')
+            except ValueError as e:
+                self.send(conn, {'ok': False, 'error': 'bad request: ' + str(e)})
+                continue
 
-    # I check solar panel generation using an API exposed by The
-    # Energy Detective (TED). It's a piece of hardware available
-    # at http://www. theenergydetective.com
-    # You may also be able to find a way to query a solar system
-    # on the roof using an API provided by your solar installer.
-    # Most of those systems only update the amount of power the
-    # system is producing every 15 minutes at most, but that's
-    # fine for tweaking your car charging.
-    #
-    # In the worst case, you could skip finding realtime green
-    # energy data and simply direct the car to charge at certain
-    # rates at certain times of day that typically have certain
-    # levels of solar or wind generation. To do so, use the hour
-    # and min variables as demonstrated just above this line:
-    #   backgroundTasksQueue.put({'cmd':'checkGreenEnergy')
-    #
-    # The curl command used below can be used to communicate
-    # with almost any web API, even ones that require POST
-    # values or authentication. The -s option prevents curl from
-    # displaying download stats. -m 60 prevents the whole
-    # operation from taking over 60 seconds.
-    greenEnergyData = run_process('curl -s -m 60 "http://192.168.13.58/history/export.csv?T=1&D=0&M=1&C=1"')
+            response = self.handle(conn, request)
+            if(response != None):
+                response['id'] = request.get('id')
+                self.send(conn, response)
+            if(conn not in self.clients):
+                return
 
-    # In case, greenEnergyData will contain something like this:
-    #   MTU, Time, Power, Cost, Voltage
-    #   Solar,11/11/2017 14:20:43,-2.957,-0.29,124.3
-    # The only part we care about is -2.957 which is negative
-    # kW currently being generated. When 0kW is generated, the
-    # negative disappears so we make it optional in the regex
-    # below.
-    m = re.search(b'^Solar,[^,]+,-?([^, ]+),', greenEnergyData, re.MULTILINE)
-    if(m):
-        solarW = int(float(m.group(1)) * 1000)
+    def handle(self, conn, request):
+        # Return the response to request, or None if it will be sent later.
+        global debugLevel, nonScheduledAmpsMax, chargeNowAmps, \
+               chargeNowTimeEnd, wiringMaxAmpsAllTWCs, settingsLock, \
+               profiler, profilerSecs, profilerIntervalSecs
 
-        # Use backgroundTasksLock to prevent changing maxAmpsToDivideAmongSlaves
-        # if the main thread is in the middle of examining and later using
-        # that value.
-        backgroundTasksLock.acquire()
+        cmd = request.get('cmd')
+        try:
+            if(cmd == 'getStatus'):
+                return {'ok': True, 'status': fleet_status()}
+            elif(cmd == 'getBusHealth'):
+                return {'ok': True, 'busHealth': busHealth.status()}
+            elif(cmd == 'setNonScheduledAmps'):
+                amps = int(request['amps'])
+                settingsLock.acquire()
+                nonScheduledAmpsMax = amps
+                settingsLock.release()
+                save_settings()
+            elif(cmd == 'chargeNow'):
+                amps = float(request.get('amps', wiringMaxAmpsAllTWCs))
+                if(amps <= 0 or amps > wiringMaxAmpsAllTWCs):
+                    return {'ok': False, 'error': 'amps must be from 0 to %.2f'
+                                                  % (wiringMaxAmpsAllTWCs)}
+                chargeNowAmps = amps
+                chargeNowTimeEnd = time.time() + float(request.get('secs', 60*60*24))
+            elif(cmd == 'chargeNowCancel'):
+                chargeNowAmps = 0
+                chargeNowTimeEnd = 0
+            elif(cmd == 'sendTWCMsg'):
+                if(not send_user_twc_msg(str(request['hex']))):
+                    return {'ok': False, 'error': 'refusing to send that message'}
+                self.twcMsgRequests.append((conn, request.get('id'), time.time()))
+                return None
+            elif(cmd == 'subscribe'):
+                # Deltas are relative to lastStatus, which is only kept up to
+                # date while someone is subscribed.
+                if(len(self.subscribers) == 0):
+                    self.lastStatus = fleet_status()
+                self.subscribers.add(conn)
+                return {'ok': True, 'status': self.lastStatus}
+            elif(cmd == 'unsubscribe'):
+                self.subscribers.discard(conn)
+            elif(cmd == 'profile'):
+                if(not profiler.start(float(request.get('secs', profilerSecs)),
+                                      profilerIntervalSecs)):
+                    return {'ok': False, 'error': 'profiler is already running'}
+            elif(cmd == 'profileStop'):
+                profiler.stop()
+            elif(cmd == 'getMemory'):
+                return {'ok': True, 'memory': memoryMonitor.status()}
+            elif(cmd == 'memoryTraceStart'):
+                queue_background_task({'cmd':'memoryTraceStart',
+                                       'frames':int(request.get('frames', memoryTraceFrames))})
+            elif(cmd == 'memoryTraceDiff'):
+                queue_background_task({'cmd':'memoryTraceDiff',
+                                       'limit':int(request.get('limit', memoryTraceLimit))})
+            elif(cmd == 'memoryTraceStop'):
+                queue_background_task({'cmd':'memoryTraceStop'})
+            else:
+                return {'ok': False, 'error': 'unknown cmd ' + str(cmd)}
+        except (KeyError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': 'bad ' + str(cmd) + ' request: ' + str(e)}
 
-        # Watts = Volts * Amps
-        # Car charges at 240 volts in North America so we figure
-        # out how many amps * 240 = solarW and limit the car to
-        # that many amps.
-        maxAmpsToDivideAmongSlaves = (solarW / 240) + \
-                                      greenEnergyAmpsOffset
+        log(2, ": Control API: %s", cmd)
+        return {'ok': True}
 
-        if(debugLevel >= 1):
-            print("%s: Solar generating %dW so limit car charging to:\n" \
-                 "          %.2fA + %.2fA = %.2fA.  Charge when above %.0fA (minAmpsPerTWC)." % \
-                 (time_now(), solarW, (solarW / 240),
-                 greenEnergyAmpsOffset, maxAmpsToDivideAmongSlaves,
-                 minAmpsPerTWC))
+    def check_twc_msg_requests(self):
+        global lastTWCResponseMsg, controlTWCResponseSecs
 
-        backgroundTasksLock.release()
-    else:
-        print(time_now() +
-            " ERROR: Can't determine current solar generation from:\n" +
-            str(greenEnergyData))
+        if(len(self.twcMsgRequests) == 0):
+            return
+
+        now = time.time()
+        waiting = []
+        for (conn, requestID, timeSent) in self.twcMsgRequests:
+            if(conn not in self.clients):
+                continue
+            if(lastTWCResponseMsg != None and len(lastTWCResponseMsg) > 0):
+                self.send(conn, {'id': requestID, 'ok': True,
+                                 'response': hex_str(lastTWCResponseMsg)})
+            elif(now - timeSent >= controlTWCResponseSecs):
+                self.send(conn, {'id': requestID, 'ok': True, 'response': None})
+            else:
+                waiting.append((conn, requestID, timeSent))
+        self.twcMsgRequests = waiting
+
+    def publish(self):
+        # Send each subscriber what changed since the last publish. The frame
+        # is encoded once no matter how many clients are subscribed.
+        status = fleet_status()
+        delta = fleet_status_delta(self.lastStatus, status)
+        self.lastStatus = status
+        if(len(delta) == 0):
+            return
+
+        frame = self.frame({'event': 'status', 'delta': delta})
+        for conn in list(self.subscribers):
+            self.send_frame(conn, frame)
+
+    def frame(self, msg):
+        data = json.dumps(msg, separators=(',', ':')).encode('utf-8')
+        return struct.pack('>I', len(data)) + data
+
+    def send(self, conn, msg):
+        self.send_frame(conn, self.frame(msg))
+
+    def send_frame(self, conn, frame):
+        global controlMaxQueuedBytes
+
+        client = self.clients.get(conn)
+        if(client == None):
+            return
+        if(len(client['out']) + len(frame) > controlMaxQueuedBytes):
+            # The client isn't reading what we send. Drop it rather than let
+            # it use up our memory.
+            log(1, ": Control API client isn't reading.  Disconnecting it.")
+            self.close(conn)
+            return
+        client['out'] += frame
+        self.flush(conn)
+
+    def flush(self, conn):
+        client = self.clients[conn]
+        try:
+            while(len(client['out']) > 0):
+                numSent = conn.send(client['out'])
+                del client['out'][0:numSent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close(conn)
+            return
+
+        # Only ask to hear when we can write when we have something to write.
+        events = selectors.EVENT_READ
+        if(len(client['out']) > 0):
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(conn, events)
+
+    def close(self, conn):
+        if(conn in self.clients):
+            self.selector.unregister(conn)
+            del self.clients[conn]
+        self.subscribers.discard(conn)
+        conn.close()
 
 #
-# End functions
+# End control socket class
 #
 ##############################
 
 
+
+##############################
+#
+# Begin serial port handoff class
+#
+
+class HandoffSerial:
+    # Stands in for serial.Serial on an RS485 port file descriptor handed to us
+    # by the copy of this script we're replacing. See take_over_serial_port().
+    # Baud rate and raw mode are settings of the port, not of the process that
+    # opened it, so all that's left for us to do is read and write.
+    fd = None
+
+    def __init__(self, fd):
+        self.fd = fd
+
+        # pyserial opens the port non-blocking. We only read what inWaiting()
+        # says is there, and we want writes to block till the whole message
+        # is queued like they do in pyserial.
+        os.set_blocking(fd, True)
+
+    def fileno(self):
+        return self.fd
+
+    def inWaiting(self):
+        return struct.unpack('I', fcntl.ioctl(self.fd, termios.TIOCINQ,
+                                              b'\x00\x00\x00\x00'))[0]
+
+    def read(self, size = 1):
+        return os.read(self.fd, size)
+
+    def write(self, data):
+        view = memoryview(bytes(data))
+        while(len(view) > 0):
+            view = view[os.write(self.fd, view):]
+
+    def close(self):
+        if(self.fd != None):
+            os.close(self.fd)
+            self.fd = None
+
+#
+# End serial port handoff class
+#
+##############################
+
+
+
 ##############################
 #
 # Begin CarApiVehicle class
@@ -1332,31 +6021,82 @@ def check_green_energy():
 class CarApiVehicle:
     ID = None
 
+    # Each vehicle runs its own wake state machine:
+    #   'asleep' We have no reason to think the car is awake and we aren't
+    #            trying to wake it.
+    #   'waking' We sent wake_up but the car isn't online yet. wakeTimer will
+    #            send the next wake_up when delayNextWakeAttempt has passed.
+    #   'online' The car answered wake_up with 'online' less than 2 minutes
+    #            ago, so it should still be awake.
+    #   'idle'   The car was online, but it's been long enough since then that
+    #            it may have gone back to sleep. We'll wake it again the next
+    #            time we need it.
+    # Transitions happen in request_wake() and in timer callbacks run by
+    # background_tasks_thread, so car API calls are never made from two threads
+    # at once.
+    wakeState = 'asleep'
+    wakeTimer = None
+
     firstWakeAttemptTime = 0
     lastWakeAttemptTime = 0
     delayNextWakeAttempt = 0
+    timeLastWakeRequest = 0
+    timeOnline = 0
+
+    # Charge command (True/False) to send as soon as the car is ready, or None.
+    # pendingChargeTWCID is the TWC that asked for the command.
+    pendingCharge = None
+    pendingChargeTWCID = None
+
+    # Limit requests about this car and stop sending them for a while when the
+    # car API returns errors for it. See car_api_call().
+    bucket = None
+    breaker = None
 
-    lastErrorTime = 0
     stopAskingToStartCharging = False
+    lastStartOrStopChargeTime = 0
     lat = 10000
     lon = 10000
+    timeLocationUpdated = 0
+    timeLocationPolled = 0
+
+    # The streaming API identifies cars by their vehicle_id rather than the id
+    # used by other car API commands. stream is the CarApiStream keeping lat,
+    # lon, streamPower, and streamShiftState up to date when
+    # carApiStreaming = True.
+    streamID = None
+    stream = None
+    streamPower = None
+    streamShiftState = ''
+
+    # Charge state last reported by the car API. chargingState is a string like
+    # 'Charging', 'Stopped', 'Complete', or 'Disconnected'.
+    chargingState = None
+    chargerActualCurrent = 0
+    timeChargeStateUpdated = 0
+
+    def __init__(self, ID, streamID = None):
+        global carApiVehicleRateLimit, carApiErrorRetryMins
 
-    def __init__(self, ID):
         self.ID = ID
+        self.streamID = streamID
+        self.bucket = TokenBucket(carApiVehicleRateLimit[0], carApiVehicleRateLimit[1])
+        self.breaker = CircuitBreaker('vehicle ' + str(ID), 1, carApiErrorRetryMins*60)
 
     def ready(self):
-        global carApiLastErrorTime, carApiErrorRetryMins
-
-        if(time.time() - self.lastErrorTime < carApiErrorRetryMins*60):
-            # It's been under carApiErrorRetryMins minutes since the car API
-            # generated an error on this vehicle. Return that car is not ready.
+        if(self.breaker.secs_till_closed() > 0):
+            # The car API generated an error on this vehicle recently. Return
+            # that car is not ready.
             if(debugLevel >= 8):
                 print(time_now() + ': Vehicle ' + str(self.ID)
-                    + ' not ready because of recent lastErrorTime '
-                    + str(self.lastErrorTime))
+                    + ' not ready because its breaker is ' + self.breaker.state
+                    + ' for ' + str(int(self.breaker.secs_till_closed()))
+                    + ' more seconds.')
             return False
 
-        if(self.firstWakeAttemptTime == 0 and time.time() - self.lastWakeAttemptTime < 2*60):
+        if(self.wakeState == 'online'
+           and time.time() - self.timeOnline >= carApiWakeSettleSecs
+        ):
             # Less than 2 minutes since we successfully woke this car, so it
             # should still be awake.  Tests on my car in energy saver mode show
             # it returns to sleep state about two minutes after the last command
@@ -1365,81 +6105,402 @@ class CarApiVehicle:
 
         if(debugLevel >= 8):
             print(time_now() + ': Vehicle ' + str(self.ID)
-                + " not ready because it wasn't woken in the last 2 minutes.")
+                + " not ready because its wake state is '" + self.wakeState + "'.")
         return False
 
+    def set_wake_state(self, state, timerDelay = None, timerCallback = None):
+        # Move to a new wake state, replacing any timer set for the old state.
+        cancel_timer(self.wakeTimer)
+        self.wakeTimer = None
+
+        if(debugLevel >= 8 and state != self.wakeState):
+            print(time_now() + ': Vehicle ' + str(self.ID) + " wake state '"
+                  + self.wakeState + "' -> '" + state + "'")
+        self.wakeState = state
+
+        if(timerCallback != None):
+            self.wakeTimer = schedule_timer(timerDelay, timerCallback)
+
+    def request_wake(self, charge = None, TWCID = None):
+        # Ask for this car to be awake and ready for commands. charge is the
+        # command we'll queue for TWCID once it is ready.
+        self.timeLastWakeRequest = time.time()
+        if(charge != None):
+            self.pendingCharge = charge
+            self.pendingChargeTWCID = TWCID
+
+        if(self.wakeState == 'asleep' or self.wakeState == 'idle'):
+            self.wake()
+
+    def wake_retry_due(self):
+        # wakeTimer callback in 'waking' state.
+        self.wakeTimer = None
+        if(time.time() - self.timeLastWakeRequest > carApiWakeAbandonMins*60):
+            # Nobody has asked for this car in a while, probably because it
+            # started charging or was unplugged. Stop trying to wake it.
+            if(debugLevel >= 8):
+                print(time_now() + ': Vehicle ' + str(self.ID)
+                      + ' no longer needed.  Stop trying to wake it.')
+            self.firstWakeAttemptTime = 0
+            self.pendingCharge = None
+            self.set_wake_state('asleep')
+            return
+
+        waitSecs = car_api_wait_secs('wake_up', self)
+        if(waitSecs > 0):
+            # Wait for a breaker to close or a rate limit token before sending
+            # wake_up again.
+            self.set_wake_state('waking', waitSecs, self.wake_retry_due)
+            return
+
+        self.wake()
+
+    def wake_settled(self):
+        # wakeTimer callback carApiWakeSettleSecs after the car came online.
+        #
+        # If you send charge_start/stop less than 1 second after calling
+        # update_location(), the charge command usually returns:
+        #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
+        # I'm not sure if the same problem exists when sending commands too
+        # quickly after we send wake_up.  I haven't seen a problem sending a
+        # command immediately, but it seems safest to wait 5 seconds after
+        # waking before sending a command.  ready() returns False till then.
+        self.set_wake_state('online', 2*60 - carApiWakeSettleSecs,
+                            self.online_expired)
+
+        if(self.pendingCharge != None):
+            # Send the charge command that was waiting on this car right
+            # away rather than waiting for the next heartbeat to ask again.
+            queue_background_task({'cmd':'charge', 'charge':self.pendingCharge,
+                                   'TWCID':self.pendingChargeTWCID})
+            self.pendingCharge = None
+
+    def online_expired(self):
+        # wakeTimer callback 2 minutes after the car came online.
+        self.wakeTimer = None
+        self.set_wake_state('idle')
+
+    def wake(self):
+        # It's been delayNextWakeAttempt seconds since we last failed to
+        # wake the car, or it's never been woken. Wake it.
+        now = time.time()
+        cmd = 'curl -s -m 60 -X POST -H "accept: application/json" -H "Authorization:Bearer ' + \
+              carApiBearerToken + \
+              '" "https://owner-api.teslamotors.com/api/1/vehicles/' + \
+              str(self.ID) + '/wake_up"'
+        if(debugLevel >= 8):
+            print(time_now() + ': Car API cmd', cmd)
+
+        apiResponseDict = car_api_call(cmd, 'wake_up', self)
+        if(apiResponseDict == None):
+            # Rate limited or a breaker is open. Try again when allowed.
+            self.set_wake_state('waking', max(1, car_api_wait_secs('wake_up', self)),
+                                self.wake_retry_due)
+            return
+
+        self.lastWakeAttemptTime = now
+
+        state = 'error'
+        try:
+            if(debugLevel >= 4):
+                print(time_now() + ': Car API wake car response', apiResponseDict, '\n')
+
+            state = apiResponseDict['response']['state']
+
+        except (KeyError, TypeError):
+            # This catches unexpected cases like trying to access
+            # apiResponseDict['response'] when 'response' doesn't exist
+            # in apiResponseDict.
+            state = 'error'
+
+        if(state == 'online'):
+            # With max power saving settings, car will almost always
+            # report 'asleep' or 'offline' the first time it's sent
+            # wake_up.  Rarely, it returns 'online' on the first wake_up
+            # even when the car has not been contacted in a long while.
+            # I suspect that happens when we happen to query the car
+            # when it periodically awakens for some reason.
+            self.firstWakeAttemptTime = 0
+            self.delayNextWakeAttempt = 0
+            self.timeOnline = now
+            car_api_result('wake_up', self, True)
+            self.set_wake_state('online', carApiWakeSettleSecs,
+                                self.wake_settled)
+        else:
+            if(self.firstWakeAttemptTime == 0):
+                self.firstWakeAttemptTime = now
+
+            if(state == 'asleep' or state == 'waking'):
+                if(now - self.firstWakeAttemptTime <= 10*60):
+                    # http://visibletesla.com has a 'force wakeup' mode
+                    # that sends wake_up messages once every 5 seconds
+                    # 15 times. This generally manages to wake my car if
+                    # it's returning 'asleep' state, but I don't think
+                    # there is any reason for 5 seconds and 15 attempts.
+                    # The car did wake in two tests with that timing,
+                    # but on the third test, it had not entered online
+                    # mode by the 15th wake_up and took another 10+
+                    # seconds to come online. In general, I hear relays
+                    # in the car clicking a few seconds after the first
+                    # wake_up but the car does not enter 'waking' or
+                    # 'online' state for a random period of time. I've
+                    # seen it take over one minute, 20 sec.
+                    #
+                    # I interpret this to mean a car in 'asleep' mode is
+                    # still receiving car API messages and will start
+                    # to wake after the first wake_up, but it may take
+                    # awhile to finish waking up. Therefore, we try
+                    # waking every 30 seconds for the first 10 mins.
+                    self.delayNextWakeAttempt = 30;
+                elif(now - self.firstWakeAttemptTime <= 70*60):
+                    # Cars in 'asleep' state should wake within a
+                    # couple minutes in my experience, so we should
+                    # never reach this point. If we do, try every 5
+                    # minutes for the next hour.
+                    self.delayNextWakeAttempt = 5*60;
+                else:
+                    # Car hasn't woken for an hour and 10 mins. Try
+                    # again in 15 minutes. We'll show an error about
+                    # reaching this point later.
+                    self.delayNextWakeAttempt = 15*60;
+            elif(state == 'offline'):
+                if(now - self.firstWakeAttemptTime <= 31*60):
+                    # A car in offline state is presumably not connected
+                    # wirelessly so our wake_up command will not reach
+                    # it. Instead, the car wakes itself every 20-30
+                    # minutes and waits some period of time for a
+                    # message, then goes back to sleep. I'm not sure
+                    # what the period of time is, so I tried sending
+                    # wake_up every 55 seconds for 16 minutes but the
+                    # car failed to wake.
+                    # Next I tried once every 25 seconds for 31 mins.
+                    # This worked after 19.5 and 19.75 minutes in 2
+                    # tests but I can't be sure the car stays awake for
+                    # 30secs or if I just happened to send a command
+                    # during a shorter period of wakefulness.
+                    self.delayNextWakeAttempt = 25;
+
+                    # I've run tests sending wake_up every 10-30 mins to
+                    # a car in offline state and it will go hours
+                    # without waking unless you're lucky enough to hit
+                    # it in the brief time it's waiting for wireless
+                    # commands. I assume cars only enter offline state
+                    # when set to max power saving mode, and even then,
+                    # they don't always enter the state even after 8
+                    # hours of no API contact or other interaction. I've
+                    # seen it remain in 'asleep' state when contacted
+                    # after 16.5 hours, but I also think I've seen it in
+                    # offline state after less than 16 hours, so I'm not
+                    # sure what the rules are or if maybe Tesla contacts
+                    # the car periodically which resets the offline
+                    # countdown.
+                    #
+                    # I've also seen it enter 'offline' state a few
+                    # minutes after finishing charging, then go 'online'
+                    # on the third retry every 55 seconds.  I suspect
+                    # that might be a case of the car briefly losing
+                    # wireless connection rather than actually going
+                    # into a deep sleep.
+                    # 'offline' may happen almost immediately if you
+                    # don't have the charger plugged in.
+            else:
+                # Handle 'error' state.
+                if(now - self.firstWakeAttemptTime <= 60*60):
+                    # We've tried to wake the car for less than an
+                    # hour.
+                    if(car_api_transient_error(apiResponseDict)):
+                        # I see these errors often enough that I think
+                        # it's worth re-trying in 1 minute rather than
+                        # waiting 5 minutes for retry in the standard
+                        # error handler.
+                        self.delayNextWakeAttempt = 60;
+                    else:
+                        # We're in an unexpected state. This could be caused
+                        # by the API servers being down, car being out of
+                        # range, or by something I can't anticipate. Try
+                        # waking the car every 5 mins.
+                        self.delayNextWakeAttempt = 5*60;
+                else:
+                    # Car hasn't woken for over an hour. Try again
+                    # in 15 minutes. We'll show an error about this
+                    # later.
+                    self.delayNextWakeAttempt = 15*60;
+
+            if(state == 'error'):
+                # Keep this car's breaker open till the next wake attempt.
+                car_api_result('wake_up', self, False, self.delayNextWakeAttempt,
+                               apiResponseDict = apiResponseDict)
+            else:
+                # The API told us the car's state, so the request worked even
+                # though the car isn't awake yet.
+                car_api_result('wake_up', self, True)
+
+            # Send the next wake_up exactly when it's due rather than waiting
+            # for the next charge task to notice the delay has passed.
+            self.set_wake_state('waking', self.delayNextWakeAttempt,
+                                self.wake_retry_due)
+
+            if(debugLevel >= 1):
+                if(state == 'error'):
+                    print(time_now() + ": Car API wake car failed with unknown response.  " \
+                        "Will try again in "
+                        + str(self.delayNextWakeAttempt) + " seconds.")
+                else:
+                    print(time_now() + ": Car API wake car failed.  State remains: '"
+                        + state + "'.  Will try again in "
+                        + str(self.delayNextWakeAttempt) + " seconds.")
+
+        if(self.firstWakeAttemptTime > 0
+           and now - self.firstWakeAttemptTime > 60*60):
+            # It should never take over an hour to wake a car.  If it
+            # does, ask user to report an error.
+            print(time_now() + ": ERROR: We have failed to wake a car from '"
+                + state + "' state for %.1f hours.\n" \
+                  "Please private message user CDragon at " \
+                  "http://teslamotorsclub.com with a copy of this error. " \
+                  "Also include this: %s" % (
+                  ((now - self.firstWakeAttemptTime) / 60 / 60),
+                  str(apiResponseDict)))
+
     def update_location(self):
-        global carApiLastErrorTime, carApiTransientErrors
+        global carApiTransientRetrySecs, carApiBusesRetrySecs, \
+               carApiLocationCacheSecs
+
+        if(self.stream != None and self.stream.fresh()
+           and self.timeLocationUpdated > 0
+        ):
+            # The stream keeps lat and lon up to date, so there's no need to
+            # ask the car where it is.
+            if(debugLevel >= 8):
+                print(time_now() + ': Vehicle ' + str(self.ID) + ' location from stream: lat='
+                      + str(self.lat) + ', lon=' + str(self.lon))
+            return True
+
+        if(time.time() - self.timeLocationPolled < carApiLocationCacheSecs):
+            # We asked the car where it is moments ago, probably just before
+            # car_api_charge() queued a retry task to send the charge command.
+            return True
 
         if(self.ready() == False):
             return False
 
-        apiResponseDict = {}
-
+        endpoint = 'data_request/drive_state'
         cmd = 'curl -s -m 60 -H "accept: application/json" -H "Authorization:Bearer ' + \
               carApiBearerToken + \
               '" "https://owner-api.teslamotors.com/api/1/vehicles/' + \
-              str(self.ID) + '/data_request/drive_state"'
-
-        # Retry up to 3 times on certain errors.
-        for retryCount in range(0, 3):
-            if(debugLevel >= 8):
-                print(time_now() + ': Car API cmd', cmd)
-            try:
-                apiResponseDict = json.loads(run_process(cmd).decode('ascii'))
-                # This error can happen here as well:
-                #   {'response': {'reason': 'could_not_wake_buses', 'result': False}}
-                # This one is somewhat common:
-                #   {'response': None, 'error': 'vehicle unavailable: {:error=>"vehicle unavailable:"}', 'error_description': ''}
-            except json.decoder.JSONDecodeError:
-                pass
+              str(self.ID) + '/' + endpoint + '"'
 
-            try:
-                if(debugLevel >= 4):
-                    print(time_now() + ': Car API vehicle GPS location', apiResponseDict, '\n')
-
-                if('error' in apiResponseDict):
-                    foundKnownError = False
-                    error = apiResponseDict['error']
-                    for knownError in carApiTransientErrors:
-                        if(knownError == error[0:len(knownError)]):
-                            # I see these errors often enough that I think
-                            # it's worth re-trying in 1 minute rather than
-                            # waiting carApiErrorRetryMins minutes for retry
-                            # in the standard error handler.
-                            if(debugLevel >= 1):
-                                print(time_now() + ": Car API returned '"
-                                      + error
-                                      + "' when trying to get GPS location.  Try again in 1 minute.")
-                            time.sleep(60)
-                            foundKnownError = True
-                            break
-                    if(foundKnownError):
-                        continue
+        if(debugLevel >= 8):
+            print(time_now() + ': Car API cmd', cmd)
+
+        # This error can happen here as well:
+        #   {'response': {'reason': 'could_not_wake_buses', 'result': False}}
+        # This one is somewhat common:
+        #   {'response': None, 'error': 'vehicle unavailable: {:error=>"vehicle unavailable:"}', 'error_description': ''}
+        apiResponseDict = car_api_call(cmd, endpoint, self)
+        if(apiResponseDict == None):
+            return False
 
-                response = apiResponseDict['response']
+        try:
+            if(debugLevel >= 4):
+                print(time_now() + ': Car API vehicle GPS location', apiResponseDict, '\n')
+
+            if(car_api_transient_error(apiResponseDict)):
+                # I see these errors often enough that I think it's worth
+                # re-trying in 1 minute rather than waiting
+                # carApiErrorRetryMins minutes for retry in the standard
+                # error handler. Open this car's breaker for that long
+                # instead of sleeping here.
+                if(debugLevel >= 1):
+                    print(time_now() + ": Car API returned '"
+                          + str(apiResponseDict['error'])
+                          + "' when trying to get GPS location.  Try again in "
+                          + str(carApiTransientRetrySecs) + " seconds.")
+                car_api_result(endpoint, self, False, carApiTransientRetrySecs,
+                               apiResponseDict = apiResponseDict)
+                return False
 
-                # A successful call to drive_state will not contain a
-                # response['reason'], so we check if the 'reason' key exists.
-                if('reason' in response and response['reason'] == 'could_not_wake_buses'):
-                    # Retry after 5 seconds.  See notes in car_api_charge where
-                    # 'could_not_wake_buses' is handled.
-                    time.sleep(5)
-                    continue
+            response = apiResponseDict['response']
 
-                self.lat = response['latitude']
-                self.lon = response['longitude']
-            except (KeyError, TypeError):
-                # This catches cases like trying to access
-                # apiResponseDict['response'] when 'response' doesn't exist in
-                # apiResponseDict.
-                if(debugLevel >= 1):
-                    print(time_now() + ": ERROR: Can't get GPS location of vehicle " + str(self.ID) + \
-                          ".  Will try again later.")
-                self.lastErrorTime = time.time()
+            # A successful call to drive_state will not contain a
+            # response['reason'], so we check if the 'reason' key exists.
+            if('reason' in response and response['reason'] == 'could_not_wake_buses'):
+                # Retry after 5 seconds.  See notes in car_api_charge where
+                # 'could_not_wake_buses' is handled. retry_soon() tells
+                # car_api_charge to queue the retry.
+                car_api_result(endpoint, self, False, carApiBusesRetrySecs,
+                               apiResponseDict = apiResponseDict)
                 return False
 
-            return True
+            self.lat = response['latitude']
+            self.lon = response['longitude']
+            self.timeLocationUpdated = time.time()
+            self.timeLocationPolled = self.timeLocationUpdated
+        except (KeyError, TypeError):
+            # This catches cases like trying to access
+            # apiResponseDict['response'] when 'response' doesn't exist in
+            # apiResponseDict.
+            if(debugLevel >= 1):
+                print(time_now() + ": ERROR: Can't get GPS location of vehicle " + str(self.ID) + \
+                      ".  Will try again later.")
+            car_api_result(endpoint, self, False,
+                           apiResponseDict = apiResponseDict)
+            return False
+
+        car_api_result(endpoint, self, True)
+        return True
+
+    def retry_soon(self):
+        # Return True if the last request about this car failed with an error
+        # like 'could_not_wake_buses' that usually clears up if we retry in
+        # carApiBusesRetrySecs.
+        global carApiBusesRetrySecs
+
+        return (self.breaker.state == 'open'
+                and self.breaker.openSecs <= carApiBusesRetrySecs)
+
+
+    def update_charge_state(self):
+        # Get the charger state and current the car reports. Unlike
+        # update_location(), don't retry on errors. This is only used to match
+        # cars to TWCs and we'll get another chance next time the car is awake.
+        if(self.ready() == False):
+            return False
+
+        endpoint = 'data_request/charge_state'
+        cmd = 'curl -s -m 60 -H "accept: application/json" -H "Authorization:Bearer ' + \
+              carApiBearerToken + \
+              '" "https://owner-api.teslamotors.com/api/1/vehicles/' + \
+              str(self.ID) + '/' + endpoint + '"'
+        if(debugLevel >= 8):
+            print(time_now() + ': Car API cmd', cmd)
+        apiResponseDict = car_api_call(cmd, endpoint, self)
+        if(apiResponseDict == None):
+            return False
+
+        try:
+            if(debugLevel >= 4):
+                print(time_now() + ': Car API vehicle charge state', apiResponseDict, '\n')
+
+            response = apiResponseDict['response']
+            self.chargingState = response['charging_state']
+            self.chargerActualCurrent = response['charger_actual_current']
+            if(self.chargerActualCurrent == None):
+                self.chargerActualCurrent = 0
+            self.timeChargeStateUpdated = time.time()
+        except (KeyError, TypeError):
+            # This catches cases like trying to access
+            # apiResponseDict['response'] when 'response' doesn't exist in
+            # apiResponseDict.
+            if(debugLevel >= 1):
+                print(time_now() + ": ERROR: Can't get charge state of vehicle " + str(self.ID) + \
+                      ".  Will try again later.")
+            car_api_result(endpoint, self, False, carApiTransientRetrySecs,
+                           apiResponseDict = apiResponseDict)
+            return False
+
+        car_api_result(endpoint, self, True)
+        return True
 
 
 #
@@ -1471,6 +6532,20 @@ class TWCSlave:
     reportedAmpsActual = 0
     reportedState = 0
 
+    # Volts on phase A and lifetime kWh delivered from the last kWh and voltage
+    # report, or 0 and None if the TWC hasn't sent one.
+    reportedVolts = 0
+    reportedKWhCounter = None
+
+    # ChargingSession for the car plugged in now, or None.
+    session = None
+
+    # What print_status last printed, as (centi-amps actual, state,
+    # centi-amps max, the rest of the slave heartbeat, master heartbeat,
+    # masterTWCID), or None to print the next heartbeat no matter what.
+    lastStatusPrinted = None
+    timeLastStatusPrinted = 0
+
     # reportedAmpsActual frequently changes by small amounts, like 5.14A may
     # frequently change to 5.23A and back.
     # reportedAmpsActualSignificantChangeMonitor is set to reportedAmpsActual
@@ -1487,76 +6562,156 @@ class TWCSlave:
 
     lastAmpsOffered = -1
     timeLastAmpsOfferedChanged = time.time()
-    lastHeartbeatDebugOutput = ''
-    timeLastHeartbeatDebugOutput = 0
     wiringMaxAmps = wiringMaxAmpsPerTWC
 
+    # pluggedIn is our guess from reportedState of whether a car is plugged in.
+    pluggedIn = False
+    timePluggedInChanged = 0
+
+    # vehicleMatchScores maps car API vehicle IDs to how well each car's
+    # reported charge state has matched this TWC. matchedVehicleID is the car
+    # we're confident is plugged in here, or None. See correlate_vehicle().
+    vehicleMatchScores = None
+    matchedVehicleID = None
+    matchedVehicleConfidence = 0
+
+    # Attributes saved in the fleet snapshot so that after a restart we can
+    # keep offering the same amps and keep the same hysteresis timers. See
+    # save_fleet_snapshot().
+    snapshotAttrs = ['protocolVersion', 'minAmpsTWCSupports',
+                     'reportedAmpsMax', 'reportedAmpsActual', 'reportedState',
+                     'reportedVolts', 'reportedKWhCounter',
+                     'reportedAmpsActualSignificantChangeMonitor',
+                     'timeReportedAmpsActualChangedSignificantly',
+                     'lastAmpsOffered', 'timeLastAmpsOfferedChanged',
+                     'pluggedIn', 'timePluggedInChanged',
+                     'matchedVehicleID', 'matchedVehicleConfidence']
+
     def __init__(self, TWCID, maxAmps):
         self.TWCID = TWCID
         self.maxAmps = maxAmps
+        self.vehicleMatchScores = {}
+
+    def update_session(self, now):
+        # Called after each heartbeat from this TWC to open a ChargingSession
+        # when a car is plugged in, add to it while the car stays plugged in,
+        # and store it when the car is unplugged.
+        if(self.session != None):
+            self.session.update(self, now)
+            if(not self.pluggedIn):
+                self.end_session()
+        elif(self.pluggedIn):
+            self.session = ChargingSession(self, now)
+
+    def end_session(self):
+        if(self.session == None):
+            return
+
+        record = self.session.record()
+        self.session = None
+        log(1, ": TWC %s charging session ended: %.2fkWh%s in %dmin, peak %.2fA, "
+            "vehicle %s", record['twcid'], record['kWh'],
+            ' (metered)' if record['kWhMetered'] else '',
+            record['durationSecs'] / 60, record['peakAmps'], record['vehicleID'])
+        queue_background_task({'cmd':'saveSession', 'TWCID':self.TWCID,
+                               'record':record})
+
+    def snapshot(self):
+        state = {
+            'TWCID': hex_str(self.TWCID),
+            'maxAmps': self.maxAmps,
+            'masterHeartbeatData': hex_str(self.masterHeartbeatData),
+            # JSON only allows string keys, so store vehicle IDs in pairs.
+            'vehicleMatchScores': list(self.vehicleMatchScores.items()),
+            'session': (self.session.snapshot() if self.session != None else None),
+        }
+        for name in self.snapshotAttrs:
+            state[name] = getattr(self, name)
+        return state
+
+    def restore(self, state, now):
+        for name in self.snapshotAttrs:
+            if(name in state):
+                setattr(self, name, state[name])
+        self.masterHeartbeatData = bytearray.fromhex(state['masterHeartbeatData'])
+        self.vehicleMatchScores = dict(state.get('vehicleMatchScores', []))
+
+        # We haven't heard from the slave while we were restarting, so give it
+        # the usual 26 seconds to answer our first heartbeat before we give up
+        # on it.
+        self.timeLastRx = now
+
+        if(state.get('session') != None):
+            self.session = ChargingSession(self, now)
+            self.session.restore(state['session'])
 
     def print_status(self, heartbeatData):
         global fakeMaster, masterTWCID
 
         try:
-            debugOutput = ": SHB %02X%02X: %02X %05.2f/%05.2fA %02X%02X" % \
-                (self.TWCID[0], self.TWCID[1], heartbeatData[0],
-                (((heartbeatData[3] << 8) + heartbeatData[4]) / 100),
-                (((heartbeatData[1] << 8) + heartbeatData[2]) / 100),
-                heartbeatData[5], heartbeatData[6]
-                )
+            # Only output once-per-second heartbeat debug info when it's
+            # different from the last output or if the only change has been amps
+            # in use and it's changed by 1.0 or more. Also output if it's been
+            # 10 mins since the last output or if debugLevel is turned up to 11.
+            #
+            # Nearly every heartbeat is the same as the last one, so we decide
+            # using the numbers in it and only build the text when we're going
+            # to print it.
+            now = time.time()
+            centiAmpsActual = (heartbeatData[3] << 8) + heartbeatData[4]
+            centiAmpsMax = (heartbeatData[1] << 8) + heartbeatData[2]
+            last = self.lastStatusPrinted
+            if(last != None
+               and debugLevel < 11
+               and abs(centiAmpsActual - last[0]) < 100
+               and heartbeatData[0] == last[1]
+               and centiAmpsMax == last[2]
+               and heartbeatData[5:] == last[3]
+               and self.masterHeartbeatData == last[4]
+               and (fakeMaster or masterTWCID == last[5])
+               and now - self.timeLastStatusPrinted <= 600
+            ):
+                return
+
+            self.lastStatusPrinted = (centiAmpsActual, heartbeatData[0], centiAmpsMax,
+                                      bytes(heartbeatData[5:]),
+                                      bytes(self.masterHeartbeatData),
+                                      (None if fakeMaster else bytes(masterTWCID)))
+            self.timeLastStatusPrinted = now
+
+            fmt = ": SHB %02X%02X: %02X %05.2f/%05.2fA %02X%02X"
+            args = [self.TWCID[0], self.TWCID[1], heartbeatData[0],
+                    centiAmpsActual / 100, centiAmpsMax / 100,
+                    heartbeatData[5], heartbeatData[6]]
             if(self.protocolVersion == 2):
-                debugOutput += (" %02X%02X" % (heartbeatData[7], heartbeatData[8]))
-            debugOutput += "  M"
+                fmt += " %02X%02X"
+                args += [heartbeatData[7], heartbeatData[8]]
+            fmt += "  M"
 
             if(not fakeMaster):
-                debugOutput += " %02X%02X" % (masterTWCID[0], masterTWCID[1])
-
-            debugOutput += ": %02X %05.2f/%05.2fA %02X%02X" % \
-                    (self.masterHeartbeatData[0],
-                    (((self.masterHeartbeatData[3] << 8) + self.masterHeartbeatData[4]) / 100),
-                    (((self.masterHeartbeatData[1] << 8) + self.masterHeartbeatData[2]) / 100),
-                    self.masterHeartbeatData[5], self.masterHeartbeatData[6])
+                fmt += " %02X%02X"
+                args += [masterTWCID[0], masterTWCID[1]]
+
+            fmt += ": %02X %05.2f/%05.2fA %02X%02X"
+            args += [self.masterHeartbeatData[0],
+                     ((self.masterHeartbeatData[3] << 8) + self.masterHeartbeatData[4]) / 100,
+                     ((self.masterHeartbeatData[1] << 8) + self.masterHeartbeatData[2]) / 100,
+                     self.masterHeartbeatData[5], self.masterHeartbeatData[6]]
             if(self.protocolVersion == 2):
-                debugOutput += (" %02X%02X" %
-                    (self.masterHeartbeatData[7], self.masterHeartbeatData[8]))
+                fmt += " %02X%02X"
+                args += [self.masterHeartbeatData[7], self.masterHeartbeatData[8]]
 
-            # Only output once-per-second heartbeat debug info when it's
-            # different from the last output or if the only change has been amps
-            # in use and it's only changed by 1.0 or less. Also output f it's
-            # been 10 mins since the last output or if debugLevel is turned up
-            # to 11.
-            lastAmpsUsed = 0
-            ampsUsed = 1
-            debugOutputCompare = debugOutput
-            m1 = re.search(r'SHB ....: .. (..\...)/', self.lastHeartbeatDebugOutput)
-            if(m1):
-                lastAmpsUsed = float(m1.group(1))
-            m2 = re.search(r'SHB ....: .. (..\...)/', debugOutput)
-            if(m2):
-                ampsUsed = float(m2.group(1))
-                if(m1):
-                    debugOutputCompare = debugOutputCompare[0:m2.start(1)] + \
-                        self.lastHeartbeatDebugOutput[m1.start(1):m1.end(1)] + \
-                        debugOutputCompare[m2.end(1):]
-            if(
-                debugOutputCompare != self.lastHeartbeatDebugOutput
-                or abs(ampsUsed - lastAmpsUsed) >= 1.0
-                or time.time() - self.timeLastHeartbeatDebugOutput > 600
-                or debugLevel >= 11
-            ):
-                print(time_now() + debugOutput)
-                self.lastHeartbeatDebugOutput = debugOutput
-                self.timeLastHeartbeatDebugOutput = time.time()
+            log(0, fmt, *args)
         except IndexError:
             # This happens if we try to access, say, heartbeatData[8] when
             # len(heartbeatData) < 9. This was happening due to a bug I fixed
             # but I may as well leave this here just in case.
             if(len(heartbeatData) != (7 if self.protocolVersion == 1 else 9)):
-                print(time_now() + ': Error in print_status displaying heartbeatData',
-                      heartbeatData, 'based on msg', hex_str(msg))
+                log(0, ': Error in print_status displaying heartbeatData %s based on msg %s',
+                    heartbeatData, msg)
             if(len(self.masterHeartbeatData) != (7 if self.protocolVersion == 1 else 9)):
-                print(time_now() + ': Error in print_status displaying masterHeartbeatData', self.masterHeartbeatData)
+                log(0, ': Error in print_status displaying masterHeartbeatData %s',
+                    self.masterHeartbeatData)
 
     def send_slave_heartbeat(self, masterID):
         # Send slave heartbeat
@@ -1809,29 +6964,33 @@ class TWCSlave:
                 # more than once per minute. Once the car gets the message to
                 # stop, reportedAmpsActualSignificantChangeMonitor should drop
                 # to near zero within a few seconds.
-                # WARNING: If you own two vehicles and one is charging at home but
+                # WARNING: Until correlate_vehicle() has matched a car to this
+                # TWC, if you own two vehicles and one is charging at home but
                 # the other is charging away from home, this command will stop
                 # them both from charging.  If the away vehicle is not currently
                 # charging, I'm not sure if this would prevent it from charging
                 # when next plugged in.
-                queue_background_task({'cmd':'charge', 'charge':False})
+                queue_background_task({'cmd':'charge', 'charge':False,
+                                       'TWCID':self.TWCID})
             elif(self.lastAmpsOffered >= 5.0 and self.reportedAmpsActual < 2.0
                  and self.reportedState != 0x02
             ):
                 # Car is not charging and is not reporting an error state, so
                 # try starting charge via car api.
-                queue_background_task({'cmd':'charge', 'charge':True})
+                queue_background_task({'cmd':'charge', 'charge':True,
+                                       'TWCID':self.TWCID})
             elif(self.reportedAmpsActual > 4.0):
-                # At least one plugged in car is successfully charging. We don't
-                # know which car it is, so we must set
-                # vehicle.stopAskingToStartCharging = False on all vehicles such
-                # that if any vehicle is not charging without us calling
-                # car_api_charge(False), we'll try to start it charging again at
-                # least once. This probably isn't necessary but might prevent
-                # some unexpected case from never starting a charge. It also
-                # seems less confusing to see in the output that we always try
-                # to start API charging after the car stops taking a charge.
-                for vehicle in carApiVehicles:
+                # At least one plugged in car is successfully charging. Unless
+                # we've matched a car to this TWC, we don't know which car it
+                # is, so we must set vehicle.stopAskingToStartCharging = False
+                # on all vehicles such that if any vehicle is not charging
+                # without us calling car_api_charge(False), we'll try to start
+                # it charging again at least once. This probably isn't
+                # necessary but might prevent some unexpected case from never
+                # starting a charge. It also seems less confusing to see in the
+                # output that we always try to start API charging after the car
+                # stops taking a charge.
+                for vehicle in vehicles_for_twc(self.TWCID):
                     vehicle.stopAskingToStartCharging = False
 
         send_msg(bytearray(b'\xFB\xE0') + fakeTWCID + bytearray(self.TWCID)
@@ -1844,7 +7003,8 @@ class TWCSlave:
                maxAmpsToDivideAmongSlaves, wiringMaxAmpsAllTWCs, \
                timeLastGreenEnergyCheck, greenEnergyAmpsOffset, \
                slaveTWCRoundRobin, spikeAmpsToCancel6ALimit, \
-               chargeNowAmps, chargeNowTimeEnd, minAmpsPerTWC
+               chargeNowAmps, chargeNowTimeEnd, minAmpsPerTWC, \
+               scheduledAmpsActive
 
         now = time.time()
         self.timeLastRx = now
@@ -1853,6 +7013,16 @@ class TWCSlave:
         self.reportedAmpsActual = ((heartbeatData[3] << 8) + heartbeatData[4]) / 100
         self.reportedState = heartbeatData[0]
 
+        # State 00 usually means no car is plugged in, though I've seen a car at
+        # its target charge report 00 too. 02 is an error and 05 lasts a second
+        # at a time during any other state, so neither tells us anything.
+        if(self.reportedState != 0x02 and self.reportedState != 0x05):
+            pluggedIn = (self.reportedState != 0x00 or self.reportedAmpsActual >= 1.0)
+            if(pluggedIn != self.pluggedIn):
+                self.pluggedIn = pluggedIn
+                self.timePluggedInChanged = now
+                twc_plug_event(self)
+
         # self.lastAmpsOffered is initialized to -1.
         # If we find it at that value, set it to the current value reported by the
         # TWC.
@@ -1923,6 +7093,7 @@ class TWCSlave:
                    and (scheduledAmpsDaysBitmap & (1 << ltNow.tm_wday))
                 ):
                    blnUseScheduledAmps = 1
+        scheduledAmpsActive = (blnUseScheduledAmps == 1)
 
         if(chargeNowTimeEnd > 0 and chargeNowTimeEnd < now):
             # We're beyond the one-day period where we want to charge at
@@ -1934,8 +7105,7 @@ class TWCSlave:
             # We're still in the one-day period where we want to charge at
             # chargeNowAmps, ignoring all other charging criteria.
             maxAmpsToDivideAmongSlaves = chargeNowAmps
-            if(debugLevel >= 10):
-                print(time_now() + ': Charge at chargeNowAmps %.2f' % (chargeNowAmps))
+            log(10, ': Charge at chargeNowAmps %.2f', chargeNowAmps)
         elif(blnUseScheduledAmps):
             # We're within the scheduled hours that we need to provide a set
             # number of amps.
@@ -1963,11 +7133,9 @@ class TWCSlave:
         if(maxAmpsToDivideAmongSlaves > wiringMaxAmpsAllTWCs):
             # Never tell the slaves to draw more amps than the physical charger
             # wiring can handle.
-            if(debugLevel >= 1):
-                print(time_now() +
-                    " ERROR: maxAmpsToDivideAmongSlaves " + str(maxAmpsToDivideAmongSlaves) +
-                    " > wiringMaxAmpsAllTWCs " + str(wiringMaxAmpsAllTWCs) +
-                    ".\nSee notes above wiringMaxAmpsAllTWCs in the 'Configuration parameters' section.")
+            log(1, " ERROR: maxAmpsToDivideAmongSlaves %s > wiringMaxAmpsAllTWCs %s."
+                "\nSee notes above wiringMaxAmpsAllTWCs in the 'Configuration parameters' section.",
+                maxAmpsToDivideAmongSlaves, wiringMaxAmpsAllTWCs)
             maxAmpsToDivideAmongSlaves = wiringMaxAmpsAllTWCs
 
         # Determine how many cars are charging and how many amps they're using
@@ -1988,11 +7156,8 @@ class TWCSlave:
         if(desiredAmpsOffered > fairShareAmps):
             desiredAmpsOffered = fairShareAmps
 
-        if(debugLevel >= 10):
-            print("desiredAmpsOffered reduced from " + str(maxAmpsToDivideAmongSlaves)
-                  + " to " + str(desiredAmpsOffered)
-                  + " with " + str(numCarsCharging)
-                  + " cars charging.")
+        log(10, ": desiredAmpsOffered reduced from %s to %s with %d cars charging.",
+            maxAmpsToDivideAmongSlaves, desiredAmpsOffered, numCarsCharging)
 
         backgroundTasksLock.release()
 
@@ -2019,10 +7184,8 @@ class TWCSlave:
                 # wiringMaxAmpsAllTWCs for a few seconds, but I don't think
                 # exceeding by up to minAmpsTWCSupports for such a short period
                 # of time will cause problems.
-                if(debugLevel >= 10):
-                    print("desiredAmpsOffered increased from " + str(desiredAmpsOffered)
-                          + " to " + str(self.minAmpsTWCSupports)
-                          + " (self.minAmpsTWCSupports)")
+                log(10, ": desiredAmpsOffered increased from %s to %s (self.minAmpsTWCSupports)",
+                    desiredAmpsOffered, self.minAmpsTWCSupports)
                 desiredAmpsOffered = self.minAmpsTWCSupports
             else:
                 # There is not enough power available to give each car
@@ -2053,12 +7216,10 @@ class TWCSlave:
                 # also wakes it) and next time it wakes, it will see there's power
                 # and start charging. Without energy saver mode, the car should
                 # begin charging within about 10 seconds of changing this value.
-                if(debugLevel >= 10):
-                    print("desiredAmpsOffered reduced to 0 from " + str(desiredAmpsOffered)
-                          + " because maxAmpsToDivideAmongSlaves "
-                          + str(maxAmpsToDivideAmongSlaves)
-                          + " / numCarsCharging " + str(numCarsCharging)
-                          + " < minAmpsToOffer " + str(minAmpsToOffer))
+                log(10, ": desiredAmpsOffered reduced to 0 from %s because "
+                    "maxAmpsToDivideAmongSlaves %s / numCarsCharging %d < minAmpsToOffer %s",
+                    desiredAmpsOffered, maxAmpsToDivideAmongSlaves, numCarsCharging,
+                    minAmpsToOffer)
                 desiredAmpsOffered = 0
 
             if(
@@ -2130,14 +7291,13 @@ class TWCSlave:
                     # unplugged, the charge port will turn green and start charging
                     # for a minute. This lets the owner quickly see that TWCManager
                     # is working properly each time they return home and plug in.
-                    if(debugLevel >= 10):
-                        print("Don't stop charging yet because: " +
-                              'time - self.timeLastAmpsOfferedChanged ' +
-                              str(int(now - self.timeLastAmpsOfferedChanged)) +
-                              ' < 60 or time - self.timeReportedAmpsActualChangedSignificantly ' +
-                              str(int(now - self.timeReportedAmpsActualChangedSignificantly)) +
-                              ' < 60 or self.reportedAmpsActual ' + str(self.reportedAmpsActual) +
-                              ' < 4')
+                    log(10, ": Don't stop charging yet because: "
+                        "time - self.timeLastAmpsOfferedChanged %d < 60 or "
+                        "time - self.timeReportedAmpsActualChangedSignificantly %d < 60 or "
+                        "self.reportedAmpsActual %s < 4",
+                        now - self.timeLastAmpsOfferedChanged,
+                        now - self.timeReportedAmpsActualChangedSignificantly,
+                        self.reportedAmpsActual)
                     desiredAmpsOffered = minAmpsToOffer
         else:
             # We can tell the TWC how much power to use in 0.01A increments, but
@@ -2155,13 +7315,10 @@ class TWCSlave:
                 # Keep charger off for at least 60 seconds before turning back
                 # on. See reasoning above where I don't turn the charger off
                 # till it's been on at least 60 seconds.
-                if(debugLevel >= 10):
-                    print("Don't start charging yet because: " +
-                          'self.lastAmpsOffered ' +
-                          str(self.lastAmpsOffered) + " == 0 " +
-                          'and time - self.timeLastAmpsOfferedChanged ' +
-                          str(int(now - self.timeLastAmpsOfferedChanged)) +
-                          " < 60")
+                log(10, ": Don't start charging yet because: "
+                    "self.lastAmpsOffered %s == 0 and "
+                    "time - self.timeLastAmpsOfferedChanged %d < 60",
+                    self.lastAmpsOffered, now - self.timeLastAmpsOfferedChanged)
                 desiredAmpsOffered = self.lastAmpsOffered
             else:
                 # Mid Oct 2017, Tesla pushed a firmware update to their cars
@@ -2181,13 +7338,12 @@ class TWCSlave:
                 # spikeAmpsToCancel6ALimit of power draw. In fact, the car is
                 # slow enough to respond that even with 10s at 21A the most I've
                 # seen it actually draw starting at 6A is 13A.
-                if(debugLevel >= 10):
-                    print('desiredAmpsOffered=' + str(desiredAmpsOffered) +
-                          ' spikeAmpsToCancel6ALimit=' + str(spikeAmpsToCancel6ALimit) +
-                          ' self.lastAmpsOffered=' + str(self.lastAmpsOffered) +
-                          ' self.reportedAmpsActual=' + str(self.reportedAmpsActual) +
-                          ' now - self.timeReportedAmpsActualChangedSignificantly=' +
-                          str(int(now - self.timeReportedAmpsActualChangedSignificantly)))
+                log(10, ': desiredAmpsOffered=%s spikeAmpsToCancel6ALimit=%s '
+                    'self.lastAmpsOffered=%s self.reportedAmpsActual=%s '
+                    'now - self.timeReportedAmpsActualChangedSignificantly=%d',
+                    desiredAmpsOffered, spikeAmpsToCancel6ALimit,
+                    self.lastAmpsOffered, self.reportedAmpsActual,
+                    now - self.timeReportedAmpsActualChangedSignificantly)
 
                 if(
                     # If we just moved from a lower amp limit to
@@ -2249,8 +7405,7 @@ class TWCSlave:
                         # spikeAmpsToCancel6ALimit as the first value it saw.
                         # The car limited itself to 6A indefinitely. In this
                         # case, the fix is to offer it lower amps.
-                        if(debugLevel >= 1):
-                            print(time_now() + ': Car stuck when offered spikeAmpsToCancel6ALimit.  Offering 2 less.')
+                        log(1, ': Car stuck when offered spikeAmpsToCancel6ALimit.  Offering 2 less.')
                         desiredAmpsOffered = spikeAmpsToCancel6ALimit - 2.0
                     elif(now - self.timeLastAmpsOfferedChanged > 5):
                         # self.lastAmpsOffered hasn't gotten the car to draw
@@ -2274,9 +7429,8 @@ class TWCSlave:
                     # limits more often than every 5 seconds. This has the side
                     # effect of holding spikeAmpsToCancel6ALimit set earlier for
                     # 5 seconds to make sure the car sees it.
-                    if(debugLevel >= 10):
-                        print('Reduce amps: time - self.timeLastAmpsOfferedChanged ' +
-                            str(int(now - self.timeLastAmpsOfferedChanged)))
+                    log(10, ': Reduce amps: time - self.timeLastAmpsOfferedChanged %d',
+                        now - self.timeLastAmpsOfferedChanged)
                     if(now - self.timeLastAmpsOfferedChanged < 5):
                         desiredAmpsOffered = self.lastAmpsOffered
 
@@ -2324,16 +7478,17 @@ class TWCSlave:
             self.masterHeartbeatData = overrideMasterHeartbeatData
 
         if(debugLevel >= 1):
+            stage = loopTimer.enter('print')
             self.print_status(heartbeatData)
+            loopTimer.enter(stage)
 
 
     def set_last_amps_offered(self, desiredAmpsOffered):
         # self.lastAmpsOffered should only be changed using this sub.
         global debugLevel
 
-        if(debugLevel >= 10):
-            print("set_last_amps_offered(TWCID=" + hex_str(self.TWCID) +
-                  ", desiredAmpsOffered=" + str(desiredAmpsOffered) + ")")
+        log(10, ": set_last_amps_offered(TWCID=%s, desiredAmpsOffered=%s)",
+            self.TWCID, desiredAmpsOffered)
 
         if(desiredAmpsOffered != self.lastAmpsOffered):
             oldLastAmpsOffered = self.lastAmpsOffered
@@ -2357,20 +7512,20 @@ class TWCSlave:
                     # 'if(maxAmpsToDivideAmongSlaves / numCarsCharging > minAmpsToOffer):'
                     self.lastAmpsOffered = self.minAmpsTWCSupports
 
-                print("WARNING: Offering slave TWC %02X%02X %.1fA instead of " \
-                    "%.1fA to avoid overloading wiring shared by all TWCs." % (
-                    self.TWCID[0], self.TWCID[1], self.lastAmpsOffered, desiredAmpsOffered))
+                log(0, ": WARNING: Offering slave TWC %02X%02X %.1fA instead of "
+                    "%.1fA to avoid overloading wiring shared by all TWCs.",
+                    self.TWCID[0], self.TWCID[1], self.lastAmpsOffered,
+                    desiredAmpsOffered)
 
             if(self.lastAmpsOffered > self.wiringMaxAmps):
                 # We reach this case frequently in some configurations, such as
                 # when two 80A TWCs share a 125A line.  Therefore, don't print
                 # an error.
                 self.lastAmpsOffered = self.wiringMaxAmps
-                if(debugLevel >= 10):
-                    print("Offering slave TWC %02X%02X %.1fA instead of " \
-                        "%.1fA to avoid overloading the TWC rated at %.1fA." % (
-                        self.TWCID[0], self.TWCID[1], self.lastAmpsOffered,
-                        desiredAmpsOffered, self.wiringMaxAmps))
+                log(10, ": Offering slave TWC %02X%02X %.1fA instead of "
+                    "%.1fA to avoid overloading the TWC rated at %.1fA.",
+                    self.TWCID[0], self.TWCID[1], self.lastAmpsOffered,
+                    desiredAmpsOffered, self.wiringMaxAmps)
 
             if(self.lastAmpsOffered != oldLastAmpsOffered):
                 self.timeLastAmpsOfferedChanged = time.time()
@@ -2392,6 +7547,9 @@ dataLen = 0
 ignoredData = bytearray()
 msg = bytearray()
 msgLen = 0
+timeDataArrived = 0
+timeMsgFirstByte = 0
+timeMsgLastByte = 0
 lastTWCResponseMsg = None
 overrideMasterHeartbeatData = b''
 
@@ -2416,6 +7574,14 @@ chargeNowTimeEnd = 0
 
 spikeAmpsToCancel6ALimit = 16
 timeLastGreenEnergyCheck = 0
+
+# Watts generated at the last green energy check and when that was, or -1 and 0
+# if we haven't checked.
+greenEnergyWatts = -1
+timeGreenEnergyWatts = 0
+
+# True while scheduledAmpsMax applies.
+scheduledAmpsActive = False
 hourResumeTrackGreenEnergy = -1
 kWhDelivered = 119
 timeLastkWhDelivered = time.time()
@@ -2427,11 +7593,288 @@ timeLastkWhSaved = time.time()
 # not match the script directory.
 settingsFileName = re.sub(r'/[^/]+$', r'/TWCManagerSettings.txt', __file__)
 nonScheduledAmpsMax = -1
+
+# Settings stored in settingsFileName, in the order we write them, and how to
+# parse each one. 'time' is a float stored as whole seconds.
+settingsSchema = {
+    'nonScheduledAmpsMax': 'int',
+    'scheduledAmpsMax': 'int',
+    'scheduledAmpsStartHour': 'float',
+    'scheduledAmpsEndHour': 'float',
+    'scheduledAmpsDaysBitmap': 'int',
+    'hourResumeTrackGreenEnergy': 'float',
+    'carApiBearerToken': 'str',
+    'carApiRefreshToken': 'str',
+    'carApiTokenExpireTime': 'time',
+    'homeLat': 'float',
+    'homeLon': 'float',
+}
+
+# Counters that change too often to store in settingsFileName. counterJournal
+# saves them to counterJournalFileName instead. Only ever add names to the end
+# of this list because the journal identifies counters by their index in it.
+counterJournalNames = ['kWhDelivered']
+counterJournalFileName = re.sub(r'/[^/]+$', r'/TWCManagerCounters.journal', __file__)
+
+# Seconds between writing changed counters to the journal. We lose at most
+# this much of kWhDelivered if the pi loses power. The journal is compacted into
+# a snapshot file when it grows past counterJournalMaxBytes.
+counterJournalSyncSecs = 30
+counterJournalMaxBytes = 64*1024
+counterJournal = None
+
+# Record every slave heartbeat in sampleStoreDir. See SampleStore. Samples are
+# written to disk in batches of sampleStoreBatchRows or every
+# sampleStoreFlushSecs. Column files grow sampleStoreSegmentRows rows at a time.
+sampleStoreEnabled = True
+sampleStoreDir = re.sub(r'/[^/]+$', r'/samples', __file__)
+sampleStoreBatchRows = 60
+sampleStoreFlushSecs = 10
+sampleStoreSegmentRows = 86400
+sampleStore = None
+
+# Per minute, hour and day totals for each TWC and the site. See Rollups.
+# Minute and hour totals are forgotten after rollupsRetentionSecs. Totals are
+# saved to rollupsFileName every rollupsSaveSecs. Heartbeats more than
+# rollupsMaxGapSecs apart count as rollupsMaxGapSecs apart.
+rollupsFileName = re.sub(r'/[^/]+$', r'/TWCManagerRollups.json', __file__)
+rollupsRetentionSecs = {60: 2*24*60*60, 3600: 90*24*60*60, 86400: None}
+rollupsSaveSecs = 5*60
+rollupsMaxGapSecs = 10
+rollups = None
+
+# Finished charging sessions are stored in sessionsFileName. See SessionStore.
+# As with rollups, heartbeats more than sessionsMaxGapSecs apart count as
+# sessionsMaxGapSecs apart.
+sessionsFileName = re.sub(r'/[^/]+$', r'/TWCManagerSessions.db', __file__)
+sessionsMaxGapSecs = 10
+sessionStore = None
+
+# When we're the fake master, we save our slaves and how much we're offering
+# each of them to fleetSnapshotFileName every fleetSnapshotSecs and when we
+# exit. On start, a snapshot less than fleetSnapshotMaxAgeSecs old lets us skip
+# linkready and keep heartbeating the same slaves. Slaves that go too long
+# without a heartbeat stop charging and wait for a master to link with, so an
+# older snapshot isn't worth trusting. fleetSnapshotGlobals lists the global
+# control state saved with the slaves.
+#
+# A snapshot only has to outlive a restart, not a power loss, so keep it in
+# RAM rather than rewrite a file on the SD card every fleetSnapshotSecs.
+fleetSnapshotFileName = '/dev/shm/TWCManagerFleet.json'
+fleetSnapshotSecs = 10
+fleetSnapshotMaxAgeSecs = 30
+fleetSnapshotGlobals = ['maxAmpsToDivideAmongSlaves', 'timeLastGreenEnergyCheck',
+                        'idxSlaveToSendNextHeartbeat']
+timeLastFleetSnapshot = 0
+
+# Start a new copy of this script as 'simpleTWCcontrol.py takeover' to replace
+# the copy that's running, like after an upgrade. The running copy hands it the
+# open RS485 port and a fleet snapshot over handoffSocketFileName, then exits,
+# so slaves keep getting heartbeats and cars keep charging. See
+# take_over_serial_port().
+handoffSocketFileName = re.sub(r'/[^/]+$', r'/TWCManagerHandoff.sock', __file__)
+handoffTimeoutSecs = 5
+handoffListener = None
+handoffDone = False
+handoffSnapshot = None
+
+# Set by request_exit() when we get SIGTERM, like from 'systemctl stop'. The
+# main loop then exits the same way it does on Ctrl+C, so background tasks
+# finish and we save our state.
+exitRequested = False
+
+# TWCs that haven't reported their voltage are assumed to be on defaultVolts
+# when we work out how much energy they delivered.
+defaultVolts = 240
+
+# Text of each setting as of the last time we loaded or saved settingsFileName.
+settingsLastSaved = {}
+settingsLock = threading.Lock()
+
+# inotify file descriptor watching settingsFileName, or None if we have to poll
+# its modification time every settingsPollSecs.
+settingsWatchFd = None
+settingsPollSecs = 5
+settingsTimeLastPolled = 0
+settingsMtime = 0
 timeLastHeartbeatDebugOutput = 0
 
 webMsgPacked = ''
 webMsgMaxSize = 300
 webMsgResult = 0
+webIPCqueue = None
+
+# Most time per trip through the main loop to spend answering web requests.
+# See service_web_ipc_queue().
+webIPCBudgetSecs = 0.02
+
+# Local programs can control us and subscribe to status changes through a Unix
+# domain socket at controlSocketFileName. See ControlServer. Set
+# controlSocketFileName = '' to turn it off.
+controlSocketFileName = re.sub(r'/[^/]+$', r'/TWCManagerControl.sock', __file__)
+controlMaxClients = 64
+controlMaxFrameBytes = 65536
+controlMaxQueuedBytes = 1048576
+controlTWCResponseSecs = 2
+controlBudgetSecs = 0.02
+controlServer = None
+
+# We write a StatusSnapshot to statusSnapshotFileName after every trip through
+# the main loop. /dev/shm is a RAM disk, so this never touches the SD card. Set
+# statusSnapshotFileName = '' to turn it off. Run
+#   simpleTWCcontrol.py status
+# to print the current snapshot.
+statusSnapshotFileName = '/dev/shm/TWCManagerStatus'
+statusSnapshotMaxSlaves = 8
+statusSnapshot = None
+
+# Set httpServerPort to a port number like 8080 to serve status, history, and
+# WebSocket updates over HTTP. See StatusHTTPServer. httpServerAddress = ''
+# listens on every network interface.
+httpServerAddress = ''
+httpServerPort = 0
+httpServerQueriesPerTick = 4
+httpServerMaxQueuedCalls = 64
+httpServer = None
+
+# SamplingProfiler writes profiles to profilerFileNamePrefix-<time>.txt.
+# 'kill -USR2 <pid>' starts it for profilerSecs, or stops it early if it's
+# running. It samples every profilerIntervalSecs, which is frequent enough to
+# find hot spots and infrequent enough that profiling doesn't change what we
+# measure.
+profilerFileNamePrefix = re.sub(r'/[^/]+$', r'/TWCManagerProfile', __file__)
+profilerSecs = 60
+profilerIntervalSecs = 0.01
+profiler = SamplingProfiler(profilerFileNamePrefix)
+
+# Prometheus can scrape metrics from http://metricsAddress:metricsPort/metrics.
+# Set metricsPort = 0 to turn it off. See Metrics.
+metricsAddress = '127.0.0.1'
+metricsPort = 9310
+
+metrics = Metrics()
+metrics.describe('twc_frames_rx_total', 'counter', 'RS485 messages received with a good checksum, by opcode.')
+metrics.describe('twc_frames_tx_total', 'counter', 'RS485 messages sent, by opcode.')
+metrics.describe('twc_checksum_errors_total', 'counter', 'RS485 messages ignored because of a bad checksum.')
+metrics.describe('twc_short_frames_total', 'counter', 'RS485 messages cut short by the start of another.')
+metrics.describe('twc_bad_length_frames_total', 'counter', 'RS485 messages ignored because of an unexpected length.')
+metrics.describe('twc_rx_timeouts_total', 'counter', 'Partial RS485 messages abandoned after 2 seconds.')
+metrics.describe('twc_unknown_frames_total', 'counter', 'RS485 messages we did not recognize.')
+metrics.describe('twc_heartbeat_latency_seconds', 'histogram', 'Time from the last byte we sent a slave to the first byte of its answer, by TWCID.',
+                 [0.001, 0.0025, 0.005, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1])
+metrics.describe('twc_frame_seconds', 'histogram', 'Time from the first to the last byte of a message, by TWCID.',
+                 [0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.05, 0.1, 0.25])
+metrics.describe('twc_interframe_gap_seconds', 'histogram', 'Quiet time on the bus before a message, by TWCID.',
+                 [0.001, 0.0025, 0.005, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1])
+metrics.describe('twc_response_collisions_total', 'counter', 'Answers that ended too close to our next message, by TWCID.')
+metrics.describe('twc_allocator_seconds', 'histogram', 'Time spent handling a slave heartbeat and dividing amps.',
+                 [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1])
+metrics.describe('car_api_request_seconds', 'histogram', 'Car API request time, by endpoint.')
+metrics.describe('car_api_errors_total', 'counter', 'Failed car API requests, by endpoint.')
+metrics.describe('car_api_blocked_total', 'counter', 'Car API requests not sent because of a breaker or rate limit.')
+metrics.describe('settings_writes_total', 'counter', 'Times settings were written to the SD card.')
+metrics.describe('settings_writes_skipped_total', 'counter', 'Settings saves skipped because nothing changed.')
+metrics.gauge_func('background_tasks_queued', 'Background tasks waiting to run.',
+                   lambda: len(backgroundTasksCmds) - backgroundTasksRunning)
+metrics.gauge_func('background_tasks_running', 'Background tasks running.',
+                   lambda: backgroundTasksRunning)
+metrics.gauge_func('twc_slaves', 'Slave TWCs we are sending heartbeats to.',
+                   lambda: len(slaveTWCRoundRobin))
+metrics.describe('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes.')
+metrics.describe('python_gc_collections_total', 'counter', 'Garbage collections, by generation.')
+metrics.describe('python_gc_uncollectable_objects', 'gauge', 'Objects the garbage collector found but could not free.')
+metrics.describe('collection_size', 'gauge', 'Entries in buffers and collections that could grow, by name.')
+metrics.gauge_func('metrics_series_dropped', 'Metric updates dropped because a metric had too many label sets.',
+                   lambda: metrics.numDropped)
+metrics.gauge_func('twc_bus_health_score', 'Percent of RS485 messages received intact over the last busHealthNumWindows windows.',
+                   lambda: busHealth.score(busHealth.totals))
+metrics.describe('loop_stage_seconds', 'histogram', 'Time spent in each stage of one main loop iteration.',
+                 [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5])
+metrics.describe('loop_iteration_seconds', 'histogram', 'Time taken by one main loop iteration.')
+metrics.describe('loop_lag_total', 'counter', 'Main loop iterations that took longer than loopLagBudgetSecs.')
+
+# A normal main loop iteration takes 25ms plus up to 100ms waiting for a slave
+# to answer our linkready or heartbeat, plus the time to receive one message.
+# If an iteration takes longer than loopLagBudgetSecs, we print how long each
+# stage took. Slaves give up on us after a few seconds without a heartbeat, so
+# this warns us well before that. Set loopLagBudgetSecs = 0 to turn it off.
+loopLagBudgetSecs = 0.5
+loopTimer = LoopTimer(loopLagBudgetSecs)
+
+# As master, we send one slave a heartbeat every heartbeatSecs, taking turns
+# between slaves. A real master uses 1 second. With many slaves on one bus, a
+# shorter time lets each hear from us more often, but only if every slave
+# answers before our next heartbeat. The twc_heartbeat_latency_seconds and
+# twc_response_collisions_total metrics show how much room there is, and we
+# print a warning when a slave's answer ends less than busCollisionMarginSecs
+# before our next message.
+heartbeatSecs = 1.0
+busCollisionMarginSecs = 0.05
+
+# While waiting for a slave to answer, check the serial port every
+# busPollSecs to time its answer. See BusTiming.
+busPollSecs = 0.002
+busTiming = BusTiming(baud)
+
+# BusHealth counts bus errors in windows of busHealthWindowSecs and keeps the
+# last busHealthNumWindows of them, so the default covers an hour. After each
+# window with errors, it prints a summary instead of one line per unknown
+# message. It tracks at most busHealthMaxTWCs TWCIDs and
+# busHealthMaxUnknownKinds kinds of unknown message per window, since corrupt
+# messages can claim to be anything.
+busHealthWindowSecs = 60
+busHealthNumWindows = 60
+busHealthMaxTWCs = 16
+busHealthMaxUnknownKinds = 16
+busHealth = BusHealth(busHealthWindowSecs, busHealthNumWindows,
+                      busHealthMaxTWCs, busHealthMaxUnknownKinds)
+
+# Noise bytes between messages are kept in ignoredData to print at debugLevel
+# 9, but only the first busMaxIgnoredBytes of them. A message that reaches
+# busMaxMsgBytes without ending is thrown away. The longest real message is 42
+# bytes with every byte escaped.
+busMaxIgnoredBytes = 64
+busMaxMsgBytes = 64
+
+# Messages passed to log() are printed by LogWriter every logFlushSecs. If
+# stdout can't keep up, we keep the newest logMaxQueuedEvents of them.
+logFlushSecs = 0.1
+logMaxQueuedEvents = 10000
+logWriter = LogWriter(logMaxQueuedEvents, logFlushSecs, logFileName,
+                      logMaxBytes, logNumBackups)
+
+# Every memoryStatsSecs, MemoryMonitor records our memory use and the size of
+# everything that could grow. It warns once an hour while we use more than
+# memoryRSSWarnBytes, or more than memoryGrowthWarnBytes over what we used
+# memoryBaselineSecs after starting. memoryTraceFrames and memoryTraceLimit
+# are the defaults for the memoryTraceStart and memoryTraceDiff control
+# commands.
+memoryStatsSecs = 300
+memoryRSSWarnBytes = 200*1024*1024
+memoryGrowthWarnBytes = 50*1024*1024
+memoryBaselineSecs = 600
+memoryTraceFrames = 1
+memoryTraceLimit = 20
+timeLastMemorySample = 0
+memoryMonitor = MemoryMonitor(memoryRSSWarnBytes, memoryGrowthWarnBytes,
+                              memoryBaselineSecs)
+memoryMonitor.watch('slaveTWCs', lambda: len(slaveTWCs))
+memoryMonitor.watch('carApiVehicles', lambda: len(carApiVehicles))
+memoryMonitor.watch('ignoredData', lambda: len(ignoredData))
+memoryMonitor.watch('msg', lambda: len(msg))
+memoryMonitor.watch('backgroundTasks', lambda: len(backgroundTasksCmds))
+memoryMonitor.watch('timers', lambda: len(timerHeap))
+memoryMonitor.watch('logEvents', lambda: len(logWriter.events))
+memoryMonitor.watch('busArrivals', lambda: len(busTiming.arrivals))
+memoryMonitor.watch('busHealthTWCs', lambda: len(busHealth.twcTotals))
+memoryMonitor.watch('metricsSeries', lambda: sum(len(values) for values
+                                                 in list(metrics.values.values())))
+memoryMonitor.watch('controlClients', lambda: (len(controlServer.clients)
+                                               if controlServer != None else 0))
+memoryMonitor.watch('httpQueries', lambda: (len(httpServer.mainThreadCalls)
+                                            if httpServer != None else 0))
+memoryMonitor.watch('httpWebSockets', lambda: (len(httpServer.wsClients)
+                                               if httpServer != None else 0))
 
 timeTo0Aafter06 = 0
 timeToRaise2A = 0
@@ -2440,9 +7883,11 @@ carApiLastErrorTime = 0
 carApiBearerToken = ''
 carApiRefreshToken = ''
 carApiTokenExpireTime = time.time()
-carApiLastStartOrStopChargeTime = 0
 carApiVehicles = []
 
+# We only keep track of the first carApiMaxVehicles cars on the Tesla account.
+carApiMaxVehicles = 10
+
 # Transient errors are ones that usually disappear if we retry the car API
 # command a minute or less later.
 # 'vehicle unavailable:' sounds like it implies the car is out of connection
@@ -2455,18 +7900,138 @@ carApiVehicles = []
 carApiTransientErrors = ['upstream internal error', 'operation_timedout',
 'vehicle unavailable']
 
+# Errors that are about one car, not the endpoint we sent the request to, so
+# they don't count against the endpoint's circuit breaker. See
+# car_api_endpoint_error().
+carApiVehicleErrors = ['vehicle unavailable']
+
 # Define minutes between retrying non-transient errors.
 carApiErrorRetryMins = 10
 
+# Seconds to wait before sending more requests about a car after it returns one
+# of carApiTransientErrors.
+carApiTransientRetrySecs = 60
+
+# Rate limits for car API requests, as (burst size, requests per minute).
+# https://teslamotorsclub.com/tmc/threads/model-s-rest-api.13410/page-114#post-2732052
+# says hammering the servers with requests as fast as possible gets you
+# blacklisted after 2 minutes, so stay well below that even when several cars
+# are waking and charging at once. Requests must fit the limit for all
+# requests, for their endpoint, and for the car they're about.
+carApiTotalRateLimit = (10, 12)
+carApiVehicleRateLimit = (6, 6)
+carApiEndpointRateLimits = {
+    'oauth/token': (2, 0.2),
+    'vehicles': (2, 1),
+    'wake_up': (4, 6),
+    'command/charge_start': (3, 3),
+    'command/charge_stop': (3, 3),
+    'data_request/drive_state': (3, 3),
+    'data_request/charge_state': (3, 3),
+    'default': (3, 3),
+}
+
+# Stop sending requests to an endpoint for carApiErrorRetryMins after this many
+# failures in a row, no matter which car they were for. Each car's own breaker
+# opens after a single failure. Breakers that fail again when half-open stay
+# open twice as long each time, up to carApiBreakerMaxOpenMins.
+carApiEndpointFailureThreshold = 3
+carApiBreakerMaxOpenMins = 60
+carApiEndpoints = {}
+carApiTotalBucket = TokenBucket(carApiTotalRateLimit[0], carApiTotalRateLimit[1])
+
+# Columns to request from the streaming API, and seconds without data after
+# which we stop trusting a stream and reconnect. Reconnects back off from
+# carApiStreamingReconnectSecs[0] to carApiStreamingReconnectSecs[1] seconds.
+carApiStreamingColumns = 'speed,odometer,soc,elevation,est_heading,est_lat,' \
+                         'est_lng,power,shift_state,range,est_range,heading'
+carApiStreamingStaleSecs = 60
+carApiStreamingReconnectSecs = (5, 10*60)
+
+# When a car's reported charge state agrees with a slave TWC, its match score
+# for that TWC moves carApiMatchLearnRate of the way toward 1. Once the best
+# car's score is carApiMatchMinConfidence ahead of the next best car, start
+# and stop commands for the TWC go only to that car. A car is charging at
+# about the same rate as a TWC if they're within carApiMatchAmpsTolerance.
+carApiMatchLearnRate = 0.4
+carApiMatchMinConfidence = 0.6
+carApiMatchAmpsTolerance = 2.0
+
+# Seconds to wait before retrying a request that failed with
+# 'could_not_wake_buses' or before sending a charge command right after
+# drive_state, and how many times to retry a charge command. Locations we polled
+# less than carApiLocationCacheSecs ago are reused.
+carApiBusesRetrySecs = 5
+carApiChargeRetries = 3
+carApiLocationCacheSecs = 30
+
+# Seconds to wait after a car comes online before sending it commands.
+carApiWakeSettleSecs = 5
+
+# Stop trying to wake a car if nothing has asked for it in this many minutes.
+carApiWakeAbandonMins = 5
+
 homeLat = 10000
 homeLon = 10000
 
-backgroundTasksQueue = queue.Queue()
+# Number of background_tasks_thread workers.
+backgroundTaskWorkers = 3
+
+# (priority, deadlineSecs, group) for each kind of background task. Tasks with
+# lower priority numbers run first. A task still waiting deadlineSecs after it
+# was queued is dropped, or never if deadlineSecs is None. Only one task in each
+# group runs at a time. Car API tasks share a group because CarApiVehicle and
+# its wake state machine expect to be used from one thread at a time.
+backgroundTaskTypes = {
+    'carApiEmailPassword': (0, None, 'carApi'),
+    'charge': (1, 60, 'carApi'),
+    'timer': (1, None, 'carApi'),
+    'checkGreenEnergy': (2, 60, 'greenEnergy'),
+    'correlate': (3, 120, 'carApi'),
+    'saveRollups': (4, None, 'rollups'),
+    'saveSession': (3, None, 'sessions'),
+    'saveFleetSnapshot': (4, None, 'fleetSnapshot'),
+    'memorySample': (4, None, 'memory'),
+    'memoryTraceStart': (4, None, 'memory'),
+    'memoryTraceDiff': (4, None, 'memory'),
+    'memoryTraceStop': (4, None, 'memory'),
+    'default': (2, None, None),
+}
+
+# Print background task stats this often when debugLevel >= 2.
+backgroundTaskStatsLogMins = 30
+
+# backgroundTasksCond protects everything below it. Workers wait on it for
+# tasks and timers.
+backgroundTasksCond = threading.Condition()
+backgroundTasksHeap = []
+backgroundTasksSeq = 0
 backgroundTasksCmds = {}
+# backgroundTaskRetries[taskKey] is (timer, task) for a retry waiting to be
+# queued. See retry_background_task().
+backgroundTaskRetries = {}
+backgroundTasksBusyGroups = set()
+backgroundTasksRunning = 0
+backgroundTaskStats = {}
+timerHeap = []
+timerSeq = 0
+
 backgroundTasksLock = threading.Lock()
 
+if(len(sys.argv) > 1 and sys.argv[1] == 'export'):
+    # Export history and exit before touching the RS485 adapter, which a
+    # running controller is using.
+    sys.exit(export_history(sys.argv[2:]))
+
+if(len(sys.argv) > 1 and sys.argv[1] == 'status'):
+    try:
+        print(json.dumps(StatusSnapshot(statusSnapshotFileName).read(), indent=2))
+    except (OSError, ValueError) as e:
+        print('ERROR: ' + str(e), file=sys.stderr)
+        sys.exit(1)
+    sys.exit(0)
+
 ser = None
-ser = serial.Serial(rs485Adapter, baud, timeout=0)
 
 #
 # End global vars
@@ -2480,14 +8045,39 @@ ser = serial.Serial(rs485Adapter, baud, timeout=0)
 #
 
 load_settings()
+watch_settings()
+logWriter.start()
+
+rollups = Rollups(rollupsFileName, rollupsRetentionSecs, rollupsMaxGapSecs,
+                  defaultVolts)
+rollups.load()
 
+sessionStore = SessionStore(sessionsFileName)
 
-# Create a background thread to handle tasks that take too long on the main
+if(httpServerPort > 0):
+    httpServer = StatusHTTPServer(httpServerAddress, httpServerPort)
+    httpServer.start()
+
+signal.signal(signal.SIGUSR2, toggle_profiler)
+signal.signal(signal.SIGTERM, request_exit)
+
+if(metricsPort > 0):
+    metricsThread = threading.Thread(target=serve_metrics, args = ())
+    metricsThread.daemon = True
+    metricsThread.start()
+
+# Create background threads to handle tasks that take too long on the main
 # thread.  For a primer on threads in Python, see:
 # http://www.laurentluce.com/posts/python-threads-synchronization-locks-rlocks-semaphores-conditions-events-and-queues/
-backgroundTasksThread = threading.Thread(target=background_tasks_thread, args = ())
-backgroundTasksThread.daemon = True
-backgroundTasksThread.start()
+backgroundTasksThreads = []
+for i in range(0, backgroundTaskWorkers):
+    backgroundTasksThread = threading.Thread(target=background_tasks_thread, args = (),
+                                             name='backgroundTasks' + str(i))
+    backgroundTasksThread.daemon = True
+    backgroundTasksThread.start()
+    backgroundTasksThreads.append(backgroundTasksThread)
+
+schedule_timer(backgroundTaskStatsLogMins*60, log_background_task_stats)
 
 
 # Create an IPC (Interprocess Communication) message queue that we can
@@ -2538,6 +8128,57 @@ if(webIPCqueue == None):
 # http://www.onlamp.com/pub/a/php/2004/05/13/shared_memory.html
 
 
+# If we're taking over from a running copy of this script, its slaves go
+# without heartbeats from the moment we connect until we've opened the files
+# it closes for us, so do it only now that everything else is running. The
+# control socket and status snapshot are created after, since ours would
+# replace the running copy's even if the takeover failed.
+if(len(sys.argv) > 1 and sys.argv[1] == 'takeover'):
+    (ser, handoffSnapshot) = take_over_serial_port()
+if(ser == None):
+    ser = serial.Serial(rs485Adapter, baud, timeout=0)
+
+counterJournal = CounterJournal(counterJournalFileName, counterJournalNames,
+                                counterJournalSyncSecs, counterJournalMaxBytes)
+for name, value in counterJournal.recover().items():
+    globals()[name] = value
+counterJournal.start()
+
+if(sampleStoreEnabled):
+    if(numpy == None):
+        print("WARNING: Install numpy to record heartbeat samples in " + sampleStoreDir + ".")
+    else:
+        sampleStore = SampleStore(sampleStoreDir, sampleStoreBatchRows,
+                                  sampleStoreFlushSecs, sampleStoreSegmentRows)
+        sampleStore.start()
+
+if(handoffSnapshot != None):
+    # Send our first heartbeat when the process we took over from would have.
+    timeLastTx = handoffSnapshot.get('timeLastTx', 0)
+    if(handoffSnapshot.get('linkReady')):
+        numInitMsgsToSend = 0
+    if('rollups' in handoffSnapshot):
+        rollups.restore(handoffSnapshot['rollups'])
+    if(fakeMaster == 1):
+        restore_fleet_snapshot(handoffSnapshot)
+elif(fakeMaster == 1 and load_fleet_snapshot() > 0):
+    # Our slaves are still linked to us, so skip the startup linkready
+    # messages. Any slave that wasn't in the snapshot will send us linkready
+    # within 10 seconds like it does whenever it has no master.
+    numInitMsgsToSend = 0
+
+listen_for_handoff()
+
+# These replace the running copy's control socket and status snapshot, so
+# only create them once it's handed off to us or if there's no running copy.
+if(controlSocketFileName != ''):
+    controlServer = ControlServer(controlSocketFileName)
+
+if(statusSnapshotFileName != ''):
+    statusSnapshot = StatusSnapshot(statusSnapshotFileName,
+                                    statusSnapshotMaxSlaves, True)
+
+
 print("TWC Manager starting as fake %s with id %02X%02X and sign %02X" \
     % ( ("Master" if fakeMaster else "Slave"), \
     ord(fakeTWCID[0:1]), ord(fakeTWCID[1:2]), ord(slaveSign)))
@@ -2554,10 +8195,45 @@ while True:
 
         # Add a 25ms sleep to prevent pegging pi's CPU at 100%. Lower CPU means
         # less power used and less waste heat.
+        loopTimer.next_iteration('sleep')
         time.sleep(0.025)
 
+        loopTimer.enter('housekeeping')
         now = time.time()
 
+        if(check_handoff()):
+            break
+
+        if(exitRequested):
+            print("Exiting after background tasks complete...")
+            break
+
+        # Apply any changes made to settingsFileName while we're running.
+        check_settings_file()
+
+        service_web_ipc_queue()
+        if(controlServer != None):
+            controlServer.service(controlBudgetSecs)
+        if(statusSnapshot != None):
+            statusSnapshot.write(now)
+        if(httpServer != None):
+            httpServer.publish(fleet_status())
+            httpServer.service(httpServerQueriesPerTick)
+
+        if(sampleStore != None):
+            sampleStore.flush_if_due()
+        rollups.save_if_due(rollupsSaveSecs)
+
+        if(fakeMaster == 1 and now - timeLastFleetSnapshot >= fleetSnapshotSecs):
+            timeLastFleetSnapshot = now
+            queue_background_task({'cmd':'saveFleetSnapshot',
+                                   'snapshot':fleet_snapshot()})
+
+        if(now - timeLastMemorySample >= memoryStatsSecs):
+            timeLastMemorySample = now
+            queue_background_task({'cmd':'memorySample'})
+
+        loopTimer.enter('transmit')
         if(fakeMaster == 1):
             # A real master sends 5 copies of linkready1 and linkready2 whenever
             # it starts up, which we do here.
@@ -2565,11 +8241,11 @@ while True:
             # per 100ms so I do once per 100ms to get them over with.
             if(numInitMsgsToSend > 5):
                 send_master_linkready1()
-                time.sleep(0.1) # give slave time to respond
+                busTiming.wait(0.1) # give slave time to respond
                 numInitMsgsToSend -= 1
             elif(numInitMsgsToSend > 0):
                 send_master_linkready2()
-                time.sleep(0.1) # give slave time to respond
+                busTiming.wait(0.1) # give slave time to respond
                 numInitMsgsToSend = numInitMsgsToSend - 1
             else:
                 # After finishing the 5 startup linkready1 and linkready2
@@ -2579,8 +8255,8 @@ while True:
                 # as long as no slave was connected, but since real slaves send
                 # linkready once every 10 seconds till they're connected to a
                 # master, we'll just wait for that.
-                if(time.time() - timeLastTx >= 1.0):
-                    # It's been about a second since our last heartbeat.
+                if(time.time() - timeLastTx >= heartbeatSecs):
+                    # It's been heartbeatSecs since our last heartbeat.
                     if(len(slaveTWCRoundRobin) > 0):
                         slaveTWC = slaveTWCRoundRobin[idxSlaveToSendNextHeartbeat]
                         if(time.time() - slaveTWC.timeLastRx > 26):
@@ -2590,27 +8266,30 @@ while True:
                             # awhile but we're just going to scratch the slave
                             # from our little black book and add them again if
                             # they ever send us a linkready.
-                            print(time_now() + ": WARNING: We haven't heard from slave " \
+                            log(0, ": WARNING: We haven't heard from slave " \
                                 "%02X%02X for over 26 seconds.  " \
-                                "Stop sending them heartbeat messages." % \
-                                (slaveTWC.TWCID[0], slaveTWC.TWCID[1]))
+                                "Stop sending them heartbeat messages.",
+                                slaveTWC.TWCID[0], slaveTWC.TWCID[1])
                             delete_slave(slaveTWC.TWCID)
                         else:
                             slaveTWC.send_master_heartbeat()
+                            busTiming.expect_response(slaveTWC.TWCID, heartbeatSecs)
 
                         idxSlaveToSendNextHeartbeat = idxSlaveToSendNextHeartbeat + 1
                         if(idxSlaveToSendNextHeartbeat >= len(slaveTWCRoundRobin)):
                             idxSlaveToSendNextHeartbeat = 0
-                        time.sleep(0.1) # give slave time to respond
+                        busTiming.wait(0.1) # give slave time to respond
 
 
         ########################################################################
         # See if there's an incoming message on the RS485 interface.
 
+        loopTimer.enter('receive')
         timeMsgRxStart = time.time()
         while True:
             now = time.time()
             dataLen = ser.inWaiting()
+            busTiming.poll(dataLen)
             if(dataLen == 0):
                 if(msgLen == 0):
                     # No message data waiting and we haven't received the
@@ -2622,9 +8301,9 @@ while True:
                     # No message data waiting but we've received a partial
                     # message that we should wait to finish receiving.
                     if(now - timeMsgRxStart >= 2.0):
-                        if(debugLevel >= 9):
-                            print(time_now() + ": Msg timeout (" + hex_str(ignoredData) +
-                                  ') ' + hex_str(msg[0:msgLen]))
+                        metrics.inc('twc_rx_timeouts_total')
+                        busHealth.count('rxTimeouts')
+                        log(9, ": Msg timeout (%s) %s", ignoredData, msg[0:msgLen])
                         msgLen = 0
                         ignoredData = bytearray()
                         break
@@ -2634,10 +8313,11 @@ while True:
             else:
                 dataLen = 1
                 data = ser.read(dataLen)
+                timeDataArrived = busTiming.read(len(data))
 
             if(dataLen != 1):
                 # This should never happen
-                print("WARNING: No data available.")
+                log(0, ": WARNING: No data available.")
                 break
 
             timeMsgRxStart = now
@@ -2645,9 +8325,15 @@ while True:
             if(msgLen == 0 and data[0] != 0xc0):
                 # We expect to find these non-c0 bytes between messages, so
                 # we don't print any warning at standard debug levels.
-                if(debugLevel >= 11):
-                    print("Ignoring byte %02X between messages." % (data[0]))
-                ignoredData += data
+                log(11, ": Ignoring byte %02X between messages.", data[0])
+                if(len(ignoredData) == 0):
+                    busHealth.count('noiseBursts')
+                busHealth.count('noiseBytes')
+                # We only keep the start of the noise to show at debugLevel 9.
+                # Without bias resistors, a floating bus can feed us garbage
+                # forever.
+                if(len(ignoredData) < busMaxIgnoredBytes):
+                    ignoredData += data
                 continue
             elif(msgLen > 0 and msgLen < 15 and data[0] == 0xc0):
                 # If you see this when the program is first started, it
@@ -2659,16 +8345,28 @@ while True:
                 # happen every once in awhile but there may be a problem
                 # such as incorrect termination or bias resistors on the
                 # rs485 wiring if you see it frequently.
-                if(debugLevel >= 10):
-                    print("Found end of message before full-length message received.  " \
-                          "Discard and wait for new message.")
+                metrics.inc('twc_short_frames_total')
+                busHealth.count('shortFrames')
+                log(10, ": Found end of message before full-length message received.  " \
+                        "Discard and wait for new message.")
 
                 msg = data
                 msgLen = 1
+                timeMsgFirstByte = timeDataArrived
                 continue
 
             if(msgLen == 0):
                 msg = bytearray()
+                timeMsgFirstByte = timeDataArrived
+            elif(msgLen >= busMaxMsgBytes):
+                # Real messages are never this long, even with every byte
+                # escaped, so we missed the C0 that ended one and this is
+                # noise.
+                busHealth.count('badLengths')
+                log(10, ": Discarding %d bytes with no end of message: %s",
+                    msgLen, msg[0:msgLen])
+                msgLen = 0
+                continue
             msg += data
             msgLen += 1
 
@@ -2698,9 +8396,11 @@ while True:
             # This explains what happens without "termination" resistors:
             #   https://e2e.ti.com/blogs_/b/analogwire/archive/2016/07/28/rs-485-basics-when-termination-is-necessary-and-how-to-do-it-properly
             if(msgLen >= 16 and data[0] == 0xc0):
+                timeMsgLastByte = timeDataArrived
                 break
 
         if(msgLen >= 16):
+            loopTimer.enter('unescape')
             msg = unescape_msg(msg, msgLen)
             # Set msgLen = 0 at start so we don't have to do it on errors below.
             # len($msg) now contains the unescaped message length.
@@ -2722,9 +8422,7 @@ while True:
             ):
                 lastTWCResponseMsg = msg
 
-            if(debugLevel >= 9):
-                print("Rx@" + time_now() + ": (" + hex_str(ignoredData) + ') ' \
-                      + hex_str(msg) + "")
+            log(9, ": Rx (%s) %s", ignoredData, msg)
 
             ignoredData = bytearray()
 
@@ -2737,20 +8435,35 @@ while True:
                 # EE, FD EF, FD F1, and FB A4 messages are length 20 while most
                 # other messages are length 16. I'm not sure if there are any
                 # length 14 messages remaining.
-                print(time_now() + ": ERROR: Ignoring message of unexpected length %d: %s" % \
-                       (len(msg), hex_str(msg)))
+                metrics.inc('twc_bad_length_frames_total')
+                busHealth.count('badLengths')
+                log(0, ": ERROR: Ignoring message of unexpected length %d: %s",
+                    len(msg), msg)
                 continue
 
+            loopTimer.enter('checksum')
             checksumExpected = msg[len(msg) - 1]
             checksum = 0
             for i in range(1, len(msg) - 1):
                 checksum += msg[i]
 
             if((checksum & 0xFF) != checksumExpected):
-                print("ERROR: Checksum %X does not match %02X.  Ignoring message: %s" %
-                    (checksum, checksumExpected, hex_str(msg)))
+                metrics.inc('twc_checksum_errors_total')
+                # The sender's TWCID may be what got corrupted, so only blame a
+                # TWC we know.
+                busHealth.count('checksumErrors', (msg[2:4] if bytes(msg[2:4]) in slaveTWCs
+                                                   else None))
+                log(0, ": ERROR: Checksum %X does not match %02X.  Ignoring message: %s",
+                    checksum, checksumExpected, msg)
                 continue
 
+            metrics.inc('twc_frames_rx_total', {'opcode': '%02X%02X' % (msg[0], msg[1])})
+            # Every message we know of has the sender's TWCID in bytes 2 and 3.
+            busTiming.frame(msg[2:4], timeMsgFirstByte, timeMsgLastByte)
+            busHealth.count('frames', msg[2:4])
+
+            loopTimer.enter('dispatch')
+
             if(fakeMaster == 1):
                 ############################
                 # Pretend to be a master TWC
@@ -2779,18 +8492,16 @@ while True:
                     sign = msgMatch.group(2)
                     maxAmps = ((msgMatch.group(3)[0] << 8) + msgMatch.group(3)[1]) / 100
 
-                    if(debugLevel >= 1):
-                        print(time_now() + ": %.2f amp slave TWC %02X%02X is ready to link.  Sign: %s" % \
-                            (maxAmps, senderID[0], senderID[1],
-                            hex_str(sign)))
+                    log(1, ": %.2f amp slave TWC %02X%02X is ready to link.  Sign: %s",
+                        maxAmps, senderID[0], senderID[1], sign)
 
 
                     spikeAmpsToCancel6ALimit = 16
 
                     if(senderID == fakeTWCID):
-                        print(time_now + ": Slave TWC %02X%02X reports same TWCID as master.  " \
-                              "Slave should resolve by changing its TWCID." % \
-                              (senderID[0], senderID[1]))
+                        log(0, ": Slave TWC %02X%02X reports same TWCID as master.  " \
+                            "Slave should resolve by changing its TWCID.",
+                            senderID[0], senderID[1])
                         # I tested sending a linkready to a real master with the
                         # same TWCID as master and instead of master sending back
                         # its heartbeat message, it sent 5 copies of its
@@ -2818,9 +8529,8 @@ while True:
                             slaveTWC.protocolVersion = 2
                             slaveTWC.minAmpsTWCSupports = 6
 
-                        if(debugLevel >= 1):
-                            print(time_now() + ": Set slave TWC %02X%02X protocolVersion to %d, minAmpsTWCSupports to %d." % \
-                                 (senderID[0], senderID[1], slaveTWC.protocolVersion, slaveTWC.minAmpsTWCSupports))
+                        log(1, ": Set slave TWC %02X%02X protocolVersion to %d, minAmpsTWCSupports to %d.",
+                            senderID[0], senderID[1], slaveTWC.protocolVersion, slaveTWC.minAmpsTWCSupports)
 
                     # We expect maxAmps to be 80 on U.S. chargers and 32 on EU
                     # chargers. Either way, don't allow
@@ -2836,10 +8546,10 @@ while True:
 
                     # Make sure we print one SHB message after a slave
                     # linkready message is received by clearing
-                    # lastHeartbeatDebugOutput. This helps with debugging
+                    # lastStatusPrinted. This helps with debugging
                     # cases where I can't tell if we responded with a
                     # heartbeat or not.
-                    slaveTWC.lastHeartbeatDebugOutput = ''
+                    slaveTWC.lastStatusPrinted = None
 
                     slaveTWC.timeLastRx = time.time()
                     slaveTWC.send_master_heartbeat()
@@ -2866,13 +8576,21 @@ while True:
                         # Normally, a slave only sends us a heartbeat message if
                         # we send them ours first, so it's not expected we would
                         # hear heartbeat from a slave that's not in our list.
-                        print(time_now() + ": ERROR: Received heartbeat message from " \
-                                "slave %02X%02X that we've not met before." % \
-                                (senderID[0], senderID[1]))
+                        log(0, ": ERROR: Received heartbeat message from " \
+                            "slave %02X%02X that we've not met before.",
+                            senderID[0], senderID[1])
                         continue
 
                     if(fakeTWCID == receiverID):
+                        timeAllocStart = time.time()
+                        loopTimer.enter('allocate')
                         slaveTWC.receive_slave_heartbeat(heartbeatData)
+                        loopTimer.enter('dispatch')
+                        metrics.observe('twc_allocator_seconds', time.time() - timeAllocStart)
+                        if(sampleStore != None):
+                            sampleStore.append(slaveTWC)
+                        rollups.add_sample(slaveTWC, now)
+                        slaveTWC.update_session(now)
                     else:
                         # I've tried different fakeTWCID values to verify a
                         # slave will send our fakeTWCID back to us as
@@ -2881,11 +8599,10 @@ while True:
                         # I'm not sure why it sent 0000 and it only happened
                         # once so far, so it could have been corruption in the
                         # data or an unusual case.
-                        if(debugLevel >= 1):
-                            print(time_now() + ": WARNING: Slave TWC %02X%02X status data: " \
-                                  "%s sent to unknown TWC %02X%02X." % \
-                                (senderID[0], senderID[1],
-                                hex_str(heartbeatData), receiverID[0], receiverID[1]))
+                        log(1, ": WARNING: Slave TWC %02X%02X status data: " \
+                            "%s sent to unknown TWC %02X%02X.",
+                            senderID[0], senderID[1],
+                            heartbeatData, receiverID[0], receiverID[1])
                 else:
                     msgMatch = re.search(b'\A\xfd\xeb(..)(..)(.+?).\Z', msg, re.DOTALL)
                 if(msgMatch and foundMsgMatch == False):
@@ -2916,21 +8633,32 @@ while True:
                     receiverID = msgMatch.group(2)
                     data = msgMatch.group(3)
 
-                    if(debugLevel >= 1):
-                        print(time_now() + ": Slave TWC %02X%02X unexpectedly reported kWh and voltage data: %s." % \
-                            (senderID[0], senderID[1],
-                            hex_str(data)))
+                    log(1, ": Slave TWC %02X%02X unexpectedly reported kWh and voltage data: %s.",
+                        senderID[0], senderID[1], data)
+
+                    # The pattern above splits the 4 byte kWh counter across
+                    # receiverID and data, so put them back together.
+                    data = receiverID + data
+                    if(senderID in slaveTWCs and len(data) >= 6):
+                        slaveTWCs[senderID].reportedKWhCounter = (data[0] << 24) \
+                            + (data[1] << 16) + (data[2] << 8) + data[3]
+                        slaveTWCs[senderID].reportedVolts = (data[4] << 8) + data[5]
                 else:
                     msgMatch = re.search(b'\A\xfc(\xe1|\xe2)(..)(.)\x00\x00\x00\x00\x00\x00\x00\x00.+\Z', msg, re.DOTALL)
                 if(msgMatch and foundMsgMatch == False):
                     foundMsgMatch = True
-                    print(time_now() + " ERROR: TWC is set to Master mode so it can't be controlled by TWCManager.  " \
-                           "Search installation instruction PDF for 'rotary switch' and set " \
-                           "switch so its arrow points to F on the dial.")
+                    log(0, " ERROR: TWC is set to Master mode so it can't be controlled by TWCManager.  " \
+                        "Search installation instruction PDF for 'rotary switch' and set " \
+                        "switch so its arrow points to F on the dial.")
                 if(foundMsgMatch == False):
-                    print(time_now() + ": *** UNKNOWN MESSAGE FROM SLAVE:" + hex_str(msg)
-                          + "\nPlease private message user CDragon at http://teslamotorsclub.com " \
-                          "with a copy of this error.")
+                    metrics.inc('twc_unknown_frames_total')
+                    # We print the first of each kind of unknown message per
+                    # busHealthWindowSecs. BusHealth prints how many more
+                    # there were.
+                    if(busHealth.unknown(msg, msg[2:4])):
+                        log(0, ": *** UNKNOWN MESSAGE FROM SLAVE:%s"
+                            "\nPlease private message user CDragon at http://teslamotorsclub.com " \
+                            "with a copy of this error.", msg)
             else:
                 ###########################
                 # Pretend to be a slave TWC
@@ -2949,9 +8677,8 @@ while True:
                     # This message seems to always contain seven 00 bytes in its
                     # data area. If we ever get this message with non-00 data
                     # we'll print it as an unexpected message.
-                    if(debugLevel >= 1):
-                        print(time_now() + ": Master TWC %02X%02X Linkready1.  Sign: %s" % \
-                            (senderID[0], senderID[1], hex_str(sign)))
+                    log(1, ": Master TWC %02X%02X Linkready1.  Sign: %s",
+                        senderID[0], senderID[1], sign)
 
                     if(senderID == fakeTWCID):
                         master_id_conflict()
@@ -2976,9 +8703,8 @@ while True:
                     # data area. If we ever get this message with non-00 data
                     # we'll print it as an unexpected message.
 
-                    if(debugLevel >= 1):
-                        print(time_now() + ": Master TWC %02X%02X Linkready2.  Sign: %s" % \
-                            (senderID[0], senderID[1], hex_str(sign)))
+                    log(1, ": Master TWC %02X%02X Linkready2.  Sign: %s",
+                        senderID[0], senderID[1], sign)
 
                     if(senderID == fakeTWCID):
                         master_id_conflict()
@@ -3002,24 +8728,20 @@ while True:
                     if(receiverID != fakeTWCID):
                         # This message was intended for another slave.
                         # Ignore it.
-                        if(debugLevel >= 11):
-                            print(time_now() + ": Master %02X%02X sent " \
-                                "heartbeat message %s to receiver %02X%02X " \
-                                "that isn't our fake slave." % \
-                                (senderID[0], senderID[1],
-                                hex_str(heartbeatData),
-                                receiverID[0], receiverID[1]))
+                        log(11, ": Master %02X%02X sent " \
+                            "heartbeat message %s to receiver %02X%02X " \
+                            "that isn't our fake slave.",
+                            senderID[0], senderID[1], heartbeatData,
+                            receiverID[0], receiverID[1])
                         continue
 
                     amps = (slaveHeartbeatData[1] << 8) + slaveHeartbeatData[2]
                     kWhDelivered += (((240 * (amps/100)) / 1000 / 60 / 60) * (now - timeLastkWhDelivered))
                     timeLastkWhDelivered = now
+                    counterJournal.set('kWhDelivered', kWhDelivered)
                     if(time.time() - timeLastkWhSaved >= 300.0):
                         timeLastkWhSaved = now
-                        if(debugLevel >= 9):
-                            print(time_now() + ": Fake slave has delivered %.3fkWh" % \
-                               (kWhDelivered))
-                        save_settings()
+                        log(9, ": Fake slave has delivered %.3fkWh", kWhDelivered)
 
                     if(heartbeatData[0] == 0x07):
                         # Lower amps in use (not amps allowed) by 2 for 10
@@ -3068,16 +8790,17 @@ while True:
                             slaveHeartbeatData[4] = (amps & 0xFF)
                             slaveHeartbeatData[0] = 0x0A
                     elif(heartbeatData[0] == 0x02):
-                        print(time_now() + ": Master heartbeat contains error %ld: %s" % \
-                                (heartbeatData[1], hex_str(heartbeatData)))
+                        log(0, ": Master heartbeat contains error %ld: %s",
+                            heartbeatData[1], heartbeatData)
                     else:
-                        print(time_now() + ": UNKNOWN MHB state %s" % \
-                                (hex_str(heartbeatData)))
+                        log(0, ": UNKNOWN MHB state %s", heartbeatData)
 
                     # Slaves always respond to master's heartbeat by sending
                     # theirs back.
                     slaveTWC.send_slave_heartbeat(senderID)
+                    loopTimer.enter('print')
                     slaveTWC.print_status(slaveHeartbeatData)
+                    loopTimer.enter('dispatch')
                 else:
                     msgMatch = re.search(b'\A\xfc\x1d\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00+?.\Z', msg, re.DOTALL)
                 if(msgMatch and foundMsgMatch == False):
@@ -3097,8 +8820,7 @@ while True:
                     # as there's no point in playing a fake master with no
                     # slaves around.
                     foundMsgMatch = True
-                    if(debugLevel >= 1):
-                        print(time_now() + ": Received 2-hour idle message from Master.")
+                    log(1, ": Received 2-hour idle message from Master.")
                 else:
                     msgMatch = re.search(b'\A\xfd\xe2(..)(.)(..)\x00\x00\x00\x00\x00\x00.+\Z', msg, re.DOTALL)
                 if(msgMatch and foundMsgMatch == False):
@@ -3108,14 +8830,12 @@ while True:
                     senderID = msgMatch.group(1)
                     sign = msgMatch.group(2)
                     maxAmps = ((msgMatch.group(3)[0] << 8) + msgMatch.group(3)[1]) / 100
-                    if(debugLevel >= 1):
-                        print(time_now() + ": %.2f amp slave TWC %02X%02X is ready to link.  Sign: %s" % \
-                            (maxAmps, senderID[0], senderID[1],
-                            hex_str(sign)))
+                    log(1, ": %.2f amp slave TWC %02X%02X is ready to link.  Sign: %s",
+                        maxAmps, senderID[0], senderID[1], sign)
                     if(senderID == fakeTWCID):
-                        print(time_now() + ": ERROR: Received slave heartbeat message from " \
-                                "slave %02X%02X that has the same TWCID as our fake slave." % \
-                                (senderID[0], senderID[1]))
+                        log(0, ": ERROR: Received slave heartbeat message from " \
+                            "slave %02X%02X that has the same TWCID as our fake slave.",
+                            senderID[0], senderID[1])
                         continue
 
                     new_slave(senderID, maxAmps)
@@ -3130,9 +8850,9 @@ while True:
                     heartbeatData = msgMatch.group(3)
 
                     if(senderID == fakeTWCID):
-                        print(time_now() + ": ERROR: Received slave heartbeat message from " \
-                                "slave %02X%02X that has the same TWCID as our fake slave." % \
-                                (senderID[0], senderID[1]))
+                        log(0, ": ERROR: Received slave heartbeat message from " \
+                            "slave %02X%02X that has the same TWCID as our fake slave.",
+                            senderID[0], senderID[1])
                         continue
 
                     try:
@@ -3143,7 +8863,9 @@ while True:
                         # it's 80A.
                         slaveTWC = new_slave(senderID, 80)
 
+                    loopTimer.enter('print')
                     slaveTWC.print_status(heartbeatData)
+                    loopTimer.enter('dispatch')
                 else:
                     msgMatch = re.search(b'\A\xfb\xeb(..)(..)(\x00\x00\x00\x00\x00\x00\x00\x00\x00+?).\Z', msg, re.DOTALL)
                 if(msgMatch and foundMsgMatch == False):
@@ -3154,14 +8876,13 @@ while True:
                     receiverID = msgMatch.group(2)
 
                     if(senderID == fakeTWCID):
-                        print(time_now() + ": ERROR: Received voltage request message from " \
-                                "TWC %02X%02X that has the same TWCID as our fake slave." % \
-                                (senderID[0], senderID[1]))
+                        log(0, ": ERROR: Received voltage request message from " \
+                            "TWC %02X%02X that has the same TWCID as our fake slave.",
+                            senderID[0], senderID[1])
                         continue
 
-                    if(debugLevel >= 8):
-                        print(time_now() + ": VRQ from %02X%02X to %02X%02X" % \
-                            (senderID[0], senderID[1], receiverID[0], receiverID[1]))
+                    log(8, ": VRQ from %02X%02X to %02X%02X",
+                        senderID[0], senderID[1], receiverID[0], receiverID[1])
 
                     if(receiverID == fakeTWCID):
                         kWhCounter = int(kWhDelivered)
@@ -3169,9 +8890,9 @@ while True:
                                       ((kWhCounter >> 16) & 0xFF),
                                       ((kWhCounter >> 8) & 0xFF),
                                       (kWhCounter & 0xFF)])
-                        print(time_now() + ": VRS %02X%02X: %dkWh (%s) %dV %dV %dV" % \
-                            (fakeTWCID[0], fakeTWCID[1],
-                            kWhCounter, hex_str(kWhPacked), 240, 0, 0))
+                        log(0, ": VRS %02X%02X: %dkWh (%s) %dV %dV %dV",
+                            fakeTWCID[0], fakeTWCID[1],
+                            kWhCounter, kWhPacked, 240, 0, 0)
                         send_msg(bytearray(b'\xFD\xEB') + fakeTWCID
                                  + kWhPacked
                                  + bytearray(b'\x00\xF0\x00\x00\x00\x00\x00'))
@@ -3192,18 +8913,19 @@ while True:
                     voltsPhaseC = (data[8] << 8) + data[9]
 
                     if(senderID == fakeTWCID):
-                        print(time_now() + ": ERROR: Received voltage response message from " \
-                                "TWC %02X%02X that has the same TWCID as our fake slave." % \
-                                (senderID[0], senderID[1]))
+                        log(0, ": ERROR: Received voltage response message from " \
+                            "TWC %02X%02X that has the same TWCID as our fake slave.",
+                            senderID[0], senderID[1])
                         continue
 
-                    if(debugLevel >= 1):
-                        print(time_now() + ": VRS %02X%02X: %dkWh %dV %dV %dV" % \
-                            (senderID[0], senderID[1],
-                            kWhCounter, voltsPhaseA, voltsPhaseB, voltsPhaseC))
+                    log(1, ": VRS %02X%02X: %dkWh %dV %dV %dV",
+                        senderID[0], senderID[1],
+                        kWhCounter, voltsPhaseA, voltsPhaseB, voltsPhaseC)
 
                 if(foundMsgMatch == False):
-                    print(time_now() + ": ***UNKNOWN MESSAGE from master: " + hex_str(msg))
+                    metrics.inc('twc_unknown_frames_total')
+                    if(busHealth.unknown(msg, msg[2:4])):
+                        log(0, ": ***UNKNOWN MESSAGE from master: %s", msg)
 
     except KeyboardInterrupt:
         print("Exiting after background tasks complete...")
@@ -3218,13 +8940,26 @@ while True:
         time.sleep(5)
 
 
-# Wait for background tasks thread to finish all tasks.
+# Wait for background tasks threads to finish all tasks.
 # Note that there is no such thing as backgroundTasksThread.stop(). Because we
 # set the thread type to daemon, it will be automatically killed when we exit
 # this program.
-backgroundTasksQueue.join()
-
-ser.close()
+wait_background_tasks()
+
+# After a handoff, check_handoff() has already closed our files and the new
+# process is using the RS485 port, so leave all that alone.
+if(not handoffDone):
+    counterJournal.close()
+    if(sampleStore != None):
+        sampleStore.close()
+    rollups.queue_changes()
+    rollups.save()
+    if(fakeMaster == 1):
+        save_fleet_snapshot(fleet_snapshot())
+
+    ser.close()
+
+logWriter.stop()
 
 #
 # End main program